@@ -0,0 +1,200 @@
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from asr_backend import AsrBackend
+from base_util import asset_lock, get_asset_info
+from config import (
+    ALIGNMENT_CACHE_ASSETS,
+    ALIGNMENT_WORKERS,
+    DATA_BASE_DIR,
+    PROV_FILENAME,
+    WHISPER_JSON_FILE,
+)
+from daan_transcript import (
+    find_whisper_transcript,
+    generate_daan_transcript,
+    load_whisper_transcript,
+)
+from download import download_uri
+from output_sink import LocalSink
+from tracing import span, start_trace
+from transcode import get_audio_file, try_transcode
+from transcript_format import encode_whisper_transcript
+
+
+logger = logging.getLogger(__name__)
+
+
+# the Whisper transcripts of the most recently aligned assets, so the words of a
+# popular asset are served without reading and decoding its transcript again.
+# An entry is only used while the transcript file is unchanged
+class TranscriptCache:
+    def __init__(self, max_assets: int = ALIGNMENT_CACHE_ASSETS):
+        self.max_assets = max_assets
+        self.transcripts: OrderedDict[str, Tuple[int, dict]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, asset_id: str, mtime_ns: int) -> Optional[dict]:
+        with self.lock:
+            entry = self.transcripts.get(asset_id)
+            if entry is None or entry[0] != mtime_ns:
+                return None
+            self.transcripts.move_to_end(asset_id)
+            return entry[1]
+
+    def put(self, asset_id: str, mtime_ns: int, transcript: dict):
+        if self.max_assets <= 0:
+            return
+        with self.lock:
+            self.transcripts[asset_id] = (mtime_ns, transcript)
+            self.transcripts.move_to_end(asset_id)
+            while len(self.transcripts) > self.max_assets:
+                self.transcripts.popitem(last=False)
+
+
+transcript_cache = TranscriptCache()
+
+
+def needs_alignment(segment: dict) -> bool:
+    return not segment["words"] and bool(segment["text"])
+
+
+# adds the words to the segments (of a Whisper transcript) in place. The backend
+# aligns them in batches, so pass all segments that need it at once
+def align_segments(model: AsrBackend, audio_file: str, segments: List[dict]) -> int:
+    aligned = model.align(audio_file, segments)
+    for segment, words in zip(segments, aligned):
+        segment["words"] = [
+            {
+                "text": word.word.strip(),
+                "start": word.start,
+                "end": word.end,
+                "confidence": word.probability,
+            }
+            for word in words
+        ]
+    return len(segments)
+
+
+# the segments of the asset's transcript (in DATA_BASE_DIR) between start_s and
+# end_s, with their words aligned. Aligned words are saved in the transcript and
+# the DAAN transcript is regenerated, so every segment is aligned only once
+def align_asset(
+    asset_id: str,
+    model: AsrBackend,
+    start_s: float = 0.0,
+    end_s: float = math.inf,
+) -> List[dict]:
+    data_dir = os.path.join(DATA_BASE_DIR, asset_id)
+    with start_trace("align", asset_id=asset_id, start_s=start_s, end_s=end_s):
+        transcript = _load_transcript(asset_id, data_dir)
+        segments = _in_range(transcript, start_s, end_s)
+        if not any(needs_alignment(s) for s in segments):
+            return segments  # without the lock, e.g. for cached assets
+
+        with asset_lock(asset_id):
+            # another request may have aligned them while this one waited
+            transcript = _load_transcript(asset_id, data_dir)
+            segments = _in_range(transcript, start_s, end_s)
+            todo = [s for s in segments if needs_alignment(s)]
+            if not todo:
+                return segments
+            audio_file = _get_audio(asset_id, data_dir)
+            logger.info(f"Aligning the words of {len(todo)} segments of {asset_id}")
+            with span("align_words", segments=len(todo)):
+                align_segments(model, audio_file, todo)
+            if not any(needs_alignment(s) for s in transcript["segments"]):
+                transcript["word_alignment"] = "aligned"
+            _save_transcript(asset_id, data_dir, transcript)
+        return segments
+
+
+def _in_range(transcript: dict, start_s: float, end_s: float) -> List[dict]:
+    return [
+        s for s in transcript["segments"] if s["end"] > start_s and s["start"] < end_s
+    ]
+
+
+def _load_transcript(asset_id: str, data_dir: str) -> dict:
+    filename = find_whisper_transcript(data_dir)
+    if not filename:
+        raise FileNotFoundError(f"No Whisper transcript of {asset_id} in {data_dir}")
+    mtime_ns = os.stat(os.path.join(data_dir, filename)).st_mtime_ns
+    transcript = transcript_cache.get(asset_id, mtime_ns)
+    if transcript is None:
+        transcript = load_whisper_transcript(data_dir)
+        transcript_cache.put(asset_id, mtime_ns, transcript)
+    return transcript
+
+
+# saved with the current layout and compression, replacing the transcript that
+# may have been written with others
+def _save_transcript(asset_id: str, data_dir: str, transcript: dict):
+    old_file = find_whisper_transcript(data_dir)
+    sink = LocalSink(data_dir)
+    sink.put(WHISPER_JSON_FILE, encode_whisper_transcript(transcript))
+    if old_file and old_file != WHISPER_JSON_FILE:
+        os.remove(os.path.join(data_dir, old_file))
+    generate_daan_transcript(data_dir, transcript, sink)
+    mtime_ns = os.stat(sink.location(WHISPER_JSON_FILE)).st_mtime_ns
+    transcript_cache.put(asset_id, mtime_ns, transcript)
+
+
+# the audio the transcript was made from. It's kept in data_dir when the run had
+# no output_uri: the transcoded audio, or the input itself when it was ASR-ready
+# already. Otherwise the input the asset was made from (in its provenance) is
+# fetched again
+def _get_audio(asset_id: str, data_dir: str) -> str:
+    audio_file = get_audio_file(asset_id, data_dir)
+    if os.path.exists(audio_file):
+        return audio_file
+    input_uri = _get_input_uri(data_dir)
+    if not input_uri:
+        raise FileNotFoundError(f"No audio (or input URI) of {asset_id} to align")
+    fn = os.path.basename(urlparse(input_uri).path)
+    input_file = os.path.join(data_dir, fn)
+    if not os.path.exists(input_file):
+        # not into data_dir: a download clears the dir when the input is in it
+        with tempfile.TemporaryDirectory(
+            dir=DATA_BASE_DIR, prefix=f".{asset_id}.align-"
+        ) as scratch_dir:
+            _, extension = get_asset_info(fn)
+            dl_result = download_uri(input_uri, scratch_dir, fn, extension)
+            os.replace(dl_result.file_path, input_file)
+    return try_transcode(input_file, asset_id, data_dir).file_path
+
+
+def _get_input_uri(data_dir: str) -> str:
+    try:
+        with open(os.path.join(data_dir, PROV_FILENAME)) as f:
+            return json.load(f)["input_data"]
+    except (OSError, ValueError, KeyError):
+        return ""
+
+
+# aligns every segment of the assets, ALIGNMENT_WORKERS at a time: one asset's
+# audio is fetched and read while another one's words are aligned
+def align_assets(
+    asset_ids: List[str], model: AsrBackend, workers: int = ALIGNMENT_WORKERS
+) -> Dict[str, str]:
+    results: Dict[str, str] = {}
+
+    def align(asset_id: str):
+        try:
+            segments = align_asset(asset_id, model)
+            results[asset_id] = f"{len(segments)} segments aligned"
+        except Exception as e:
+            logger.exception(f"Failed to align {asset_id}")
+            results[asset_id] = f"failed: {e}"
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(align, asset_ids))
+    return results
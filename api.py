@@ -1,16 +1,55 @@
+import asyncio
+import hashlib
+import json
 import logging
+import math
+import os
 import sys
+import threading
+import time
+from contextlib import asynccontextmanager
 from typing import Optional
+from urllib.parse import urlparse
 from uuid import uuid4
-from fastapi import BackgroundTasks, FastAPI, HTTPException, status, Response
-from asr import run
-from whisper import load_model
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request, status, Response
+from alignment import align_asset
+from asr import run, get_pipeline_parameters
+from asr_backend import AsrBackend
+from base_util import (
+    CancelToken,
+    TaskCancelled,
+    copy_asr_output,
+    get_asset_info,
+    transfer_asr_output,
+    validate_http_uri,
+)
+from download import receive_upload
+from input_cache import get_cache_stats
+from profiler import SamplingProfiler, profile_run, save_profile
+from tracing import Trace, start_trace, to_chrome_trace, to_otlp
+from webhooks import Outbox, WebhookDispatcher
+from scheduler import (
+    DEFAULT_REAL_TIME_FACTOR,
+    QueuedJob,
+    Scheduler,
+    estimate_cost,
+    get_budget_error,
+    get_disk_space,
+    get_memory,
+)
+from whisper import load_model, warm_up_model
 from enum import Enum
 from pydantic import BaseModel
 from config import (
+    DATA_BASE_DIR,
+    DRAIN_TIMEOUT_S,
     MODEL_BASE_DIR,
+    PROFILING_ENABLED,
+    TASK_DEDUP_WINDOW_S,
     W_DEVICE,
     W_MODEL,
+    W_WARM_UP,
+    validate_config,
 )
 from config import LOG_FORMAT
 
@@ -21,12 +60,68 @@ logging.basicConfig(
     format=LOG_FORMAT,
 )
 logger = logging.getLogger(__name__)
-api = FastAPI()
 
-logger.info(f"Loading model on device {W_DEVICE}")
 
-# load the model in memory on API startup
-model = load_model(MODEL_BASE_DIR, W_MODEL, W_DEVICE)
+class ModelState(Enum):
+    LOADING = "LOADING"
+    READY = "READY"
+    FAILED = "FAILED"
+
+
+model: Optional[AsrBackend] = None
+model_state = ModelState.LOADING
+model_error: str | None = None
+
+
+class ModelStats(BaseModel):
+    load_s: float = -1
+    warm_up_s: float = -1
+    # real-time factor of the first task vs. the mean of the tasks after it
+    first_task_real_time_factor: float = -1
+    steady_state_real_time_factor: float = -1
+    transcribed_tasks: int = 0
+
+
+model_stats = ModelStats()
+
+
+# fetching and loading the model takes minutes, so it's done in the background:
+# meanwhile the API answers /health/live, and /health/ready reports it's not ready
+def load_model_in_background():
+    global model, model_state, model_error, scheduler_thread
+    logger.info(f"Loading model on device {W_DEVICE}")
+    try:
+        start_time = time.time()
+        loaded_model = load_model(MODEL_BASE_DIR, W_MODEL, W_DEVICE, warm_up=False)
+        model_stats.load_s = time.time() - start_time
+        if W_WARM_UP:
+            model_stats.warm_up_s = warm_up_model(loaded_model)
+        model = loaded_model
+        model_state = ModelState.READY
+        logger.info("Model loaded, ready to accept tasks")
+        scheduler_thread = threading.Thread(target=run_scheduler, daemon=True)
+        scheduler_thread.start()
+    except Exception as e:
+        logger.exception("Failed to load the model")
+        model_error = str(e)
+        model_state = ModelState.FAILED
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    validate_config()
+    global webhooks
+    webhooks = WebhookDispatcher(Outbox(OUTBOX_FILE))
+    webhooks.start()
+    restore_queue()
+    threading.Thread(target=load_model_in_background, daemon=True).start()
+    yield
+    # uvicorn stopped accepting requests, e.g. because it received SIGTERM
+    await asyncio.to_thread(drain)
+    await asyncio.to_thread(webhooks.stop)
+
+
+api = FastAPI(lifespan=lifespan)
 
 
 class Status(Enum):
@@ -51,14 +146,154 @@ class Task(BaseModel):
     id: str | None = None
     error_msg: str | None = None
     response: dict | None = None
+    # output_uris of identical submissions that were attached to this task
+    attached_output_uris: list[str] = []
+    finished_unix: float | None = None
+    # live progress (0-1) of the pipeline stage that is running
+    stage: str | None = None
+    progress: float | None = None
+    # queued tasks of a higher priority class are always started first
+    priority: int = 0
+    # estimated from the HEAD/head_object size and the probed duration of the input
+    content_length: int | None = None
+    duration_s: float | None = None
+    # seconds until the task is expected to be done, based on the real-time factor
+    eta_s: float | None = None
+    submitted_unix: float | None = None
+    # POSTed the result when the task is DONE or ERROR (see webhooks.py), so the
+    # task doesn't need to be polled
+    callback_url: str = ""
+    # callback_urls of identical submissions that were attached to this task
+    attached_callback_urls: list[str] = []
+    # profile the run (see profiler.py, needs PROFILING_ENABLED), the response
+    # links to the profile
+    profile: bool = False
+    profile_memory: bool = False
 
 
 all_tasks: dict[str, Task] = {}
 
+# fingerprint of input + parameters -> ID of the task producing that output
+task_fingerprints: dict[str, str] = {}
+
+# guards the attached_output_uris and status of tasks while fanning out output
+fan_out_lock = threading.Lock()
+
 current_task: Optional[Task] = None
 
+# task ID -> uploaded input file waiting to be claimed by the pipeline
+uploaded_files: dict[str, str] = {}
+
+# the submitted tasks that wait for the model
+scheduler = Scheduler()
+
+# how often a task that doesn't fit in the free disk/memory is reconsidered
+ADMISSION_RETRY_S = 30
+
+# task ID -> token to cancel the run of the task with
+cancel_tokens: dict[str, CancelToken] = {}
+
+# task ID -> trace of its (last) run
+traces: dict[str, Trace] = {}
+
+# set on shutdown: no new tasks are accepted or started
+draining = False
+scheduler_thread: Optional[threading.Thread] = None
+
+# queued (and drained) tasks are kept here while the worker restarts
+QUEUE_FILE = os.path.join(DATA_BASE_DIR, ".queued-tasks.json")
+# how long a cancelled run gets to reach its next cancellation check
+CANCEL_TIMEOUT_S = 60
+
+# the callbacks of finished tasks that weren't delivered yet survive restarts here
+OUTBOX_FILE = os.path.join(DATA_BASE_DIR, ".webhook-outbox.db")
+webhooks: Optional[WebhookDispatcher] = None
+
+
+def get_fingerprint(input_uri: str) -> str:
+    fingerprint_data = {"input_uri": input_uri, **get_pipeline_parameters()}
+    return hashlib.sha256(
+        json.dumps(fingerprint_data, sort_keys=True).encode()
+    ).hexdigest()
+
+
+# returns the in-flight or recently finished task with the same input & parameters
+def find_duplicate_task(input_uri: str) -> Optional[Task]:
+    task_id = task_fingerprints.get(get_fingerprint(input_uri))
+    task = all_tasks.get(task_id) if task_id else None
+    if not task or task.status == Status.ERROR:
+        return None
+    if task.status == Status.DONE and (
+        not task.finished_unix or time.time() - task.finished_unix > TASK_DEDUP_WINDOW_S
+    ):
+        return None
+    return task
+
+
+# returns True if the output_uri still needs to receive the output of the task
+def attach_to_task(task: Task, output_uri: str) -> bool:
+    with fan_out_lock:
+        if not output_uri or output_uri in [
+            task.output_uri,
+            *task.attached_output_uris,
+        ]:
+            return False
+        task.attached_output_uris.append(output_uri)
+        # in-flight tasks deliver all attached output_uris when done
+        return task.status == Status.DONE
+
+
+# returns True if the task is done already, so the callback_url is notified now
+def attach_callback(task: Task, callback_url: str) -> bool:
+    with fan_out_lock:
+        if task.status == Status.DONE:
+            return True
+        if callback_url not in [task.callback_url, *task.attached_callback_urls]:
+            task.attached_callback_urls.append(callback_url)
+        return False
+
+
+# queues a POST of the result of a finished (DONE or ERROR) task to its callbacks
+def notify_finished(task: Task, callback_urls: Optional[list[str]] = None):
+    if callback_urls is None:
+        callback_urls = [task.callback_url, *task.attached_callback_urls]
+    callback_urls = [u for u in dict.fromkeys(callback_urls) if u]
+    if not callback_urls or webhooks is None:
+        return
+    payload = task.model_dump(
+        mode="json",
+        include={
+            "id",
+            "status",
+            "input_uri",
+            "output_uri",
+            "error_msg",
+            "response",
+            "finished_unix",
+        },
+    )
+    for callback_url in callback_urls:
+        webhooks.notify(callback_url, payload)
+
+
+def deliver_output(task: Task, output_uri: str):
+    logger.info(f"Delivering output of task {task.id} to {output_uri}")
+    try:
+        if task.output_uri:  # local output was removed after the transfer
+            success = copy_asr_output(task.output_uri, output_uri)
+        else:
+            asset_id, _ = get_asset_info(urlparse(task.input_uri).path)
+            success = transfer_asr_output(
+                os.path.join(DATA_BASE_DIR, asset_id), output_uri
+            )
+        if not success:
+            raise Exception(f"Transfer to {output_uri} failed")
+    except Exception:
+        logger.exception(f"Failed to deliver output of task {task.id}")
+
 
 def delete_task(task_id):
+    traces.pop(task_id, None)
     try:
         del all_tasks[task_id]
     except KeyError:
@@ -71,36 +306,249 @@ def update_task(task: Task):
     all_tasks[task.id] = task
 
 
+# runs the queued tasks one by one, in the order of the SCHEDULING_POLICY
+def run_scheduler():
+    global current_task
+    while not draining:
+        job = scheduler.pop_next(get_real_time_factor(), ADMISSION_RETRY_S)
+        if job and draining:
+            scheduler.add(job)  # taken just before the drain started
+            break
+        task = all_tasks.get(job.id) if job else None
+        if task:
+            current_task = task
+            try_whisper(task)
+
+
+# finishes the running task, or cancels it after DRAIN_TIMEOUT_S (keeping the
+# transcoded audio, so the next run skips the transcode), and persists the queue,
+# so a rolling restart doesn't lose or redo work
+def drain():
+    global draining
+    draining = True
+    with scheduler.changed:
+        scheduler.changed.notify_all()
+    thread = scheduler_thread
+    if thread and thread.is_alive():
+        logger.info(f"Draining, waiting up to {DRAIN_TIMEOUT_S}s for the running task")
+        thread.join(DRAIN_TIMEOUT_S)
+        task = current_task
+        if thread.is_alive() and task and task.id in cancel_tokens:
+            logger.warning(f"Cancelling task {task.id}, it's requeued on restart")
+            cancel_tokens[task.id].cancel("The worker was drained", keep_output=True)
+            thread.join(CANCEL_TIMEOUT_S)
+    save_queue()
+
+
+def save_queue():
+    queued = [
+        {
+            "task": task.model_dump(
+                mode="json", exclude={"stage", "progress", "eta_s"}
+            ),
+            "uploaded_file": uploaded_files.get(task.id or "", ""),
+        }
+        for task in all_tasks.values()
+        if task.status in [Status.CREATED, Status.PROCESSING]
+    ]
+    if not queued:
+        return
+    logger.info(f"Saving {len(queued)} queued tasks to {QUEUE_FILE}")
+    with open(f"{QUEUE_FILE}.part", "w") as f:
+        json.dump(queued, f)
+    os.replace(f"{QUEUE_FILE}.part", QUEUE_FILE)
+
+
+# queues the tasks saved by the previous drain again
+def restore_queue():
+    if not os.path.exists(QUEUE_FILE):
+        return
+    with open(QUEUE_FILE, "r") as f:
+        queued = json.load(f)
+    restored = []
+    for entry in queued:
+        task = Task(**entry["task"])
+        task.status = Status.CREATED
+        if not task.id:
+            continue
+        all_tasks[task.id] = task
+        task_fingerprints[get_fingerprint(task.input_uri)] = task.id
+        if os.path.exists(entry["uploaded_file"]):
+            uploaded_files[task.id] = entry["uploaded_file"]
+        scheduler.add(
+            QueuedJob(task.id, task.priority, task.submitted_unix or time.time())
+        )
+        restored.append(task)
+    logger.info(f"Restored {len(restored)} queued tasks from {QUEUE_FILE}")
+    os.remove(QUEUE_FILE)
+
+    def estimate_tasks():
+        for task in restored:
+            estimate_task(task)
+
+    threading.Thread(target=estimate_tasks, daemon=True).start()
+
+
+# estimates the cost of a queued task, so the scheduler can order it, and rejects
+# it right away if it could never fit in the disk or memory
+def estimate_task(task: Task):
+    cost = estimate_cost(task.input_uri, uploaded_files.get(task.id or "", ""))
+    task.content_length = cost.content_length
+    task.duration_s = cost.duration_s
+    total_disk, _ = get_disk_space()
+    total_memory, _ = get_memory()
+    if error := get_budget_error(cost, total_disk, total_memory):
+        if scheduler.remove(task.id or ""):
+            logger.error(f"Rejecting task {task.id}: {error}")
+            task.status = Status.ERROR
+            task.error_msg = error
+            task.finished_unix = time.time()
+            remove_upload(uploaded_files.pop(task.id or "", ""))
+            notify_finished(task)
+        return
+    scheduler.set_cost(task.id or "", cost)
+
+
+# measured on the tasks so far, so the first task's warm-up doesn't skew it
+def get_real_time_factor() -> float:
+    if model_stats.steady_state_real_time_factor > 0:
+        return model_stats.steady_state_real_time_factor
+    if model_stats.first_task_real_time_factor > 0:
+        return model_stats.first_task_real_time_factor
+    return DEFAULT_REAL_TIME_FACTOR
+
+
+# refreshes the ETA of the running and queued tasks
+def update_etas():
+    real_time_factor = get_real_time_factor()
+    running_remaining_s = 0.0
+    task = current_task
+    if task and task.status == Status.PROCESSING and task.duration_s:
+        running_remaining_s = max(task.duration_s, 0) * real_time_factor
+        if task.stage == "asr" and task.progress:
+            running_remaining_s *= 1 - task.progress
+        task.eta_s = round(running_remaining_s, 1)
+    for task_id, eta_s in scheduler.get_etas(
+        real_time_factor, running_remaining_s
+    ).items():
+        if task_id in all_tasks:
+            all_tasks[task_id].eta_s = round(eta_s, 1)
+
+
 def try_whisper(task: Task):
     logger.info(f"Trying to call Whisper for task {task.id}")
+    cancel = cancel_tokens[task.id or ""] = CancelToken()
+    profiler: Optional[SamplingProfiler] = None
 
     try:
         task.status = Status.PROCESSING
         update_task(task)
-        outputs = run(task.input_uri, task.output_uri, model)
-        task.status = Status.DONE
+        with start_trace("task", task_id=task.id) as trace:
+            traces[task.id or ""] = trace
+            with profile_run(
+                task.profile or task.profile_memory, task.profile_memory
+            ) as profiler:
+                outputs = run(
+                    task.input_uri,
+                    task.output_uri,
+                    model,
+                    uploaded_files.get(task.id or "", ""),
+                    lambda stage, progress: set_progress(task, stage, progress),
+                    cancel,
+                )
         task.response = outputs
         logger.info(f"Successfully transcribed task {task.id}")
+        update_model_stats(outputs["real_time_factor"])
+        fan_out(task)
+    except TaskCancelled as e:
+        logger.info(f"Task {task.id} was cancelled: {e}")
+        # a drained task is queued again when the worker restarts
+        task.status = Status.CREATED if e.keep_output else Status.ERROR
+        task.error_msg = None if e.keep_output else str(e)
+        task.stage = task.progress = None
     except Exception as e:
         logger.error("Failed to run Whisper")
         logger.exception(e)
         task.status = Status.ERROR
         task.error_msg = str(e)
+        task.finished_unix = time.time()
+    finally:
+        cancel_tokens.pop(task.id or "", None)
+        if task.status != Status.CREATED:
+            remove_upload(uploaded_files.pop(task.id or "", ""))
+        if profiler:
+            save_task_profile(task, profiler)
+    task.eta_s = None
+    if task.id not in all_tasks:  # deleted (and cancelled) meanwhile
+        logger.info(f"Task {task.id} was deleted, its callback URLs aren't notified")
+        return
     update_task(task)
     logger.info(f"Task {task.id} has been updated")
+    if task.status in [Status.DONE, Status.ERROR]:
+        notify_finished(task)
+
+
+# also when the run failed, that may be why it was profiled
+def save_task_profile(task: Task, profiler: SamplingProfiler):
+    asset_id, _ = get_asset_info(urlparse(task.input_uri).path)
+    try:
+        locations = save_profile(
+            profiler, os.path.join(DATA_BASE_DIR, asset_id), task.output_uri
+        )
+        logger.info(f"Saved the profile of task {task.id} to {locations}")
+        task.response = {**(task.response or {}), "profile": locations}
+    except Exception:
+        logger.exception(f"Failed to save the profile of task {task.id}")
+
+
+def update_model_stats(real_time_factor: float):
+    if real_time_factor <= 0:  # the transcript already existed
+        return
+    stats = model_stats
+    stats.transcribed_tasks += 1
+    if stats.transcribed_tasks == 1:
+        stats.first_task_real_time_factor = real_time_factor
+    elif stats.transcribed_tasks == 2:
+        stats.steady_state_real_time_factor = real_time_factor
+    else:  # running mean over all tasks but the first
+        n = stats.transcribed_tasks - 1
+        stats.steady_state_real_time_factor += (
+            real_time_factor - stats.steady_state_real_time_factor
+        ) / n
+
+
+def set_progress(task: Task, stage: str, progress: float):
+    task.stage = stage
+    task.progress = round(progress, 3)
+
+
+# delivers the output to the output_uris attached while the task was running
+def fan_out(task: Task):
+    delivered = [task.output_uri]
+    while True:
+        with fan_out_lock:
+            pending = [u for u in task.attached_output_uris if u not in delivered]
+            if not pending:
+                task.finished_unix = time.time()
+                task.status = Status.DONE
+                return
+        for output_uri in pending:
+            deliver_output(task, output_uri)
+            delivered.append(output_uri)
 
 
 @api.get("/tasks")
 def get_all_tasks():
+    update_etas()
     return {"data": all_tasks}
 
 
 @api.get("/status")
 def get_status(response: Response):
 
-    if current_task and current_task.status == Status.PROCESSING:
+    if unavailable_msg := get_unavailable_msg():
         response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
-        return {"msg": "The worker is currently processing a task. Try again later!"}
+        return {"msg": unavailable_msg}
 
     response.status_code = status.HTTP_200_OK
     return {"msg": "The worker is available!"}
@@ -110,17 +558,127 @@ def get_status(response: Response):
 async def create_task(
     task: Task, background_tasks: BackgroundTasks, response: Response
 ):
-    global current_task
-    if current_task and current_task.status == Status.PROCESSING:
+    return submit_task(task, background_tasks, response)
+
+
+# streams the (possibly chunked) request body to disk, so no input_uri is needed
+@api.post("/tasks/upload", status_code=status.HTTP_201_CREATED)
+async def create_upload_task(
+    request: Request,
+    filename: str,
+    background_tasks: BackgroundTasks,
+    response: Response,
+    output_uri: str = "",
+    callback_url: str = "",
+):
+    # don't read the whole body, only to reject it afterwards
+    if unavailable_msg := get_rejection_msg():
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"msg": unavailable_msg}
+
+    fn = os.path.basename(filename)
+    if not os.path.splitext(fn)[1]:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Please provide a filename with extension, not |{filename}|",
+        )
+    upload = await receive_upload(
+        request.stream(), os.path.join(DATA_BASE_DIR, ".uploads")
+    )
+    # the content hash makes identical uploads coalesce into the same task
+    task = Task(
+        input_uri=f"upload://{upload.sha256}/{fn}",
+        output_uri=output_uri,
+        callback_url=callback_url,
+    )
+    return submit_task(task, background_tasks, response, upload.file_path)
+
+
+def submit_task(
+    task: Task,
+    background_tasks: BackgroundTasks,
+    response: Response,
+    uploaded_file: str = "",
+) -> dict:
+    if task.callback_url and not validate_http_uri(task.callback_url):
+        remove_upload(uploaded_file)
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Please provide an http(s) callback_url, not |{task.callback_url}|",
+        )
+    if (task.profile or task.profile_memory) and not PROFILING_ENABLED:
+        remove_upload(uploaded_file)
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Profiling is disabled on this worker (see PROFILING_ENABLED)",
+        )
+    # a profiled task is run, rather than attached to an identical one
+    duplicate = (
+        None
+        if task.profile or task.profile_memory
+        else find_duplicate_task(task.input_uri)
+    )
+    if duplicate:
+        logger.info(f"Attaching submission of {task.input_uri} to {duplicate.id}")
+        remove_upload(uploaded_file)
+        if attach_to_task(duplicate, task.output_uri):
+            background_tasks.add_task(deliver_output, duplicate, task.output_uri)
+        if task.callback_url and attach_callback(duplicate, task.callback_url):
+            background_tasks.add_task(notify_finished, duplicate, [task.callback_url])
+        response.status_code = status.HTTP_200_OK
+        return {
+            "data": duplicate.dict(),
+            "msg": "Attached to existing task with the same input",
+            "task_id": duplicate.id,
+        }
+
+    if unavailable_msg := get_rejection_msg():
+        remove_upload(uploaded_file)
         response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
-        return {"msg": "The worker is currently processing a task. Try again later!"}
-    background_tasks.add_task(try_whisper, task)
+        return {"msg": unavailable_msg}
     task.id = str(uuid4())
     task.status = Status.CREATED
-    current_task = task
+    task.submitted_unix = time.time()
     task_dict = task.dict()
-    all_tasks["task_id"] = task
-    return {"data": task_dict, "msg": "Successfully added task", "task_id": task.id}
+    all_tasks[task.id] = task
+    task_fingerprints[get_fingerprint(task.input_uri)] = task.id
+    if uploaded_file:
+        uploaded_files[task.id] = uploaded_file
+    scheduler.add(QueuedJob(task.id, task.priority, task.submitted_unix))
+    background_tasks.add_task(estimate_task, task)
+    return {"data": task_dict, "msg": "Successfully queued task", "task_id": task.id}
+
+
+def worker_busy() -> bool:
+    return current_task is not None and current_task.status == Status.PROCESSING
+
+
+# why no new task can be started right now, empty if one can
+def get_unavailable_msg() -> str:
+    if model_state == ModelState.LOADING:
+        return "The worker is still loading the model. Try again later!"
+    if model_state == ModelState.FAILED:
+        return f"The worker failed to load the model: {model_error}"
+    if worker_busy():
+        return "The worker is currently processing a task. Try again later!"
+    return ""
+
+
+# why a submitted task can't be queued, empty if it can
+def get_rejection_msg() -> str:
+    if draining:
+        return "The worker is shutting down. Try again later!"
+    if model_state != ModelState.READY:
+        return get_unavailable_msg()
+    if scheduler.is_full():
+        return "The queue of the worker is full. Try again later!"
+    return ""
+
+
+def remove_upload(uploaded_file: str):
+    if uploaded_file and os.path.exists(uploaded_file):
+        logger.info(f"Removing unclaimed upload {uploaded_file}")
+        os.remove(uploaded_file)
 
 
 @api.get("/tasks/{task_id}")
@@ -131,14 +689,66 @@ async def get_task(task_id: str, response: Response):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail=f"Task {task_id} not found"
         )
+    update_etas()
     response.status_code = StatusToHTTP[task.status]
     return {"data": task}
 
 
+# the steps of the task's run as Chrome trace JSON (chrome://tracing, Perfetto) or
+# OTLP/JSON (format=otlp), to e.g. POST to an OpenTelemetry collector
+@api.get("/tasks/{task_id}/trace")
+async def get_task_trace(task_id: str, format: str = "chrome"):
+    if format not in ["chrome", "otlp"]:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Please use either chrome|otlp as format, not |{format}|",
+        )
+    trace = traces.get(task_id)
+    if not trace:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No trace of task {task_id} (yet)",
+        )
+    return to_otlp(trace) if format == "otlp" else to_chrome_trace(trace)
+
+
+# the words of the asset's segments between start_s and end_s, aligned on demand
+# when its word timestamps were deferred (see W_DEFER_WORD_TIMESTAMPS). Only works
+# for assets whose transcript was kept in DATA_BASE_DIR (i.e. without output_uri)
+@api.get("/assets/{asset_id}/words")
+def get_asset_words(
+    asset_id: str,
+    response: Response,
+    start_s: float = 0.0,
+    end_s: float = -1,  # the end of the asset
+):
+    if model is None:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"msg": get_unavailable_msg()}
+    try:
+        segments = align_asset(
+            os.path.basename(asset_id),
+            model,
+            start_s,
+            end_s if end_s >= 0 else math.inf,
+        )
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    return {
+        "data": [
+            {k: s[k] for k in ["id", "start", "end", "text", "words"]} for s in segments
+        ]
+    }
+
+
 @api.delete("/tasks/{task_id}")
 async def remove_task(task_id: str):
     try:
         delete_task(task_id)
+        if scheduler.remove(task_id):  # a queued task is not started anymore
+            remove_upload(uploaded_files.pop(task_id, ""))
+        elif cancel_token := cancel_tokens.get(task_id):
+            cancel_token.cancel(f"Task {task_id} was deleted")
         return {
             "msg": f"Successfully deleted task {task_id}",
             "task_id": task_id,
@@ -154,3 +764,38 @@ async def remove_task(task_id: str):
 @api.get("/ping")
 async def ping():
     return "pong"
+
+
+# the callbacks that are waiting for (a retry of) their delivery, and the ones
+# that failed
+@api.get("/webhooks")
+async def get_webhooks():
+    return {"data": webhooks.outbox.get_counts() if webhooks else {}}
+
+
+# hits, misses and bytes saved by the input cache (see INPUT_CACHE_MAX_BYTES)
+@api.get("/cache")
+async def get_input_cache():
+    return {"data": get_cache_stats()}
+
+
+# liveness: the process is responsive (restarting it won't help while it's loading)
+@api.get("/health/live")
+async def health_live(response: Response):
+    if model_state == ModelState.FAILED:
+        response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        return {"model": model_state.value, "msg": model_error}
+    return {"model": model_state.value}
+
+
+# readiness: the model is loaded, so tasks can be accepted
+@api.get("/health/ready")
+async def health_ready(response: Response):
+    if model_state != ModelState.READY or draining:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {
+        "model": model_state.value,
+        "busy": worker_busy(),
+        "backend": model.resource_info() if model else None,
+        "model_stats": model_stats,
+    }
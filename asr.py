@@ -1,14 +1,22 @@
 import logging
 import os
 import time
+from typing import Optional, Union
 from urllib.parse import urlparse
 
 from base_util import (
+    CancelToken,
+    ProgressCallback,
+    TaskCancelled,
+    asset_lock,
     get_asset_info,
-    save_provenance,
+    provenance_to_json,
 )
 from config import (
     DATA_BASE_DIR,
+    STREAM_VIDEO_INPUT,
+    W_BACKEND,
+    W_DEFER_WORD_TIMESTAMPS,
     W_WORD_TIMESTAMPS,
     W_DEVICE,
     W_MODEL,
@@ -18,39 +26,109 @@ from config import (
     WHISPER_JSON_FILE,
     DAAN_JSON_FILE,
     PROV_FILENAME,
+    WORD_INDEX,
+    WORD_INDEX_FILE,
 )
 
-from download import download_uri
+from download import claim_staged_input, download_uri
+from input_cache import is_cached, mark_streamed, was_streamed
 from whisper import run_asr
-from base_util import remove_all_input_output, transfer_asr_output, Provenance
-from transcode import try_transcode
-from daan_transcript import generate_daan_transcript
+from base_util import remove_all_input_output, Provenance
+from output_sink import LocalSink, OutputSink, get_output_sink
+from transcode import (
+    TranscodeResult,
+    get_audio_file,
+    try_stream_transcode,
+    try_transcode,
+)
+from daan_transcript import (
+    find_whisper_transcript,
+    generate_daan_transcript,
+    load_whisper_transcript,
+)
+from tracing import current_span, span, start_trace
+from transcript import Transcript
 
 logger = logging.getLogger(__name__)
 
 
-def run(input_uri: str, output_uri: str, model=None) -> dict:
+# parameters that determine the outcome of a run (also used to detect duplicate tasks)
+def get_pipeline_parameters() -> dict:
+    return {
+        "BACKEND": W_BACKEND,
+        "WORD_TIMESTAMPS": W_WORD_TIMESTAMPS,
+        "DEFER_WORD_TIMESTAMPS": W_DEFER_WORD_TIMESTAMPS,
+        "DEVICE": W_DEVICE,
+        "VAD": W_VAD,
+        "MODEL": W_MODEL,
+        "BEAM_SIZE": W_BEAM_SIZE,
+        "BEST_OF": W_BEST_OF,
+    }
+
+
+def run(
+    input_uri: str,
+    output_uri: str,
+    model=None,
+    staged_file: str = "",
+    on_progress: Optional[ProgressCallback] = None,
+    cancel: Optional[CancelToken] = None,
+) -> dict:
     logger.info(f"Processing {input_uri} (save to --> {output_uri})")
-    start_time = time.time()
-    prov_steps = []  # track provenance
 
-    try:
-        # 1. get all needed info about input
-        fn = os.path.basename(urlparse(input_uri).path)
-        asset_id, extension = get_asset_info(fn)
-        data_dir = os.path.join(DATA_BASE_DIR, asset_id)
+    # 1. get all needed info about input
+    fn = os.path.basename(urlparse(input_uri).path)
+    asset_id, extension = get_asset_info(fn)
+    data_dir = os.path.join(DATA_BASE_DIR, asset_id)
 
-        # 2. download input
-        dl_result = download_uri(input_uri, data_dir, fn, extension)
-        logger.info(dl_result)
+    with start_trace("asr.run", input_uri=input_uri, asset_id=asset_id):
+        # only one pipeline at a time may use the asset dir
+        with asset_lock(asset_id):
+            return _run_pipeline(
+                input_uri,
+                output_uri,
+                model,
+                fn,
+                asset_id,
+                extension,
+                data_dir,
+                staged_file,
+                on_progress,
+                cancel or CancelToken(),
+            )
 
-        prov_steps.append(dl_result.provenance)
 
-        # 3. convert input to audio if input is video
-        transcode_prov = try_transcode(
-            dl_result.file_path, asset_id, extension, data_dir
+def _run_pipeline(
+    input_uri: str,
+    output_uri: str,
+    model,
+    fn: str,
+    asset_id: str,
+    extension: str,
+    data_dir: str,
+    staged_file: str,
+    on_progress: Optional[ProgressCallback],
+    cancel: CancelToken,
+) -> dict:
+    start_time = time.time()
+    prov_steps: list[Provenance] = []  # track provenance
+    # with an output_uri every output file is uploaded (from memory) as soon as
+    # it's ready, instead of being written to data_dir
+    sink = get_output_sink(data_dir, output_uri)
+
+    try:
+        # 2. & 3. download input and convert it to audio if necessary
+        audio = _get_audio(
+            input_uri,
+            fn,
+            asset_id,
+            extension,
+            data_dir,
+            staged_file,
+            prov_steps,
+            on_progress,
+            cancel,
         )
-        prov_steps.append(transcode_prov)
 
         whisper_prov = Provenance(
             activity_name="Whisper transcript already exists",
@@ -60,28 +138,39 @@ def run(input_uri: str, output_uri: str, model=None) -> dict:
         )
 
         # 4. run ASR
-        if not asr_already_done(data_dir):
-            logger.info("No Whisper transcript found")
-            whisper_prov = run_asr(dl_result.file_path, data_dir, asset_id, model)
-        else:
-            logger.info(f"Whisper transcript already present in {data_dir}")
+        cancel.check()
+        whisper_transcript: Union[dict, Transcript, None] = None
+        # an earlier run may have written it with another layout or compression
+        whisper_file = find_whisper_transcript(data_dir) or WHISPER_JSON_FILE
+        with span("asr", audio_s=audio.duration) as asr_span:
+            if not asr_already_done(data_dir):
+                logger.info("No Whisper transcript found")
+                whisper_prov, whisper_transcript = run_asr(
+                    audio.file_path,
+                    data_dir,
+                    asset_id,
+                    model,
+                    audio.duration,
+                    on_progress,
+                    sink,
+                    cancel,
+                )
+                if audio.duration > 0:
+                    real_time_factor = (
+                        whisper_prov.processing_time_ms / 1000 / audio.duration
+                    )
+                    whisper_prov.parameters["real_time_factor"] = real_time_factor
+            else:
+                logger.info(f"Whisper transcript already present in {data_dir}")
+                asr_span.set("skipped", "Whisper transcript already exists")
+                _put_existing_output(sink, data_dir, whisper_file)
 
         prov_steps.append(whisper_prov)
 
         # 5. generate DAAN format transcript
-        daan_prov = Provenance(
-            activity_name="DAAN transcript already exists",
-            activity_description="",
-            start_time_unix=time.time(),
-            input_data="",
-        )
-
-        if not daan_transcript_already_done(data_dir):
-            logger.info("No DAAN transcript found")
-            daan_prov = generate_daan_transcript(data_dir)
-        else:
-            logger.info(f"DAAN transcript already present in {data_dir}")
-
+        cancel.check()
+        with span("daan_transcript"):
+            daan_prov = _get_daan_transcript(data_dir, whisper_transcript, sink)
         prov_steps.append(daan_prov)
 
         # 6. generate final provenance
@@ -92,51 +181,145 @@ def run(input_uri: str, output_uri: str, model=None) -> dict:
             "and transcribes it using Whisper",
             processing_time_ms=end_time,
             start_time_unix=start_time,
-            parameters={
-                "WORD_TIMESTAMPS": W_WORD_TIMESTAMPS,
-                "DEVICE": W_DEVICE,
-                "VAD": W_VAD,
-                "MODEL": W_MODEL,
-                "BEAM_SIZE": W_BEAM_SIZE,
-                "BEST_OF": W_BEST_OF,
-            },
+            parameters=get_pipeline_parameters(),
             input_data=input_uri,
             output_data=output_uri if output_uri else data_dir,
             steps=prov_steps,
         )
 
-        save_provenance(final_prov, data_dir)
+        # 7. save the provenance once the transcripts are stored, so its presence
+        # (also in the output_uri) means the output is complete
+        with span("wait_for_outputs"):
+            sink.wait()
+        sink.put(PROV_FILENAME, provenance_to_json(final_prov))
+        with span("close_outputs"):
+            sink.close()
 
-        # 7. transfer output
         if output_uri:
-            transfer_asr_output(data_dir, output_uri)
             remove_all_input_output(data_dir)
         else:
             logger.info("No output_uri specified, so all is done")
 
         return {
-            "whisper_transcript": WHISPER_JSON_FILE,
+            "whisper_transcript": whisper_file,
             "daan_transcript": DAAN_JSON_FILE,
             "provenance": PROV_FILENAME,
+            "audio_duration_s": audio.duration,
+            "real_time_factor": whisper_prov.parameters.get("real_time_factor", -1),
         }
 
     except Exception as e:
         logger.error(f"Worker failed! Exception raised: {e}")
-        # Check if variable exists (might not if exception raised from download_uri)
-        if os.path.exists(data_dir):
+        try:
+            sink.close()
+        except Exception:
+            logger.exception("Failed to store the output of the failed run")
+        if isinstance(e, TaskCancelled) and e.keep_output:
+            logger.info(f"Keeping {data_dir}, so the next run can continue from it")
+        elif os.path.exists(data_dir):
             remove_all_input_output(data_dir)
         raise e
 
 
-# check if there is a whisper-transcript.json
+def _get_daan_transcript(
+    data_dir: str, whisper_transcript: Union[dict, Transcript, None], sink: OutputSink
+) -> Provenance:
+    if daan_transcript_already_done(data_dir):
+        logger.info(f"DAAN transcript already present in {data_dir}")
+        current_span().set("skipped", "DAAN transcript already exists")
+        _put_existing_output(sink, data_dir, DAAN_JSON_FILE)
+        if WORD_INDEX:
+            _put_existing_output(sink, data_dir, WORD_INDEX_FILE)
+        return Provenance(
+            activity_name="DAAN transcript already exists",
+            activity_description="",
+            start_time_unix=time.time(),
+            input_data="",
+        )
+
+    logger.info("No DAAN transcript found")
+    if whisper_transcript is None:
+        whisper_transcript = load_whisper_transcript(data_dir)
+    return generate_daan_transcript(data_dir, whisper_transcript, sink)
+
+
+# outputs of an earlier run that were kept in data_dir (no output_uri) also go to
+# the output_uri of this run
+def _put_existing_output(sink: OutputSink, data_dir: str, filename: str):
+    if isinstance(sink, LocalSink):
+        return
+    with open(os.path.join(data_dir, filename), "rb") as f:
+        sink.put(filename, f.read())
+
+
+# returns the audio to transcribe, tracking provenance in prov_steps
+def _get_audio(
+    input_uri: str,
+    fn: str,
+    asset_id: str,
+    extension: str,
+    data_dir: str,
+    staged_file: str,
+    prov_steps: list[Provenance],
+    on_progress: Optional[ProgressCallback],
+    cancel: CancelToken,
+) -> TranscodeResult:
+    # e.g. an earlier run of this input was cancelled while draining the worker
+    audio_file = get_audio_file(asset_id, data_dir)
+    if os.path.exists(audio_file):
+        with span("transcode", input=audio_file):
+            audio = try_transcode(audio_file, asset_id, data_dir)
+        prov_steps.append(audio.provenance)
+        return audio
+
+    # inputs that need transcoding are streamed into ffmpeg, so they never land on
+    # disk. Unless they're in the input cache already, or were streamed before: a
+    # retry or re-run downloads them into the cache instead of streaming again
+    if (
+        STREAM_VIDEO_INPUT
+        and not staged_file
+        and not is_cached(input_uri)
+        and not was_streamed(input_uri)
+    ):
+        mark_streamed(input_uri)
+        with span("stream_transcode", input=input_uri) as stream_span:
+            transcode_result = try_stream_transcode(
+                input_uri, asset_id, data_dir, on_progress, cancel
+            )
+            stream_span.set("streamed", transcode_result is not None)
+        if transcode_result:
+            prov_steps.append(transcode_result.provenance)
+            return transcode_result
+
+    # 2. download input (unless it was uploaded or prefetched already)
+    if staged_file:
+        dl_result = claim_staged_input(staged_file, input_uri, data_dir, fn, extension)
+    else:
+        dl_result = download_uri(input_uri, data_dir, fn, extension)
+    logger.info(dl_result)
+
+    prov_steps.append(dl_result.provenance)
+    cancel.check()
+
+    # 3. convert input to audio if it is not ASR-ready audio already
+    with span("transcode", input=dl_result.file_path):
+        transcode_result = try_transcode(
+            dl_result.file_path, asset_id, data_dir, on_progress, cancel
+        )
+    prov_steps.append(transcode_result.provenance)
+    return transcode_result
+
+
+# check if there is a Whisper transcript, with any layout and compression
 def asr_already_done(output_dir: str) -> bool:
-    whisper_transcript = os.path.join(output_dir, WHISPER_JSON_FILE)
-    logger.info(f"Checking existence of {whisper_transcript}")
-    return os.path.exists(os.path.join(output_dir, WHISPER_JSON_FILE))
+    logger.info(f"Checking existence of a Whisper transcript in {output_dir}")
+    return find_whisper_transcript(output_dir) != ""
 
 
-# check if there is a daan-es-transcript.json
+# check if there is a daan-es-transcript.json (and word index, written with it)
 def daan_transcript_already_done(output_dir: str) -> bool:
     daan_transcript = os.path.join(output_dir, DAAN_JSON_FILE)
     logger.info(f"Checking existence of {daan_transcript}")
+    if WORD_INDEX and not os.path.exists(os.path.join(output_dir, WORD_INDEX_FILE)):
+        return False
     return os.path.exists(os.path.join(output_dir, DAAN_JSON_FILE))
@@ -0,0 +1,321 @@
+import logging
+import os
+import time
+import wave
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Iterator, List
+from config import (
+    STUB_MEMORY_BYTES,
+    STUB_REAL_TIME_FACTOR,
+    W_BATCH_SIZE,
+    W_BEAM_SIZE,
+    W_BEST_OF,
+    W_DEFER_WORD_TIMESTAMPS,
+    W_VAD,
+    W_WORD_TIMESTAMPS,
+)
+from model_download import get_model_location
+from transcode import probe_media
+
+if TYPE_CHECKING:
+    import faster_whisper
+
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 16000
+# faster_whisper attaches these to the next/previous word when aligning
+PREPEND_PUNCTUATIONS = "\"'“¿([{-"
+APPEND_PUNCTUATIONS = "\"'.。,，!！?？:：”)]}、"
+
+
+# the attributes of faster_whisper's Word and Segment that process_segments reads,
+# so other backends don't need faster_whisper
+@dataclass
+class Word:
+    start: float
+    end: float
+    word: str
+    probability: float
+
+
+@dataclass
+class Segment:
+    id: int
+    seek: int
+    start: float
+    end: float
+    text: str
+    tokens: List[int] = field(default_factory=list)
+    temperature: float = 0.0
+    avg_logprob: float = 0.0
+    compression_ratio: float = 1.0
+    no_speech_prob: float = 0.0
+    words: List[Word] = field(default_factory=list)
+
+
+# what whisper.py needs from a speech recognition engine (see W_BACKEND)
+class AsrBackend(ABC):
+    name = ""
+    device = "cpu"
+
+    # segments are transcribed lazily, while they're iterated over
+    @abstractmethod
+    def transcribe(self, audio_file: str) -> Iterator[Segment]:
+        pass
+
+    # the words of each of the (whisper transcript) segments, for transcripts whose
+    # word timestamps were deferred (see W_DEFER_WORD_TIMESTAMPS). The segments need
+    # their start, end, text and tokens
+    @abstractmethod
+    def align(self, audio_file: str, segments: List[dict]) -> List[List[Word]]:
+        pass
+
+    # prepares the backend for the first task, returns how long it took
+    def warm_up(self) -> float:
+        return 0.0
+
+    # describes the loaded model and its resource usage, e.g. for /health/ready
+    def resource_info(self) -> dict:
+        return {"backend": self.name, "device": self.device}
+
+
+class FasterWhisperBackend(AsrBackend):
+    name = "faster-whisper"
+
+    def __init__(self, model_base_dir: str, model_type: str, device: str):
+        # takes a while to import, so only when the model is loaded
+        from faster_whisper import BatchedInferencePipeline, WhisperModel
+
+        # change HuggingFace dir to where model is downloaded
+        os.environ["HF_HOME"] = model_base_dir
+
+        # determine loading locally or have Whisper download from HuggingFace
+        self.model_location = get_model_location(model_base_dir, model_type)
+        if self.model_location == "":
+            raise ValueError("Transcribe failure: Model could not be loaded")
+        self.device = device
+        # float16 only works on GPU, float32 or int8 are recommended for CPU
+        self.compute_type = "float16" if device == "cuda" else "float32"
+        model = WhisperModel(
+            self.model_location,  # either local path or e.g. large-v2 (HuggingFace)
+            device=device,
+            compute_type=self.compute_type,
+        )
+        self.pipeline: "faster_whisper.BatchedInferencePipeline" = (
+            BatchedInferencePipeline(model=model)
+        )
+        self.batch_size = W_BATCH_SIZE if device == "cuda" else 1
+        logger.info(f"Model loaded from location: {self.model_location}")
+
+    def transcribe(self, audio_file: str) -> Iterator[Segment]:
+        segments, _ = self.pipeline.transcribe(
+            audio_file,
+            vad_filter=W_VAD,
+            beam_size=W_BEAM_SIZE,
+            best_of=W_BEST_OF,
+            batch_size=self.batch_size,
+            language="nl",  # TODO: experiment without language parameter specified (for programs with foreign speech)
+            word_timestamps=W_WORD_TIMESTAMPS and not W_DEFER_WORD_TIMESTAMPS,
+        )
+        return segments
+
+    # the cross-attention alignment faster_whisper runs for word_timestamps, on the
+    # decoded tokens: one encoder pass per batch of segments, no decoding
+    def align(self, audio_file: str, segments: List[dict]) -> List[List[Word]]:
+        import numpy as np
+        from faster_whisper.audio import pad_or_trim
+        from faster_whisper.tokenizer import Tokenizer
+        from faster_whisper.transcribe import merge_punctuations
+
+        model = self.pipeline.model
+        tokenizer = Tokenizer(
+            model.hf_tokenizer,
+            model.model.is_multilingual,
+            task="transcribe",
+            language="nl",
+        )
+        aligned: List[List[Word]] = []
+        for i in range(0, len(segments), self.batch_size):
+            batch = segments[i : i + self.batch_size]
+            features = [
+                model.feature_extractor(
+                    read_audio(audio_file, segment["start"], segment["end"])
+                )[..., :-1]
+                for segment in batch
+            ]
+            encoder_output = model.encode(np.stack([pad_or_trim(f) for f in features]))
+            alignments = model.find_alignment(
+                tokenizer,
+                [[t for t in s["tokens"] if t < tokenizer.eot] for s in batch],
+                encoder_output,
+                [f.shape[-1] for f in features],
+            )
+            for segment, alignment in zip(batch, alignments):
+                # the defaults of faster_whisper's transcribe
+                merge_punctuations(alignment, PREPEND_PUNCTUATIONS, APPEND_PUNCTUATIONS)
+                aligned.append(
+                    [
+                        Word(
+                            start=round(segment["start"] + float(word["start"]), 2),
+                            end=round(segment["start"] + float(word["end"]), 2),
+                            word=word["word"],
+                            probability=float(word["probability"]),
+                        )
+                        for word in alignment
+                        if word["word"]  # emptied by merge_punctuations
+                    ]
+                )
+        return aligned
+
+    # the first batch is slow: CUDA allocates its memory pools and selects kernels
+    # for the shapes in use. Transcribing a full batch of synthetic audio with the
+    # configured parameters at load time moves that out of the first task
+    def warm_up(self) -> float:
+        import numpy as np
+
+        start_time = time.time()
+        logger.info(f"Warming up the model with a batch of {self.batch_size} clip(s)")
+        # faint noise rather than silence, which VAD would skip entirely. The clips
+        # are passed explicitly, so every one of them is encoded (padded to 30s)
+        audio = np.random.default_rng(0).normal(0, 0.01, self.batch_size * 16000)
+        segments, _ = self.pipeline.transcribe(
+            audio.astype(np.float32),
+            clip_timestamps=[
+                {"start": i, "end": i + 1} for i in range(self.batch_size)
+            ],
+            vad_filter=False,
+            beam_size=W_BEAM_SIZE,
+            best_of=W_BEST_OF,
+            batch_size=self.batch_size,
+            language="nl",
+            word_timestamps=W_WORD_TIMESTAMPS and not W_DEFER_WORD_TIMESTAMPS,
+            max_new_tokens=8,  # decoding noise could otherwise take long
+        )
+        for _ in segments:  # segments are transcribed lazily
+            pass
+        return time.time() - start_time
+
+    def resource_info(self) -> dict:
+        return {
+            **super().resource_info(),
+            "model": self.model_location,
+            "compute_type": self.compute_type,
+            "batch_size": self.batch_size,
+        }
+
+
+# emits synthetic segments at STUB_REAL_TIME_FACTOR, holding STUB_MEMORY_BYTES like
+# a model would, so the queue, I/O and conversion around the ASR can be tested and
+# load-tested without a GPU or a model. The output only depends on the duration
+class StubBackend(AsrBackend):
+    name = "stub"
+    SEGMENT_S = 5.0
+    WORDS_PER_SEGMENT = 10
+
+    def __init__(
+        self,
+        real_time_factor: float = STUB_REAL_TIME_FACTOR,
+        memory_bytes: int = STUB_MEMORY_BYTES,
+    ):
+        self.real_time_factor = real_time_factor
+        self.memory_bytes = memory_bytes
+        # written to, so the pages are actually resident
+        self.weights = bytearray(b"\x01" * memory_bytes)
+        logger.info(f"Stub backend loaded ({memory_bytes} bytes)")
+
+    def transcribe(self, audio_file: str) -> Iterator[Segment]:
+        duration = get_audio_duration(audio_file)
+        start = 0.0
+        i = 0
+        while start < duration:
+            end = min(start + self.SEGMENT_S, duration)
+            time.sleep((end - start) * self.real_time_factor)
+            yield self._get_segment(i, start, end)
+            start = end
+            i += 1
+
+    def _get_segment(self, i: int, start: float, end: float) -> Segment:
+        word_s = (end - start) / self.WORDS_PER_SEGMENT
+        words = [
+            Word(
+                start=round(start + j * word_s, 2),
+                end=round(start + (j + 1) * word_s, 2),
+                word=f" woord{i}_{j}",
+                probability=0.9,
+            )
+            for j in range(self.WORDS_PER_SEGMENT)
+        ]
+        return Segment(
+            id=i + 1,
+            seek=int(start * 100),
+            start=start,
+            end=end,
+            text="".join(word.word for word in words),
+            tokens=list(range(i, i + self.WORDS_PER_SEGMENT)),
+            words=words,
+        )
+
+    # spreads the words of the text evenly over the segment
+    def align(self, audio_file: str, segments: List[dict]) -> List[List[Word]]:
+        aligned = []
+        for segment in segments:
+            texts = segment["text"].split()
+            word_s = (segment["end"] - segment["start"]) / max(len(texts), 1)
+            aligned.append(
+                [
+                    Word(
+                        start=round(segment["start"] + j * word_s, 2),
+                        end=round(segment["start"] + (j + 1) * word_s, 2),
+                        word=f" {text}",
+                        probability=0.9,
+                    )
+                    for j, text in enumerate(texts)
+                ]
+            )
+        return aligned
+
+    def resource_info(self) -> dict:
+        return {
+            **super().resource_info(),
+            "real_time_factor": self.real_time_factor,
+            "memory_bytes": self.memory_bytes,
+        }
+
+
+# WAV (what the transcode step writes) is read directly, other audio is probed
+def get_audio_duration(audio_file: str) -> float:
+    try:
+        with wave.open(audio_file, "rb") as f:
+            return f.getnframes() / f.getframerate()
+    except (wave.Error, EOFError):
+        return probe_media(audio_file).duration
+
+
+# the 16kHz mono audio between start and end (seconds), as faster_whisper's
+# decode_audio returns it. Only that part of a WAV (what the transcode step
+# writes) is read, other audio is decoded entirely
+def read_audio(audio_file: str, start: float, end: float):
+    import numpy as np
+
+    try:
+        with wave.open(audio_file, "rb") as f:
+            if f.getframerate() == SAMPLE_RATE and f.getnchannels() == 1:
+                f.setpos(min(int(start * SAMPLE_RATE), f.getnframes()))
+                frames = f.readframes(int((end - start) * SAMPLE_RATE))
+                return np.frombuffer(frames, np.int16).astype(np.float32) / 32768.0
+    except (wave.Error, EOFError):
+        pass
+    from faster_whisper.audio import decode_audio
+
+    audio = decode_audio(audio_file, sampling_rate=SAMPLE_RATE)
+    return audio[int(start * SAMPLE_RATE) : int(end * SAMPLE_RATE)]
+
+
+def get_backend(
+    backend: str, model_base_dir: str, model_type: str, device: str
+) -> AsrBackend:
+    if backend == "stub":
+        return StubBackend()
+    return FasterWhisperBackend(model_base_dir, model_type, device)
@@ -1,19 +1,29 @@
+import fcntl
 import logging
+import orjson
 import os
+import shlex
 import subprocess
 import json
+from collections import deque
+from contextlib import contextmanager
+from threading import Event, Thread, Timer
 from urllib.parse import urlparse
 from dataclasses import dataclass, field, asdict
-from typing import List, Tuple
+from typing import IO, Callable, Deque, Iterator, List, Optional, Tuple
 from config import (
+    DATA_BASE_DIR,
     OUTPUT_S3_ENDPOINT_URL,
     OUTPUT_S3_ACCES_KEY_ID,
     OUTPUT_S3_SECRET_ACCES_KEY,
     PROV_FILENAME,
     WHISPER_JSON_FILE,
     DAAN_JSON_FILE,
+    WORD_INDEX,
+    WORD_INDEX_FILE,
 )
 from s3_util import parse_s3_uri, S3Store
+from tracing import span
 
 
 logger = logging.getLogger(__name__)
@@ -51,34 +61,126 @@ def extension_to_mime_type(extension: str) -> str:
     return mime_dict.get(extension, "unknown")
 
 
-# used by asr.py and transcode.py
-def run_shell_command(command: List[str]) -> Tuple[bool, str]:
-    cmd = " ".join(command)
+# reports progress (0-1) of a pipeline stage, e.g. to show it in the API
+ProgressCallback = Callable[[str, float], None]
+
+
+class TaskCancelled(Exception):
+    def __init__(self, reason: str, keep_output: bool = False):
+        super().__init__(reason)
+        # e.g. when draining: the transcoded audio is kept in the asset dir, so the
+        # next run of the task can skip the transcode
+        self.keep_output = keep_output
+
+
+# cancels a run from another thread (e.g. DELETE /tasks/{task_id}): the run stops
+# at the next check, between the stages of asr.run, between ASR segments and on
+# every progress line of ffmpeg (which is then killed)
+class CancelToken:
+    def __init__(self):
+        self.event = Event()
+        self.reason = ""
+        self.keep_output = False
+
+    def cancel(self, reason: str, keep_output: bool = False):
+        self.reason = reason
+        self.keep_output = keep_output
+        self.event.set()
+
+    def is_cancelled(self) -> bool:
+        return self.event.is_set()
+
+    def check(self):
+        if self.event.is_set():
+            raise TaskCancelled(self.reason, self.keep_output)
+
+
+# used by transcode.py. Executes the command without a shell, streaming its
+# output: stdout lines are passed to on_output_line (or returned when that is
+# not given) and only the tail of stderr is kept, so chatty commands cannot fill
+# up memory. The command is killed when it runs longer than timeout_s
+def run_command(
+    command: List[str],
+    timeout_s: float = 0,
+    on_output_line: Optional[Callable[[str], None]] = None,
+    max_stderr_bytes: int = 64 * 1024,
+) -> Tuple[bool, str]:
     logger.info("Executing command:")
-    logger.info(cmd)
+    logger.info(shlex.join(command))
+    with span("run_command", command=command[0]) as command_span:
+        success, output = _run_command(
+            command, timeout_s, on_output_line, max_stderr_bytes
+        )
+        command_span.set("success", success)
+    return success, output
+
 
+def _run_command(
+    command: List[str],
+    timeout_s: float,
+    on_output_line: Optional[Callable[[str], None]],
+    max_stderr_bytes: int,
+) -> Tuple[bool, str]:
     process = subprocess.Popen(
-        cmd,
+        command,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
-        shell=True,  # needed to support file glob
+        text=True,
+        errors="replace",
     )
+    stderr_tail: Deque[str] = deque()
+    stderr_thread = Thread(
+        target=_read_tail, args=(process.stderr, stderr_tail, max_stderr_bytes)
+    )
+    stderr_thread.start()
+    timed_out = Event()
 
-    stdout, stderr = process.communicate()
-    logger.debug(stdout)
-    logger.error(stderr)
+    def kill_on_timeout():
+        timed_out.set()
+        process.kill()
+
+    timer = Timer(timeout_s, kill_on_timeout) if timeout_s > 0 else None
+    if timer:
+        timer.start()
+
+    stdout = []
+    try:
+        for line in process.stdout or []:
+            if on_output_line:
+                on_output_line(line.rstrip("\n"))
+            else:
+                stdout.append(line)
+        process.wait()
+    finally:
+        if timer:
+            timer.cancel()
+        if process.poll() is None:  # e.g. on_output_line raised
+            process.kill()
+            process.wait()
+        stderr_thread.join()
+
+    stderr = "".join(stderr_tail)
     logger.info(f"Process is done: return code {process.returncode}")
     if process.returncode == 0:
-        return True, stdout.decode()
-    return False, stderr.decode()
+        logger.debug(stderr)
+        return True, "".join(stdout)
+    if timed_out.is_set():
+        stderr += f"\nKilled after a timeout of {timeout_s} seconds"
+    logger.error(stderr)
+    return False, stderr
+
 
+def _read_tail(stream: Optional[IO[str]], tail: Deque[str], max_bytes: int):
+    size = 0
+    for line in stream or []:
+        tail.append(line)
+        size += len(line)
+        while size > max_bytes and len(tail) > 1:
+            size -= len(tail.popleft())
 
-def save_provenance(provenance: Provenance, output_dir: str):
-    logger.info(f"Saving provenance to: {output_dir}")
-    # write provenance.json
-    with open(os.path.join(output_dir, PROV_FILENAME), "w+", encoding="utf-8") as f:
-        json.dump(asdict(provenance), f, ensure_ascii=False, indent=4)
-        logger.info("Provenance successfully saved!")
+
+def provenance_to_json(provenance: Provenance) -> bytes:
+    return json.dumps(asdict(provenance), ensure_ascii=False, indent=4).encode("utf-8")
 
 
 def validate_http_uri(http_uri: str) -> bool:
@@ -107,13 +209,30 @@ def remove_all_input_output(path: str) -> bool:
         return False
 
 
-def write_transcript_to_json(transcript, output_dir: str, filename: str):
-    logger.info(f"Saving transcript to {filename}")
+# serialises work on a shared path, also between worker processes on the same host
+# (without blocking it raises BlockingIOError if the lock is taken)
+@contextmanager
+def file_lock(lock_file: str, blocking: bool = True) -> Iterator[None]:
+    os.makedirs(os.path.dirname(lock_file), exist_ok=True)
+    with open(lock_file, "a") as f:
+        logger.info(f"Waiting for lock {lock_file}")
+        fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        logger.info(f"Acquired lock {lock_file}")
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
 
-    with open(os.path.join(output_dir, filename), "w+", encoding="utf-8") as f:
-        logger.info(f"writing transcript of length '{len(transcript)}'")
-        logger.debug(transcript)
-        json.dump(transcript, f, ensure_ascii=False, indent=4)
+# guarantees one pipeline per DATA_BASE_DIR/<asset_id>, since concurrent runs
+# would delete each other's input and output files
+def asset_lock(asset_id: str):
+    return file_lock(os.path.join(DATA_BASE_DIR, ".locks", f"{asset_id}.lock"))
+
+
+# orjson is many times faster than the (pure Python when indenting) json encoder
+def transcript_to_json(transcript) -> bytes:
+    return orjson.dumps(transcript, option=orjson.OPT_INDENT_2)
 
 
 # if S3 output_uri is supplied transfers data to S3 location
@@ -132,9 +251,34 @@ def transfer_asr_output(output_path: str, output_uri: str):
     return s3.transfer_to_s3(
         s3_bucket,
         s3_folder_in_bucket,
-        [
-            os.path.join(output_path, DAAN_JSON_FILE),
-            os.path.join(output_path, WHISPER_JSON_FILE),
-            os.path.join(output_path, PROV_FILENAME),
-        ],
+        [os.path.join(output_path, fn) for fn in get_output_files()],
     )
+
+
+# delivers the output of an earlier run (already in S3) to another output_uri
+def copy_asr_output(source_uri: str, output_uri: str) -> bool:
+    logger.info(f"Copying ASR output from {source_uri} to {output_uri}")
+    if not OUTPUT_S3_ENDPOINT_URL:
+        raise Exception("Transfer to S3 configured without an S3_ENDPOINT_URL!")
+
+    source_bucket, source_folder = parse_s3_uri(source_uri)
+    s3_bucket, s3_folder_in_bucket = parse_s3_uri(output_uri)
+
+    s3 = S3Store(
+        s3_endpoint_url=OUTPUT_S3_ENDPOINT_URL,
+        access_key_id=OUTPUT_S3_ACCES_KEY_ID,
+        secret_access_key=OUTPUT_S3_SECRET_ACCES_KEY,
+    )
+    return s3.copy_within_s3(
+        source_bucket,
+        source_folder,
+        s3_bucket,
+        s3_folder_in_bucket,
+        get_output_files(),
+    )
+
+
+# the files (in the asset dir) that make up the output of a run
+def get_output_files() -> List[str]:
+    word_index_files = [WORD_INDEX_FILE] if WORD_INDEX else []
+    return [DAAN_JSON_FILE, *word_index_files, WHISPER_JSON_FILE, PROV_FILENAME]
@@ -0,0 +1,179 @@
+import json
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List
+from urllib.parse import urlparse
+from uuid import uuid4
+
+from asr import asr_already_done, daan_transcript_already_done, run
+from base_util import get_asset_info
+from config import DATA_BASE_DIR, MODEL_BASE_DIR, W_DEVICE, W_MODEL
+from download import download_uri
+from whisper import load_model
+
+
+logger = logging.getLogger(__name__)
+
+STATE_FILE = "state.jsonl"  # one line per finished manifest entry, used to resume
+SUMMARY_FILE = "summary.json"
+
+
+# every line of the manifest is an input URI, or an ID that is turned into an
+# input URI with input_template (e.g. s3://bucket/{id}.mp4)
+def read_manifest(manifest_file: str, input_template: str = "") -> List[str]:
+    logger.info(f"Reading manifest {manifest_file}")
+    input_uris = []
+    with open(manifest_file, "r", encoding="utf-8") as f:
+        for line in f:
+            entry = line.strip()
+            if not entry or entry.startswith("#"):
+                continue
+            if "://" not in entry:
+                if not input_template:
+                    raise ValueError(f"{entry} is not a URI, please add a template")
+                entry = input_template.format(id=entry)
+            input_uris.append(entry)
+    return input_uris
+
+
+# returns the input URIs that were finished by an earlier (interrupted) run
+def load_finished(run_dir: str) -> Dict[str, dict]:
+    state_file = os.path.join(run_dir, STATE_FILE)
+    finished: Dict[str, dict] = {}
+    if not os.path.exists(state_file):
+        return finished
+    with open(state_file, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                state = json.loads(line)
+                finished[state["input_uri"]] = state
+    # failed inputs are tried again
+    return {uri: s for uri, s in finished.items() if s["status"] == "DONE"}
+
+
+def run_batch(
+    manifest_file: str,
+    run_dir: str,
+    concurrency: int = 2,
+    input_template: str = "",
+    output_template: str = "",
+) -> dict:
+    logger.info(f"Running batch {manifest_file} (run dir: {run_dir})")
+    start_time = time.time()
+    if not os.path.exists(run_dir):
+        os.makedirs(run_dir)
+
+    input_uris = read_manifest(manifest_file, input_template)
+    finished = load_finished(run_dir)
+    todo = [
+        uri
+        for uri in input_uris
+        if uri not in finished and not already_transcribed(uri, output_template)
+    ]
+    logger.info(f"{len(input_uris) - len(todo)} of {len(input_uris)} already done")
+
+    model = load_model(MODEL_BASE_DIR, W_MODEL, W_DEVICE)
+    results = []
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        prefetches: Dict[str, Future] = {}
+        for i, input_uri in enumerate(todo):
+            # keep the next inputs downloading while the model transcribes this one
+            for next_uri in todo[i : i + concurrency + 1]:
+                if next_uri not in prefetches:
+                    prefetches[next_uri] = pool.submit(prefetch_input, next_uri)
+            result = process_input(
+                input_uri, prefetches.pop(input_uri), output_template, model
+            )
+            save_state(run_dir, result)
+            results.append(result)
+
+    summary = get_summary(
+        results, len(input_uris), len(input_uris) - len(todo), start_time
+    )
+    with open(os.path.join(run_dir, SUMMARY_FILE), "w+", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=4)
+    logger.info(f"Batch done: {summary}")
+    return summary
+
+
+# locally stored transcripts can be detected without downloading the input
+def already_transcribed(input_uri: str, output_template: str) -> bool:
+    if output_template:
+        return False
+    asset_id, _ = get_asset_info(urlparse(input_uri).path)
+    data_dir = os.path.join(DATA_BASE_DIR, asset_id)
+    return asr_already_done(data_dir) and daan_transcript_already_done(data_dir)
+
+
+# downloads the input into a staging dir, from which asr.run claims it
+def prefetch_input(input_uri: str) -> str:
+    fn = os.path.basename(urlparse(input_uri).path)
+    _, extension = get_asset_info(fn)
+    staging_dir = os.path.join(DATA_BASE_DIR, ".prefetch", str(uuid4()))
+    try:
+        return download_uri(input_uri, staging_dir, fn, extension).file_path
+    except Exception:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+
+def process_input(
+    input_uri: str, prefetch: Future, output_template: str, model
+) -> dict:
+    start_time = time.time()
+    asset_id, _ = get_asset_info(urlparse(input_uri).path)
+    output_uri = output_template.format(asset_id=asset_id) if output_template else ""
+    staged_file = ""
+    try:
+        staged_file = prefetch.result()
+        response = run(input_uri, output_uri, model, staged_file)
+        return {
+            "input_uri": input_uri,
+            "status": "DONE",
+            "processing_time_s": time.time() - start_time,
+            "audio_duration_s": response["audio_duration_s"],
+            "real_time_factor": response["real_time_factor"],
+        }
+    except Exception as e:
+        logger.exception(f"Failed to process {input_uri}")
+        return {
+            "input_uri": input_uri,
+            "status": "ERROR",
+            "processing_time_s": time.time() - start_time,
+            "error_msg": str(e),
+        }
+    finally:
+        if staged_file:
+            shutil.rmtree(os.path.dirname(staged_file), ignore_errors=True)
+
+
+def save_state(run_dir: str, result: dict):
+    with open(os.path.join(run_dir, STATE_FILE), "a", encoding="utf-8") as f:
+        f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def get_summary(
+    results: List[dict], total: int, skipped: int, start_time: float
+) -> dict:
+    wall_time_s = time.time() - start_time
+    done = [r for r in results if r["status"] == "DONE"]
+    audio_s = sum(max(r["audio_duration_s"], 0) for r in done)
+    # only inputs that were transcribed in this run count for the real-time factor
+    transcribed = [r for r in done if r["real_time_factor"] > 0]
+    asr_s = sum(r["real_time_factor"] * r["audio_duration_s"] for r in transcribed)
+    asr_audio_s = sum(r["audio_duration_s"] for r in transcribed)
+    return {
+        "total": total,
+        "skipped": skipped,
+        "done": len(done),
+        "failed": [r for r in results if r["status"] == "ERROR"],
+        "wall_time_s": wall_time_s,
+        "inputs_per_hour": len(done) / wall_time_s * 3600 if wall_time_s else 0,
+        "audio_hours_per_hour": audio_s / wall_time_s if wall_time_s else 0,
+        "real_time_factor": asr_s / asr_audio_s if asr_audio_s else -1,
+    }
@@ -0,0 +1,424 @@
+# Load test of the API: starts a worker (stub backend by default) on a free port,
+# with the inputs served over HTTP and a moto S3 server receiving the outputs, and
+# replays a mix of submissions, status polls and deletes against it, e.g.:
+#   python benchmarks/load.py                        (see --help for the mix)
+#   python benchmarks/load.py --submitters 50 --pollers 200 --duration 300
+# Reports the p50/p95/p99 latency of every endpoint, the end-to-end latency of the
+# tasks and the tasks per hour, and writes them to benchmarks/load-results.json.
+# Needs the service dependencies (poetry install --with service) for the S3 server
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser, Namespace
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+import httpx
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK_DIR = os.path.join(ROOT_DIR, "benchmarks")
+OUTPUT_BUCKET = "load-test-output"
+# how often the whole task list is requested instead of a single task
+LIST_RATIO = 0.05
+# not recorded in the results: the backend the worker reports is recorded instead
+UNRECORDED_ARGS = ["output", "backend", "model", "device", "stub_real_time_factor"]
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return -1
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+def summarise(values: List[float]) -> dict:
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 4) if values else -1,
+        **{f"p{p}": round(percentile(values, p), 4) for p in [50, 95, 99]},
+        "max": round(max(values), 4) if values else -1,
+    }
+
+
+# latencies (seconds) and status codes of the requests, per endpoint
+class RequestLog:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = {}
+        self.status_codes: Dict[str, Dict[str, int]] = {}
+
+    def request(
+        self, client: httpx.Client, endpoint: str, method: str, url: str, **kwargs
+    ) -> Optional[httpx.Response]:
+        start_time = time.perf_counter()
+        try:
+            response = client.request(method, url, **kwargs)
+            code = str(response.status_code)
+        except httpx.HTTPError as e:
+            response = None
+            code = type(e).__name__
+        latency = time.perf_counter() - start_time
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(latency)
+            codes = self.status_codes.setdefault(endpoint, {})
+            codes[code] = codes.get(code, 0) + 1
+        return response
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                endpoint: {
+                    **summarise(latencies),
+                    "status_codes": self.status_codes[endpoint],
+                }
+                for endpoint, latencies in sorted(self.latencies.items())
+            }
+
+
+# every path returns the same input, so every submission is a new task rather than
+# being attached to an identical one
+def serve_input(input_file: str) -> ThreadingHTTPServer:
+    class Handler(SimpleHTTPRequestHandler):
+        def translate_path(self, path):
+            return input_file
+
+        def log_message(self, format, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        daemon_threads = True
+
+        def handle_error(self, request, client_address):
+            pass  # e.g. ffprobe closing the connection once it read the headers
+
+    server = Server(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_s3_server():
+    import boto3
+    from moto.server import ThreadedMotoServer
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)  # every request
+    port = get_free_port()
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+    server.start()
+    endpoint_url = f"http://127.0.0.1:{port}"
+    boto3.client(
+        "s3",
+        endpoint_url=endpoint_url,
+        region_name="us-east-1",
+        aws_access_key_id="load-test",
+        aws_secret_access_key="load-test",
+    ).create_bucket(Bucket=OUTPUT_BUCKET)
+    return server, endpoint_url
+
+
+def generate_input(path: str, duration_s: int):
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-v",
+            "error",
+            "-f",
+            "lavfi",
+            "-i",
+            f"sine=frequency=440:sample_rate=44100:duration={duration_s}",
+            "-ac",
+            "2",
+            "-b:a",
+            "128k",
+            path,
+        ],
+        check=True,
+    )
+
+
+# returns the worker process, its URL and the backend it reports as loaded, which is
+# what the results are recorded against (e.g. the stub has no model)
+def start_worker(args: Namespace, work_dir: str, s3_endpoint_url: str):
+    port = get_free_port()
+    env = {
+        **os.environ,
+        "DATA_BASE_DIR": os.path.join(work_dir, "data"),
+        "MODEL_BASE_DIR": os.path.join(work_dir, "model"),
+        "W_BACKEND": args.backend,
+        "W_MODEL": args.model,
+        "W_DEVICE": args.device,
+        "STUB_REAL_TIME_FACTOR": str(args.stub_real_time_factor),
+        "MAX_QUEUED_TASKS": str(args.max_queued),
+        "INPUT_CACHE_MAX_BYTES": "0",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "OUTPUT_S3_ENDPOINT_URL": s3_endpoint_url,
+        "OUTPUT_ACCESS_KEY_ID": "load-test",
+        "OUTPUT_SECRET_ACCESS_KEY": "load-test",
+    }
+    for directory in [env["DATA_BASE_DIR"], env["MODEL_BASE_DIR"]]:
+        os.makedirs(directory)
+    log_file = open(os.path.join(work_dir, "worker.log"), "w")
+    process = subprocess.Popen(
+        [sys.executable, "main.py", "--port", str(port), "--log", "WARNING"],
+        cwd=ROOT_DIR,
+        env=env,
+        stdout=log_file,
+        stderr=subprocess.STDOUT,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + args.startup_timeout
+    while time.time() < deadline and process.poll() is None:
+        try:
+            response = httpx.get(f"{base_url}/health/ready")
+            if response.status_code == 200:
+                return process, base_url, response.json()["backend"]
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    process.kill()
+    raise Exception(f"The worker did not get ready, see {log_file.name}")
+
+
+# peak RSS of the worker process, from /proc
+def get_peak_rss_mb(pid: int) -> float:
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return -1
+
+
+class LoadTest:
+    def __init__(self, args: Namespace, base_url: str, input_url: str):
+        self.args = args
+        self.base_url = base_url
+        self.input_url = input_url
+        self.log = RequestLog()
+        self.lock = threading.Lock()
+        self.pending: List[str] = []  # submitted, not finished or deleted
+        self.submitted: List[str] = []
+        self.deleted: List[str] = []
+        self.submitting = threading.Event()
+        self.polling = threading.Event()
+
+    # submits tasks at (on average) --rate tasks per second, in total
+    def submit(self, i: int):
+        rng = random.Random(i)
+        with httpx.Client(base_url=self.base_url, timeout=60) as client:
+            while self.submitting.is_set():
+                output_uri = ""
+                if rng.random() < self.args.s3_ratio:
+                    output_uri = f"s3://{OUTPUT_BUCKET}/{uuid4()}"
+                response = self.log.request(
+                    client,
+                    "POST /tasks",
+                    "POST",
+                    "/tasks",
+                    json={
+                        "input_uri": f"{self.input_url}/{uuid4()}.mp3",
+                        "output_uri": output_uri,
+                    },
+                )
+                if response is not None and response.status_code == 201:
+                    task_id = response.json()["task_id"]
+                    with self.lock:
+                        self.submitted.append(task_id)
+                        self.pending.append(task_id)
+                if rng.random() < self.args.delete_ratio:
+                    self.delete(client, rng)
+                # Poisson arrivals
+                time.sleep(rng.expovariate(self.args.rate / self.args.submitters))
+
+    # deletes one of the pending tasks, queued or running
+    def delete(self, client: httpx.Client, rng: random.Random):
+        with self.lock:
+            if not self.pending:
+                return
+            task_id = self.pending.pop(rng.randrange(len(self.pending)))
+            self.deleted.append(task_id)
+        self.log.request(client, "DELETE /tasks/{id}", "DELETE", f"/tasks/{task_id}")
+
+    # polls the status of pending tasks like clients waiting for them would
+    def poll(self, i: int):
+        rng = random.Random(-i - 1)
+        with httpx.Client(base_url=self.base_url, timeout=60) as client:
+            while self.polling.is_set():
+                time.sleep(rng.uniform(0.5, 1.5) * self.args.poll_interval)
+                if rng.random() < LIST_RATIO:
+                    self.log.request(client, "GET /tasks", "GET", "/tasks")
+                    continue
+                with self.lock:
+                    if not self.pending:
+                        continue
+                    task_id = rng.choice(self.pending)
+                response = self.log.request(
+                    client, "GET /tasks/{id}", "GET", f"/tasks/{task_id}"
+                )
+                if response is None or response.status_code in [201, 202, 404]:
+                    continue  # still queued/processing, or just deleted
+                with self.lock:
+                    if task_id in self.pending:
+                        self.pending.remove(task_id)
+
+    def run(self) -> float:
+        self.submitting.set()
+        self.polling.set()
+        threads = [
+            threading.Thread(target=target, args=(i,), daemon=True)
+            for target, count in [
+                (self.submit, self.args.submitters),
+                (self.poll, self.args.pollers),
+            ]
+            for i in range(count)
+        ]
+        start_time = time.time()
+        for thread in threads:
+            thread.start()
+        time.sleep(self.args.duration)
+        self.submitting.clear()
+        print("Waiting for the submitted tasks to finish", file=sys.stderr)
+        deadline = time.time() + self.args.drain_timeout
+        while time.time() < deadline:
+            with self.lock:
+                if not self.pending:
+                    break
+            time.sleep(1)
+        self.polling.clear()
+        for thread in threads:
+            thread.join()
+        return time.time() - start_time
+
+
+# end-to-end latencies and throughput, from the submitted and finished times the
+# worker recorded for the tasks that weren't deleted
+def get_task_stats(load_test: LoadTest, all_tasks: dict) -> dict:
+    tasks = [
+        all_tasks[task_id]
+        for task_id in load_test.submitted
+        if task_id in all_tasks and task_id not in load_test.deleted
+    ]
+    done = [t for t in tasks if t["status"] == "DONE" and t["finished_unix"]]
+    stats = {
+        "submitted": len(load_test.submitted),
+        "deleted": len(load_test.deleted),
+        "done": len(done),
+        "error": len([t for t in tasks if t["status"] == "ERROR"]),
+        "unfinished": len(
+            [t for t in tasks if t["status"] in ["CREATED", "PROCESSING"]]
+        ),
+        "latency_s": summarise(
+            [t["finished_unix"] - t["submitted_unix"] for t in done]
+        ),
+        "tasks_per_hour": -1.0,
+    }
+    if len(done) > 1:
+        first = min(t["submitted_unix"] for t in done)
+        last = max(t["finished_unix"] for t in done)
+        stats["tasks_per_hour"] = round(len(done) / (last - first) * 3600, 1)
+    return stats
+
+
+def print_report(results: dict):
+    print(f"{'endpoint':<18} {'count':>7} {'p50_ms':>9} {'p95_ms':>9} {'p99_ms':>9}")
+    for endpoint, stats in results["endpoints"].items():
+        print(
+            f"{endpoint:<18} {stats['count']:>7} {stats['p50'] * 1000:>9.1f} "
+            f"{stats['p95'] * 1000:>9.1f} {stats['p99'] * 1000:>9.1f}  "
+            f"{stats['status_codes']}"
+        )
+    tasks = results["tasks"]
+    latency = tasks["latency_s"]
+    print(
+        f"tasks: {tasks['submitted']} submitted, {tasks['done']} done, "
+        f"{tasks['error']} failed, {tasks['deleted']} deleted, "
+        f"{tasks['unfinished']} unfinished"
+    )
+    print(
+        f"task latency (s): p50 {latency['p50']}, p95 {latency['p95']}, "
+        f"p99 {latency['p99']}; {tasks['tasks_per_hour']} tasks/hour"
+    )
+
+
+def main():
+    parser = ArgumentParser(description="Load test of the worker API")
+    parser.add_argument("--backend", default="stub", help="stub or faster-whisper")
+    parser.add_argument("--model", default="tiny", help="(faster-whisper) W_MODEL")
+    parser.add_argument("--device", default="cpu", help="(faster-whisper) W_DEVICE")
+    parser.add_argument("--stub-real-time-factor", type=float, default=0.01)
+    parser.add_argument("--input-duration", type=int, default=60, dest="input_s")
+    parser.add_argument("--submitters", type=int, default=10)
+    parser.add_argument("--pollers", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=1, help="submissions/second")
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--delete-ratio", type=float, default=0.05)
+    parser.add_argument("--s3-ratio", type=float, default=0.5, help="S3 outputs")
+    parser.add_argument("--max-queued", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--drain-timeout", type=float, default=300)
+    parser.add_argument("--startup-timeout", type=float, default=120)
+    parser.add_argument(
+        "--output", default=os.path.join(BENCHMARK_DIR, "load-results.json")
+    )
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="whisper-load-test-")
+    input_file = os.path.join(work_dir, "input.mp3")
+    generate_input(input_file, args.input_s)
+    input_server = serve_input(input_file)
+    s3_server, s3_endpoint_url = start_s3_server()
+    worker, base_url, backend_info = start_worker(args, work_dir, s3_endpoint_url)
+    try:
+        load_test = LoadTest(
+            args, base_url, f"http://127.0.0.1:{input_server.server_port}"
+        )
+        print(f"Running the load test for {args.duration}s", file=sys.stderr)
+        wall_s = load_test.run()
+        all_tasks = httpx.get(f"{base_url}/tasks", timeout=60).json()["data"]
+        results = {
+            "meta": {
+                **{k: v for k, v in vars(args).items() if k not in UNRECORDED_ARGS},
+                **backend_info,
+                "wall_s": round(wall_s, 1),
+                "worker_peak_rss_mb": round(get_peak_rss_mb(worker.pid)),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "cpu_count": os.cpu_count(),
+                "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            },
+            "endpoints": load_test.log.get_stats(),
+            "tasks": get_task_stats(load_test, all_tasks),
+        }
+    finally:
+        worker.terminate()
+        worker.wait()
+        s3_server.stop()
+        input_server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print_report(results)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
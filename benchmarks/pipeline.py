@@ -0,0 +1,416 @@
+# End-to-end benchmark of asr.run: the wall time, CPU time, peak RSS and real-time
+# factor of every stage, for local (uploaded), HTTP and (moto) S3 inputs, e.g.:
+#   python benchmarks/pipeline.py                    (stub backend, see W_BACKEND)
+#   python benchmarks/pipeline.py --backend faster-whisper --model tiny
+#   python benchmarks/pipeline.py --save-baseline    (after a known-good change)
+# Exits with 1 if a stage got slower (or bigger) than the baseline by more than
+# --threshold. The baseline is per machine: it isn't committed and CI doesn't run
+# this, so save it on the main branch and compare a change on the same machine
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from functools import wraps
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Tuple
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK_DIR = os.path.join(ROOT_DIR, "benchmarks")
+SHORT_INPUT = os.path.join(ROOT_DIR, "data", "whisper-test", "whisper-test.mp3")
+
+STAGES = ["download", "transcode", "asr", "daan", "serialization", "upload"]
+SCENARIOS = ["local-short", "http-long", "s3-long"]
+METRICS = ["wall_s", "cpu_s", "peak_rss_mb"]
+# the results only compare with a baseline of the same machine
+HARDWARE_KEYS = ["host", "machine", "cpu_count"]
+# differences below these are noise, whatever the threshold
+MIN_DIFFERENCE = {"wall_s": 0.05, "cpu_s": 0.05, "peak_rss_mb": 20}
+
+
+# attributes the time spent in the wrapped functions to stages. Nested stages are
+# subtracted from the stage around them (e.g. serialising the transcript from
+# asr), and stages are tracked per thread, as outputs are uploaded in the
+# background. CPU time includes child processes, i.e. ffmpeg
+class StageRecorder:
+    def __init__(self):
+        self.stats = {
+            s: {"wall_s": 0.0, "cpu_s": 0.0, "peak_rss_mb": 0.0} for s in STAGES
+        }
+        self.peak_rss_mb = 0.0  # of the whole run, also between the stages
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.active: Dict[int, str] = {}  # frame ID -> stage
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self._sample_rss, daemon=True)
+
+    def wrap(self, stage: str, func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            stack = self.local.__dict__.setdefault("stack", [])
+            frame = {"child_wall_s": 0.0, "child_cpu_s": 0.0}
+            stack.append(frame)
+            self.update_peak_rss(stage)  # stages may be shorter than a sample
+            with self.lock:
+                self.active[id(frame)] = stage
+            start_wall, start_cpu = time.perf_counter(), get_cpu_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                wall_s = time.perf_counter() - start_wall
+                cpu_s = get_cpu_time() - start_cpu
+                stack.pop()
+                self.update_peak_rss(stage)
+                with self.lock:
+                    del self.active[id(frame)]
+                    self.stats[stage]["wall_s"] += wall_s - frame["child_wall_s"]
+                    self.stats[stage]["cpu_s"] += cpu_s - frame["child_cpu_s"]
+                if stack:
+                    stack[-1]["child_wall_s"] += wall_s
+                    stack[-1]["child_cpu_s"] += cpu_s
+
+        return wrapper
+
+    def _sample_rss(self):
+        while not self.stopped.wait(0.01):
+            with self.lock:
+                stages = set(self.active.values())
+            for stage in stages:
+                self.update_peak_rss(stage)
+            self.update_peak_rss()
+
+    def update_peak_rss(self, stage: str = ""):
+        rss_mb = get_rss_mb()
+        with self.lock:
+            self.peak_rss_mb = max(self.peak_rss_mb, rss_mb)
+            if stage:
+                stats = self.stats[stage]
+                stats["peak_rss_mb"] = max(stats["peak_rss_mb"], rss_mb)
+
+
+def get_cpu_time() -> float:
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # thread time, as other threads (e.g. uploads) are measured on their own
+    return time.thread_time() + children.ru_utime + children.ru_stime
+
+
+def get_rss_mb() -> float:
+    with open("/proc/self/statm", "r") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024**2
+
+
+# wraps the functions of every stage, returns what to restore afterwards
+def instrument(recorder: StageRecorder) -> List[Tuple[object, str, Callable]]:
+    import asr
+    import daan_transcript
+    import output_sink
+    import whisper
+
+    originals = []
+    for module, name, stage in [
+        (asr, "download_uri", "download"),
+        (asr, "claim_staged_input", "download"),
+        (asr, "try_stream_transcode", "transcode"),
+        (asr, "try_transcode", "transcode"),
+        (asr, "run_asr", "asr"),
+        (asr, "_get_daan_transcript", "daan"),
+        (asr, "provenance_to_json", "serialization"),
+        (whisper, "encode_whisper_transcript", "serialization"),
+        (daan_transcript, "transcript_to_json", "serialization"),
+        (output_sink.LocalSink, "put", "upload"),
+        (output_sink.S3Store, "upload_bytes", "upload"),
+    ]:
+        original = getattr(module, name)
+        originals.append((module, name, original))
+        setattr(module, name, recorder.wrap(stage, original))
+    return originals
+
+
+def generate_long_input(path: str, duration_s: int):
+    if os.path.exists(path):
+        return
+    print(f"Generating {duration_s}s of synthetic audio", file=sys.stderr)
+    # a tone in noise, as 44.1kHz stereo MP3, so it needs transcoding like most inputs
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-v",
+            "error",
+            "-f",
+            "lavfi",
+            "-i",
+            f"sine=frequency=440:sample_rate=44100:duration={duration_s}",
+            "-f",
+            "lavfi",
+            "-i",
+            f"anoisesrc=color=pink:amplitude=0.1:sample_rate=44100:duration={duration_s}",
+            "-filter_complex",
+            "amix=inputs=2",
+            "-ac",
+            "2",
+            "-b:a",
+            "128k",
+            path,
+        ],
+        check=True,
+    )
+
+
+def serve_http(directory: str) -> ThreadingHTTPServer:
+    class Handler(SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=directory, **kwargs)
+
+        def log_message(self, format, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        def handle_error(self, request, client_address):
+            pass  # e.g. ffprobe closing the connection once it read the headers
+
+    server = Server(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# uploads the input to a moto S3 bucket, yields the input and output URI
+@contextmanager
+def mocked_s3(input_file: str) -> Iterator[Tuple[str, str]]:
+    import boto3
+    from moto import mock_aws
+
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        for bucket in ["input", "output"]:
+            client.create_bucket(Bucket=bucket)
+        key = os.path.basename(input_file)
+        client.upload_file(input_file, "input", key)
+        yield f"s3://input/{key}", f"s3://output/{os.path.splitext(key)[0]}"
+
+
+# runs asr.run on the input of the scenario, returns the stats of every stage
+def run_scenario(scenario: str, input_dir: str, model, long_input: str) -> dict:
+    import asr
+
+    # start without the outputs (and extracted audio) of an earlier run
+    data_dir = os.environ["DATA_BASE_DIR"]
+    shutil.rmtree(data_dir, ignore_errors=True)
+    os.makedirs(data_dir)
+
+    recorder = StageRecorder()
+    recorder.sampler.start()
+    originals = instrument(recorder)
+    stream_video_input = asr.STREAM_VIDEO_INPUT
+    try:
+        start_wall, start_cpu = time.perf_counter(), get_cpu_time()
+        if scenario == "local-short":
+            staged_file = os.path.join(input_dir, "staged.mp3")
+            shutil.copyfile(SHORT_INPUT, staged_file)
+            outputs = asr.run("upload://bench/short.mp3", "", model, staged_file)
+        elif scenario == "http-long":
+            server = serve_http(input_dir)
+            url = (
+                f"http://127.0.0.1:{server.server_port}/{os.path.basename(long_input)}"
+            )
+            try:
+                outputs = asr.run(url, "", model)
+            finally:
+                server.shutdown()
+        else:
+            # ffmpeg can't reach the in-process S3 mock, so this scenario covers
+            # the download (and upload) path rather than the streaming one
+            asr.STREAM_VIDEO_INPUT = False
+            with mocked_s3(long_input) as (input_uri, output_uri):
+                outputs = asr.run(input_uri, output_uri, model)
+        recorder.update_peak_rss()  # (shorter runs than a sample)
+        total = {
+            "wall_s": time.perf_counter() - start_wall,
+            "cpu_s": get_cpu_time() - start_cpu,
+            "peak_rss_mb": recorder.peak_rss_mb,
+        }
+    finally:
+        recorder.stopped.set()
+        recorder.sampler.join()
+        for module, name, original in originals:
+            setattr(module, name, original)
+        asr.STREAM_VIDEO_INPUT = stream_video_input
+
+    duration = outputs["audio_duration_s"]
+    stages = {}
+    for stage, stats in recorder.stats.items():
+        stages[stage] = {k: round(v, 4) for k, v in stats.items()}
+        stages[stage]["real_time_factor"] = round(stats["wall_s"] / duration, 6)
+    total["real_time_factor"] = total["wall_s"] / duration
+    return {
+        "audio_duration_s": duration,
+        "total": {k: round(v, 4) for k, v in total.items()},
+        "stages": stages,
+    }
+
+
+# the fastest of the runs is the least disturbed by other processes
+def best_of(runs: List[dict]) -> dict:
+    best = runs[0]
+    for stage in STAGES:
+        for metric in METRICS + ["real_time_factor"]:
+            best["stages"][stage][metric] = min(
+                run["stages"][stage][metric] for run in runs
+            )
+    return best
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> List[str]:
+    regressions = []
+    for scenario, result in results["scenarios"].items():
+        baseline_scenario = baseline["scenarios"].get(scenario)
+        if not baseline_scenario:
+            continue
+        for stage in STAGES:
+            for metric in METRICS:
+                value = result["stages"][stage][metric]
+                baseline_value = baseline_scenario["stages"][stage][metric]
+                if (
+                    value > baseline_value * (1 + threshold)
+                    and value - baseline_value > MIN_DIFFERENCE[metric]
+                ):
+                    regressions.append(
+                        f"{scenario} {stage} {metric}: {value} (baseline "
+                        f"{baseline_value}, +{(value / baseline_value - 1) * 100:.0f}%)"
+                        if baseline_value
+                        else f"{scenario} {stage} {metric}: {value} (baseline 0)"
+                    )
+    return regressions
+
+
+def print_table(results: dict):
+    print(
+        f"{'scenario':<12} {'stage':<14} {'wall_s':>9} {'cpu_s':>9} {'rss_mb':>8} {'rtf':>9}"
+    )
+    for scenario, result in results["scenarios"].items():
+        for stage, stats in [*result["stages"].items(), ("total", result["total"])]:
+            print(
+                f"{scenario:<12} {stage:<14} {stats['wall_s']:>9.3f} "
+                f"{stats['cpu_s']:>9.3f} {stats['peak_rss_mb']:>8.0f} "
+                f"{stats['real_time_factor']:>9.5f}"
+            )
+
+
+# exits with 1 if the results regressed compared to the baseline
+def compare_with_baseline(results: dict, baseline_file: str, threshold: float):
+    if not os.path.exists(baseline_file):
+        print(f"No baseline at {baseline_file} to compare with (see --save-baseline)")
+        return
+    with open(baseline_file, "r") as f:
+        baseline = json.load(f)
+    different = [
+        key
+        for key in HARDWARE_KEYS
+        if baseline["meta"].get(key) != results["meta"][key]
+    ]
+    if different:
+        print(
+            f"Not compared: the baseline was made on another machine ({different}), "
+            "save one on this machine with --save-baseline"
+        )
+        return
+    if baseline["meta"]["backend"] != results["meta"]["backend"]:
+        print(f"The baseline was made with the {baseline['meta']['backend']} backend")
+    regressions = compare(results, baseline, threshold)
+    if regressions:
+        print(f"Slower than the baseline (threshold {threshold * 100:.0f}%):")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print("No regressions compared to the baseline")
+
+
+def main():
+    parser = ArgumentParser(description="Benchmarks asr.run per stage")
+    parser.add_argument("--backend", default="stub", help="stub or faster-whisper")
+    parser.add_argument("--model", default="tiny", help="(faster-whisper) W_MODEL")
+    parser.add_argument("--device", default="cpu", help="(faster-whisper) W_DEVICE")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--long-duration", type=int, default=1800, dest="long_s")
+    parser.add_argument("--runs", type=int, default=1)
+    parser.add_argument("--output", default=os.path.join(BENCHMARK_DIR, "results.json"))
+    parser.add_argument(
+        "--baseline", default=os.path.join(BENCHMARK_DIR, "baseline.json")
+    )
+    parser.add_argument("--save-baseline", action="store_true", dest="save_baseline")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="whisper-benchmark-")
+    input_dir = os.path.join(work_dir, "inputs")
+    os.makedirs(input_dir)
+    # config is read on import, so the environment is set up first
+    os.environ["DATA_BASE_DIR"] = os.path.join(work_dir, "data")
+    os.environ.setdefault("MODEL_BASE_DIR", os.path.join(work_dir, "model"))
+    os.makedirs(os.environ["MODEL_BASE_DIR"], exist_ok=True)
+    os.environ["INPUT_CACHE_MAX_BYTES"] = "0"  # every run downloads its input
+    os.environ["W_BACKEND"] = args.backend
+    os.environ["W_MODEL"] = args.model
+    os.environ["W_DEVICE"] = args.device
+    os.environ.setdefault("STUB_REAL_TIME_FACTOR", "0")
+    # served by moto (see mocked_s3)
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    for prefix in ["INPUT", "OUTPUT"]:
+        os.environ[f"{prefix}_S3_ENDPOINT_URL"] = "https://s3.amazonaws.com"
+        os.environ[f"{prefix}_ACCESS_KEY_ID"] = "benchmark"
+        os.environ[f"{prefix}_SECRET_ACCESS_KEY"] = "benchmark"
+    sys.path.insert(0, ROOT_DIR)
+
+    from whisper import load_model
+
+    long_input = os.path.join(input_dir, f"long-{args.long_s}s.mp3")
+    scenarios = [s for s in args.scenarios.split(",") if s]
+    if any(s != "local-short" for s in scenarios):
+        generate_long_input(long_input, args.long_s)
+    model = load_model(os.environ["MODEL_BASE_DIR"], args.model, args.device)
+
+    results: dict = {
+        "meta": {
+            "backend": args.backend,
+            "model": args.model if args.backend != "stub" else "",
+            "device": args.device,
+            "long_duration_s": args.long_s,
+            "python": platform.python_version(),
+            "host": platform.node(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "scenarios": {},
+    }
+    try:
+        for scenario in scenarios:
+            print(f"Running {scenario}", file=sys.stderr)
+            runs = [
+                run_scenario(scenario, input_dir, model, long_input)
+                for _ in range(args.runs)
+            ]
+            results["scenarios"][scenario] = best_of(runs)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print_table(results)
+    print(f"Results written to {args.output}")
+
+    if args.save_baseline:
+        shutil.copyfile(args.output, args.baseline)
+        print(f"Saved as the baseline ({args.baseline})")
+        return
+    compare_with_baseline(results, args.baseline, args.threshold)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# Measures where the startup time of the worker goes, each phase in a fresh
+# interpreter (so nothing is cached in sys.modules), e.g.:
+#   python benchmarks/startup.py            (uses the model configured in .env)
+#   python benchmarks/startup.py --no-model (only the imports and config)
+import json
+import os
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# runs inside the fresh interpreter, prints the timing of each phase as JSON
+PHASES = """
+import json, time
+timings = {}
+start = time.perf_counter()
+import api  # noqa
+timings["import_api_s"] = time.perf_counter() - start
+
+start = time.perf_counter()
+from config import MODEL_BASE_DIR, W_DEVICE, W_MODEL, validate_config
+validate_config()
+timings["validate_config_s"] = time.perf_counter() - start
+
+if LOAD_MODEL:
+    from whisper import configure_caches, warm_up_model
+    configure_caches(MODEL_BASE_DIR)
+    start = time.perf_counter()
+    import faster_whisper
+    timings["import_faster_whisper_s"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    from model_download import get_model_location
+    os.environ["HF_HOME"] = MODEL_BASE_DIR
+    model_location = get_model_location(MODEL_BASE_DIR, W_MODEL)
+    timings["model_fetch_s"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    from asr_backend import FasterWhisperBackend
+    model = FasterWhisperBackend(MODEL_BASE_DIR, W_MODEL, W_DEVICE)
+    timings["model_load_s"] = time.perf_counter() - start
+
+    timings["warm_up_s"] = warm_up_model(model)
+
+print(json.dumps(timings))
+"""
+
+
+def run_phases(load_model: bool) -> dict:
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"import os\nLOAD_MODEL = {load_model}\n{PHASES}",
+        ],
+        cwd=ROOT_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Breaks down the startup time")
+    parser.add_argument("--no-model", action="store_true", dest="no_model")
+    parser.add_argument("--runs", action="store", dest="runs", default="3")
+    args = parser.parse_args()
+
+    runs = [run_phases(not args.no_model) for _ in range(int(args.runs))]
+    # the fastest run is the least disturbed by other processes
+    summary = {phase: min(run[phase] for run in runs) for phase in runs[0]}
+    summary["total_s"] = sum(summary.values())
+    print(json.dumps({k: round(v, 3) for k, v in summary.items()}, indent=4))
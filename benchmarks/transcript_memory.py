@@ -0,0 +1,175 @@
+# Compares the memory and CPU time of the in-memory transcript (transcript.py)
+# with the dicts the pipeline used to keep (a dict per segment and per word), on
+# a synthetic transcript of --hours of speech, e.g.:
+#   python benchmarks/transcript_memory.py --hours 10
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from typing import Callable, Iterator, Tuple
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEGMENT_S = 5.0
+WORDS_PER_SEGMENT = 14  # ~170 words a minute
+TOKENS_PER_WORD = 2
+
+
+# like faster_whisper yields them, lazily
+def generate_segments(hours: float) -> Iterator:
+    from asr_backend import Segment, Word
+
+    rng = random.Random(0)
+    for i in range(int(hours * 3600 / SEGMENT_S)):
+        start = i * SEGMENT_S
+        word_s = SEGMENT_S / WORDS_PER_SEGMENT
+        words = [
+            Word(
+                round(start + j * word_s, 2),
+                round(start + (j + 1) * word_s, 2),
+                " " + "".join(rng.choices("aeiounrst", k=rng.randint(2, 9))),
+                rng.random(),
+            )
+            for j in range(WORDS_PER_SEGMENT)
+        ]
+        yield Segment(
+            id=i,
+            seek=int(start * 100),
+            start=start,
+            end=start + SEGMENT_S,
+            text="".join(w.word for w in words),
+            tokens=[rng.randrange(50000) for _ in range(len(words) * TOKENS_PER_WORD)],
+            temperature=0.0,
+            avg_logprob=-rng.random(),
+            compression_ratio=1.5,
+            no_speech_prob=rng.random() / 10,
+            words=words,
+        )
+
+
+# the segments as process_segments built them before transcript.py
+def build_dicts(segments: Iterator, asset_id: str) -> dict:
+    return {
+        "carrierId": asset_id,
+        "segments": [
+            {
+                "id": segment.id,
+                "seek": segment.seek,
+                "start": segment.start,
+                "end": segment.end,
+                "text": segment.text.strip(),
+                "tokens": segment.tokens,
+                "temperature": segment.temperature,
+                "avg_logprob": segment.avg_logprob,
+                "compression_ratio": segment.compression_ratio,
+                "no_speech_prob": segment.no_speech_prob,
+                "words": [
+                    {
+                        "text": word.word.strip(),
+                        "start": word.start,
+                        "end": word.end,
+                        "confidence": word.probability,
+                    }
+                    for word in segment.words
+                ],
+            }
+            for segment in segments
+        ],
+    }
+
+
+# the DAAN transcript as whisper_json_to_daan_format made it from the dicts
+def daan_from_dicts(transcript: dict) -> list:
+    return [
+        {
+            "wordTimes": [int(word["start"] * 1000) for word in segment["words"]],
+            "sequenceNr": 0,
+            "start": segment["start"],
+            "fragmentId": "00000",
+            "words": segment["text"],
+            "carrierId": transcript["carrierId"],
+        }
+        for segment in transcript["segments"]
+    ]
+
+
+def time_it(func: Callable, runs: int) -> float:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)  # the least disturbed by other processes
+
+
+# the bytes still allocated by what func returns, and the peak while it ran
+def measure_memory(func: Callable) -> Tuple[int, int]:
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    result = func()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return retained - before, peak - before
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmarks the in-memory transcript")
+    parser.add_argument("--hours", action="store", dest="hours", default="10")
+    parser.add_argument("--runs", action="store", dest="runs", default="3")
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT_DIR)
+    from daan_transcript import whisper_json_to_daan_format
+    from transcript_format import encode_whisper_transcript
+    from whisper import process_segments
+
+    hours, runs = float(args.hours), int(args.runs)
+    transcript = process_segments(generate_segments(hours), "asset")
+    dicts = transcript.to_dict()
+    mb = 1024**2
+
+    # timed on segments generated beforehand, as generating them is slower than
+    # what's timed. Their memory is measured while they're generated (lazily),
+    # the tokens lists the dicts keep are part of it
+    segments = list(generate_segments(hours))
+    results: dict = {"hours": hours, "words": transcript.word_count}
+    for name, build, daan, encode in [
+        (
+            "dicts",
+            lambda segments: build_dicts(segments, "asset"),
+            lambda: daan_from_dicts(dicts),
+            lambda: encode_whisper_transcript(dicts),
+        ),
+        (
+            "arrays",
+            lambda segments: process_segments(segments, "asset"),
+            lambda: whisper_json_to_daan_format(transcript),
+            lambda: encode_whisper_transcript(transcript),
+        ),
+    ]:
+        retained, peak = measure_memory(lambda: build(generate_segments(hours)))
+        results[name] = {
+            "build_s": time_it(lambda: build(segments), runs),
+            "retained_mb": retained / mb,
+            "build_peak_mb": peak / mb,
+            "daan_s": time_it(daan, runs),
+            "daan_peak_mb": measure_memory(daan)[1] / mb,
+            "encode_s": time_it(encode, runs),
+            "encode_peak_mb": measure_memory(encode)[1] / mb,
+        }
+    # a transcript read from file (daan_bulk.py, alignment.py) is converted first
+    results["arrays"]["daan_from_file_s"] = time_it(
+        lambda: whisper_json_to_daan_format(dicts), runs
+    )
+    print(
+        json.dumps(
+            {
+                k: {m: round(v, 3) for m, v in r.items()} if isinstance(r, dict) else r
+                for k, r in results.items()
+            },
+            indent=4,
+        )
+    )
@@ -1,12 +1,12 @@
 import os
-import validators
+from importlib.util import find_spec
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-def assert_bool(param: str) -> bool:
-    value = os.environ.get(param, "y")
+def assert_bool(param: str, default: str = "y") -> bool:
+    value = os.environ.get(param, default)
     assert value in ["y", "n"], f"Please use y or n for {param}, not |{value}|"
     return value == "y"
 
@@ -19,6 +19,14 @@ def as_int(param: str, default: int) -> int:
         assert False, f"Please enter a valid number for {param}, not |{value}|"
 
 
+def as_float(param: str, default: float) -> float:
+    value = os.environ.get(param, default)
+    try:
+        return float(value)
+    except ValueError:
+        assert False, f"Please enter a valid number for {param}, not |{value}|"
+
+
 # mounting dirs
 DATA_BASE_DIR = os.environ.get("DATA_BASE_DIR", "")
 MODEL_BASE_DIR = os.environ.get("MODEL_BASE_DIR", "")
@@ -39,48 +47,212 @@ MODEL_S3_SECRET_ACCES_KEY = os.environ.get("MODEL_SECRET_ACCESS_KEY", "")
 
 # Whisper params
 W_WORD_TIMESTAMPS = assert_bool("W_WORD_TIMESTAMPS")
+# transcribe without word timestamps, the words are aligned later for the assets
+# (and time ranges) that need them: see alignment.py
+W_DEFER_WORD_TIMESTAMPS = assert_bool("W_DEFER_WORD_TIMESTAMPS", "n")
 W_VAD = assert_bool("W_VAD")
 W_DEVICE = os.environ.get("W_DEVICE", "cuda")
 W_MODEL = os.environ.get("W_MODEL", "large-v2")
 W_BEAM_SIZE = as_int("W_BEAM_SIZE", 5)
 W_BEST_OF = as_int("W_BEST_OF", 5)
 W_BATCH_SIZE = as_int("W_BATCH_SIZE", 50)
+# transcribe a batch of synthetic audio after loading the model, so the first task
+# doesn't pay for CUDA's memory allocation and kernel selection
+W_WARM_UP = assert_bool("W_WARM_UP")
+# faster-whisper, or stub: emits synthetic segments at STUB_REAL_TIME_FACTOR while
+# holding STUB_MEMORY_BYTES, to test (or load-test) everything around the ASR on
+# machines without a GPU or model
+W_BACKEND = os.environ.get("W_BACKEND", "faster-whisper")
+STUB_REAL_TIME_FACTOR = as_float("STUB_REAL_TIME_FACTOR", 0.05)
+STUB_MEMORY_BYTES = as_int("STUB_MEMORY_BYTES", 0)
+
+# Input params
+# let ffmpeg stream inputs that need transcoding (HTTP/presigned S3 URL) instead of
+# downloading them
+STREAM_VIDEO_INPUT = assert_bool("STREAM_VIDEO_INPUT")
+
+# inputs are kept in DATA_BASE_DIR/.cache/inputs (least recently used ones are
+# evicted beyond this size), so retries don't download unchanged inputs again.
+# 0 disables the cache
+INPUT_CACHE_MAX_BYTES = as_int("INPUT_CACHE_MAX_BYTES", 20 * 1024**3)
+
+# Transcode params
+# ffmpeg runs longer than this (e.g. hanging on a broken stream) are killed
+FFMPEG_TIMEOUT_S = as_int("FFMPEG_TIMEOUT_S", 4 * 3600)
+
+# Output params
+# attempts (with exponential backoff) after the first failed upload of an output file
+OUTPUT_UPLOAD_RETRIES = as_int("OUTPUT_UPLOAD_RETRIES", 4)
+
+# API params
+# (finished) tasks with the same input and parameters are coalesced within this window
+TASK_DEDUP_WINDOW_S = as_int("TASK_DEDUP_WINDOW_S", 600)
+# order of the queued tasks (within a priority class): fifo, sjf (shortest estimated
+# job first) or aging (sjf, but every second a task waits counts as
+# SCHEDULING_AGING_FACTOR seconds less work, so long tasks don't starve)
+SCHEDULING_POLICY = os.environ.get("SCHEDULING_POLICY", "aging")
+SCHEDULING_AGING_FACTOR = as_float("SCHEDULING_AGING_FACTOR", 1.0)
+MAX_QUEUED_TASKS = as_int("MAX_QUEUED_TASKS", 100)
+# a task only starts if its estimated disk and memory usage leave this much free
+DISK_RESERVE_BYTES = as_int("DISK_RESERVE_BYTES", 1024**3)
+MEMORY_RESERVE_BYTES = as_int("MEMORY_RESERVE_BYTES", 1024**3)
+# on SIGTERM the running task gets this long to finish before it's cancelled (and
+# queued again on restart), so set e.g. terminationGracePeriodSeconds above it
+DRAIN_TIMEOUT_S = as_int("DRAIN_TIMEOUT_S", 300)
+
+# Webhook params (the callback_url of a task)
+# failed deliveries are retried after WEBHOOK_BACKOFF_S, doubling every attempt
+WEBHOOK_MAX_ATTEMPTS = as_int("WEBHOOK_MAX_ATTEMPTS", 10)
+WEBHOOK_BACKOFF_S = as_float("WEBHOOK_BACKOFF_S", 2.0)
+WEBHOOK_TIMEOUT_S = as_float("WEBHOOK_TIMEOUT_S", 10.0)
+# up to this many completions (for the same callback_url) are POSTed at once, for
+# which a completion waits up to WEBHOOK_BATCH_WAIT_S for others
+WEBHOOK_BATCH_SIZE = as_int("WEBHOOK_BATCH_SIZE", 1)
+WEBHOOK_BATCH_WAIT_S = as_float("WEBHOOK_BATCH_WAIT_S", 0.0)
+# signs the body (X-Webhook-Signature: sha256=<HMAC-SHA256 hex digest>)
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+
+# Job queue params (main.py --queue)
+# a worker extends the lease of its job every third of this, a job whose lease
+# expired (e.g. the worker died) is taken by the next worker
+JOB_QUEUE_LEASE_S = as_int("JOB_QUEUE_LEASE_S", 300)
+JOB_QUEUE_POLL_INTERVAL_S = as_int("JOB_QUEUE_POLL_INTERVAL_S", 5)
+JOB_QUEUE_MAX_ATTEMPTS = as_int("JOB_QUEUE_MAX_ATTEMPTS", 3)
+
+# Transcript params (Whisper transcript only, the DAAN transcript is always JSON)
+# json: one (indented unless compressed) document, ndjson: one segment per line
+TRANSCRIPT_LAYOUT = os.environ.get("TRANSCRIPT_LAYOUT", "json")
+# store the text/start/end/confidence of the words of a segment as 4 arrays
+TRANSCRIPT_COLUMNAR_WORDS = assert_bool("TRANSCRIPT_COLUMNAR_WORDS", "n")
+TRANSCRIPT_COMPRESSION = os.environ.get("TRANSCRIPT_COMPRESSION", "none")
+# the Whisper token IDs of each segment, needed to align deferred word timestamps
+TRANSCRIPT_TOKENS = assert_bool("TRANSCRIPT_TOKENS")
+
+# Word index params
+# write an inverted index of the words (see word_index.py) next to the DAAN transcript
+WORD_INDEX = assert_bool("WORD_INDEX")
+
+# Alignment params (deferred word timestamps)
+# the transcripts of the most recently aligned assets are kept in memory
+ALIGNMENT_CACHE_ASSETS = as_int("ALIGNMENT_CACHE_ASSETS", 32)
+# assets aligned at the same time by main.py --align
+ALIGNMENT_WORKERS = as_int("ALIGNMENT_WORKERS", 2)
+
+# Profiling params
+# allows tasks to be profiled (profile/profile_memory), e.g. on one replica
+PROFILING_ENABLED = assert_bool("PROFILING_ENABLED", "n")
+PROFILE_SAMPLE_INTERVAL_MS = as_int("PROFILE_SAMPLE_INTERVAL_MS", 10)
+# frames of the allocation stacks (profile_memory), more makes tracing slower
+PROFILE_MEMORY_FRAMES = as_int("PROFILE_MEMORY_FRAMES", 16)
+
+# Tracing params
+# every run writes a trace of its (nested) steps to this dir, as Chrome trace JSON
+# (chrome://tracing, Perfetto) or OTLP/JSON. The API keeps the trace of every task
+# (GET /tasks/{id}/trace) either way
+TRACE_DIR = os.environ.get("TRACE_DIR", "")
+TRACE_FORMAT = os.environ.get("TRACE_FORMAT", "chrome")
 
 # Output filenames
-WHISPER_JSON_FILE = os.environ.get("WHISPER_JSON_FILE", "whisper-transcript.json")
+WHISPER_JSON_FILE = os.environ.get(
+    "WHISPER_JSON_FILE",
+    "whisper-transcript"
+    + (".ndjson" if TRANSCRIPT_LAYOUT == "ndjson" else ".json")
+    + {"gzip": ".gz", "zstd": ".zst"}.get(TRANSCRIPT_COMPRESSION, ""),
+)
+# the names the Whisper transcript gets with any layout and compression (the
+# current one first), so transcripts written before a change are still found
+WHISPER_JSON_FILES = list(
+    dict.fromkeys(
+        [WHISPER_JSON_FILE]
+        + [
+            f"whisper-transcript{extension}{compression}"
+            for extension in [".json", ".ndjson"]
+            for compression in ["", ".gz", ".zst"]
+        ]
+    )
+)
 DAAN_JSON_FILE = os.environ.get("DAAN_JSON_FILE", "daan-es-transcript.json")
+WORD_INDEX_FILE = os.environ.get("WORD_INDEX_FILE", "word-index.bin")
 PROV_FILENAME = os.environ.get("PROVENANCE_FILENAME", "provenance.json")
 
 LOG_FORMAT = "%(asctime)s|%(levelname)s|%(process)d|%(module)s|%(funcName)s|%(lineno)d|%(message)s"  # noqa: E501
 
-assert DATA_BASE_DIR, "Please add DATA_BASE_DIR to your environment"
-assert DATA_BASE_DIR not in [".", "/"], "Please enter an absolute, non-root path"
-assert os.path.exists(DATA_BASE_DIR), "DATA_BASE_DIR does not exist"
-
-assert MODEL_BASE_DIR, "Please add MODEL_BASE_DIR to your environment"
-assert MODEL_BASE_DIR not in [".", "/"], "Please enter an absolute, non-root path"
-assert os.path.exists(MODEL_BASE_DIR), "MODEL_BASE_DIR does not exist"
-
-for url, access_key_id, secret_access_key in [
-    (INPUT_S3_ENDPOINT_URL, INPUT_S3_ACCES_KEY_ID, INPUT_S3_SECRET_ACCES_KEY),
-    (OUTPUT_S3_ENDPOINT_URL, OUTPUT_S3_ACCES_KEY_ID, OUTPUT_S3_SECRET_ACCES_KEY),
-    (MODEL_S3_ENDPOINT_URL, MODEL_S3_ACCES_KEY_ID, MODEL_S3_SECRET_ACCES_KEY),
-]:
-    if url:
-        assert validators.url(url), "Please enter a valid S3_ENDPOINT_URL"
-        assert (
-            access_key_id and secret_access_key
-        ), f"No valid credentials specified for {url}"
-
-
-assert W_DEVICE in ["cuda", "cpu"], "Please use either cuda|cpu for W_DEVICE"
-if W_MODEL[0:5] != "s3://" and not validators.url(W_MODEL):
-    assert W_MODEL in [
-        "tiny",
-        "base",
-        "small",
-        "medium",
-        "large",
-        "large-v2",
-        "large-v3",
-    ], "Please use one of: tiny|base|small|medium|large|large-v2|large-v3 for W_MODEL"
+
+# called once at startup by main.py (and the API), rather than on import, so
+# importing any module (e.g. in tests and tooling) stays cheap
+def validate_config():
+    import validators
+
+    assert DATA_BASE_DIR, "Please add DATA_BASE_DIR to your environment"
+    assert DATA_BASE_DIR not in [".", "/"], "Please enter an absolute, non-root path"
+    assert os.path.exists(DATA_BASE_DIR), "DATA_BASE_DIR does not exist"
+
+    assert MODEL_BASE_DIR, "Please add MODEL_BASE_DIR to your environment"
+    assert MODEL_BASE_DIR not in [".", "/"], "Please enter an absolute, non-root path"
+    assert os.path.exists(MODEL_BASE_DIR), "MODEL_BASE_DIR does not exist"
+
+    for url, access_key_id, secret_access_key in [
+        (INPUT_S3_ENDPOINT_URL, INPUT_S3_ACCES_KEY_ID, INPUT_S3_SECRET_ACCES_KEY),
+        (OUTPUT_S3_ENDPOINT_URL, OUTPUT_S3_ACCES_KEY_ID, OUTPUT_S3_SECRET_ACCES_KEY),
+        (MODEL_S3_ENDPOINT_URL, MODEL_S3_ACCES_KEY_ID, MODEL_S3_SECRET_ACCES_KEY),
+    ]:
+        if url:
+            assert validators.url(url), "Please enter a valid S3_ENDPOINT_URL"
+            assert (
+                access_key_id and secret_access_key
+            ), f"No valid credentials specified for {url}"
+
+    assert SCHEDULING_POLICY in [
+        "fifo",
+        "sjf",
+        "aging",
+    ], "Please use one of: fifo|sjf|aging for SCHEDULING_POLICY"
+
+    assert WEBHOOK_MAX_ATTEMPTS > 0, "Please use a positive WEBHOOK_MAX_ATTEMPTS"
+    assert WEBHOOK_BATCH_SIZE > 0, "Please use a positive WEBHOOK_BATCH_SIZE"
+
+    assert JOB_QUEUE_LEASE_S > 0, "Please use a positive JOB_QUEUE_LEASE_S"
+    assert JOB_QUEUE_MAX_ATTEMPTS > 0, "Please use a positive JOB_QUEUE_MAX_ATTEMPTS"
+
+    assert TRANSCRIPT_LAYOUT in [
+        "json",
+        "ndjson",
+    ], "Please use either json|ndjson for TRANSCRIPT_LAYOUT"
+    assert TRANSCRIPT_COMPRESSION in [
+        "none",
+        "gzip",
+        "zstd",
+    ], "Please use one of: none|gzip|zstd for TRANSCRIPT_COMPRESSION"
+    if TRANSCRIPT_COMPRESSION == "zstd":
+        assert find_spec("zstandard"), "Please install the zstd extra to use zstd"
+
+    if W_DEFER_WORD_TIMESTAMPS:
+        assert W_WORD_TIMESTAMPS, "Please enable W_WORD_TIMESTAMPS to defer them"
+        assert TRANSCRIPT_TOKENS, "Please enable TRANSCRIPT_TOKENS to align later"
+    assert ALIGNMENT_WORKERS > 0, "Please use a positive ALIGNMENT_WORKERS"
+
+    assert (
+        PROFILE_SAMPLE_INTERVAL_MS > 0
+    ), "Please use a positive PROFILE_SAMPLE_INTERVAL_MS"
+    assert PROFILE_MEMORY_FRAMES > 0, "Please use a positive PROFILE_MEMORY_FRAMES"
+
+    assert TRACE_FORMAT in [
+        "chrome",
+        "otlp",
+    ], "Please use either chrome|otlp for TRACE_FORMAT"
+
+    assert W_DEVICE in ["cuda", "cpu"], "Please use either cuda|cpu for W_DEVICE"
+    assert W_BACKEND in [
+        "faster-whisper",
+        "stub",
+    ], "Please use either faster-whisper|stub for W_BACKEND"
+    if W_MODEL[0:5] != "s3://" and not validators.url(W_MODEL):
+        assert W_MODEL in [
+            "tiny",
+            "base",
+            "small",
+            "medium",
+            "large",
+            "large-v2",
+            "large-v3",
+        ], "Please use one of: tiny|base|small|medium|large|large-v2|large-v3 for W_MODEL"
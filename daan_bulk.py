@@ -0,0 +1,192 @@
+import logging
+import orjson
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+from base_util import transcript_to_json
+from config import (
+    DAAN_JSON_FILE,
+    OUTPUT_S3_ENDPOINT_URL,
+    OUTPUT_S3_ACCES_KEY_ID,
+    OUTPUT_S3_SECRET_ACCES_KEY,
+    WHISPER_JSON_FILES,
+    WORD_INDEX,
+    WORD_INDEX_FILE,
+)
+from daan_transcript import DAAN_FORMAT_VERSION, whisper_json_to_daan_format
+from s3_util import S3Store, parse_s3_uri
+from transcript_format import decode_whisper_transcript
+from word_index import WordIndexBuilder
+
+
+logger = logging.getLogger(__name__)
+
+# which version of each Whisper transcript was converted with which DAAN format
+STATE_FILE = "daan-bulk-state.json"
+
+
+@dataclass
+class ConversionJob:
+    source: str  # local path or S3 URI of a Whisper transcript
+    version: str  # mtime (local) or ETag (S3): changes when the transcript changes
+
+
+# regenerates the DAAN transcript next to every Whisper transcript under source
+# (a directory or an S3 prefix), skipping the ones that are already up to date
+def convert_all(
+    source: str, state_file: str, workers: Optional[int] = None, force: bool = False
+) -> dict:
+    logger.info(f"Converting Whisper transcripts under {source} to DAAN format")
+    start_time = time.time()
+    state = {} if force else load_state(state_file)
+    jobs = find_s3_jobs(source) if _is_s3(source) else find_local_jobs(source)
+    todo = [j for j in jobs if state.get(j.source) != [j.version, DAAN_FORMAT_VERSION]]
+    logger.info(f"{len(jobs) - len(todo)} of {len(jobs)} DAAN transcripts up to date")
+
+    words = 0
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for job, (word_count, error) in zip(
+            todo, pool.map(convert_job, todo, chunksize=16)
+        ):
+            if error:
+                failed.append({"source": job.source, "error_msg": error})
+                continue
+            words += word_count
+            state[job.source] = [job.version, DAAN_FORMAT_VERSION]
+    save_state(state_file, state)
+
+    wall_time_s = time.time() - start_time
+    summary = {
+        "transcripts": len(jobs),
+        "converted": len(todo) - len(failed),
+        "skipped": len(jobs) - len(todo),
+        "failed": failed,
+        "words": words,
+        "wall_time_s": wall_time_s,
+        "words_per_second": words / wall_time_s if wall_time_s else 0,
+    }
+    logger.info(f"Conversion done: {summary}")
+    return summary
+
+
+def find_local_jobs(root: str) -> List[ConversionJob]:
+    jobs = []
+    for dir_path, _, file_names in os.walk(root):
+        filename = get_whisper_transcript(file_names)
+        if filename:
+            path = os.path.join(dir_path, filename)
+            jobs.append(ConversionJob(path, str(os.stat(path).st_mtime_ns)))
+    return jobs
+
+
+def find_s3_jobs(s3_uri: str) -> List[ConversionJob]:
+    bucket, prefix = parse_s3_uri(s3_uri)
+    paginator = _get_s3_client().get_paginator("list_objects_v2")
+    etags: Dict[str, Dict[str, str]] = {}  # dir -> file name -> ETag
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            dir_key, filename = os.path.split(obj["Key"])
+            if filename in WHISPER_JSON_FILES:
+                etags.setdefault(dir_key, {})[filename] = obj["ETag"]
+    jobs = []
+    for dir_key, files in etags.items():
+        filename = get_whisper_transcript(list(files))
+        key = os.path.join(dir_key, filename)
+        jobs.append(ConversionJob(f"s3://{bucket}/{key}", files[filename]))
+    return jobs
+
+
+# the Whisper transcript among the file names of an asset. There is only one,
+# unless one was left by a run with another layout or compression: then the
+# first in WHISPER_JSON_FILES, i.e. the one with the current settings
+def get_whisper_transcript(file_names: List[str]) -> str:
+    return next((f for f in WHISPER_JSON_FILES if f in file_names), "")
+
+
+# runs in a worker process, returns the number of words and an error (if any)
+def convert_job(job: ConversionJob) -> Tuple[int, str]:
+    try:
+        if _is_s3(job.source):
+            bucket, key = parse_s3_uri(job.source)
+            s3_object = _get_s3_client().get_object(Bucket=bucket, Key=key)
+            outputs, word_count = convert(s3_object["Body"].read())
+            for filename, data in outputs.items():
+                _get_s3_client().put_object(
+                    Bucket=bucket,
+                    Key=os.path.join(os.path.dirname(key), filename),
+                    Body=data,
+                    ContentType=(
+                        "application/json"
+                        if filename == DAAN_JSON_FILE
+                        else "application/octet-stream"
+                    ),
+                )
+        else:
+            with open(job.source, "rb") as f:
+                outputs, word_count = convert(f.read())
+            for filename, data in outputs.items():
+                with open(
+                    os.path.join(os.path.dirname(job.source), filename), "wb"
+                ) as f:
+                    f.write(data)
+        return word_count, ""
+    except Exception as e:
+        logger.exception(f"Failed to convert {job.source}")
+        return 0, str(e)
+
+
+# the DAAN transcript (and word index) by filename, and the number of words
+def convert(whisper_json: bytes) -> Tuple[Dict[str, bytes], int]:
+    whisper_transcript = decode_whisper_transcript(whisper_json)
+    word_index = WordIndexBuilder() if WORD_INDEX else None
+    daan_transcript = whisper_json_to_daan_format(whisper_transcript, word_index)
+    word_count = sum(len(subtitle["wordTimes"]) for subtitle in daan_transcript)
+    outputs = {DAAN_JSON_FILE: transcript_to_json(daan_transcript)}
+    if word_index is not None:
+        outputs[WORD_INDEX_FILE] = word_index.to_bytes()
+    return outputs, word_count
+
+
+# unlike validate_s3_uri this doesn't log an error for every local path
+def _is_s3(source: str) -> bool:
+    return urlparse(source).scheme == "s3"
+
+
+_s3_client = None
+
+
+# one client per (worker) process, boto3 clients cannot be pickled
+def _get_s3_client():
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = S3Store(
+            s3_endpoint_url=OUTPUT_S3_ENDPOINT_URL,
+            access_key_id=OUTPUT_S3_ACCES_KEY_ID,
+            secret_access_key=OUTPUT_S3_SECRET_ACCES_KEY,
+        ).client
+    return _s3_client
+
+
+def load_state(state_file: str) -> Dict[str, list]:
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file, "rb") as f:
+        return orjson.loads(f.read())
+
+
+def save_state(state_file: str, state: Dict[str, list]):
+    tmp_file = f"{state_file}.tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(orjson.dumps(state))
+    os.replace(tmp_file, state_file)
+
+
+# local trees keep their state at the root, for S3 it's kept in the working dir
+def get_default_state_file(source: str) -> str:
+    if _is_s3(source):
+        return STATE_FILE
+    return os.path.join(source, STATE_FILE)
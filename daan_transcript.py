@@ -1,14 +1,29 @@
-import json
 import logging
 import os
 import time
-from typing import TypedDict, List
-from base_util import Provenance, write_transcript_to_json
-from config import WHISPER_JSON_FILE, DAAN_JSON_FILE
+from typing import List, NotRequired, Optional, TypedDict, Union
+from base_util import Provenance, transcript_to_json
+from config import (
+    WHISPER_JSON_FILE,
+    WHISPER_JSON_FILES,
+    DAAN_JSON_FILE,
+    WORD_INDEX,
+    WORD_INDEX_FILE,
+)
+from output_sink import LocalSink, OutputSink
+from tracing import current_span
+from transcript import Transcript, TranscriptSegment
+from transcript_format import decode_whisper_transcript
+from word_index import WordIndexBuilder
 
 
 logger = logging.getLogger(__name__)
 
+# bump when the output of whisper_json_to_daan_format changes, so the bulk
+# converter (daan_bulk.py) knows to regenerate existing DAAN transcripts
+# 2: the word index (WORD_INDEX_FILE), 3: wordTimesEstimated
+DAAN_FORMAT_VERSION = 3
+
 
 class ParsedResult(TypedDict):
     words: str
@@ -17,17 +32,32 @@ class ParsedResult(TypedDict):
     sequenceNr: int
     fragmentId: str
     carrierId: str
+    # only in (deferred) segments whose words weren't aligned yet: the wordTimes
+    # are estimated (see estimate_word_times)
+    wordTimesEstimated: NotRequired[bool]
 
 
-# asr_output_dir e.g /data/output/whisper-test/
-def generate_daan_transcript(asr_output_dir: str) -> Provenance:
+# asr_output_dir e.g /data/output/whisper-test/, the Whisper transcript is only
+# loaded from there if it's not passed (e.g. when it was just produced)
+def generate_daan_transcript(
+    asr_output_dir: str,
+    whisper_transcript: Union[dict, Transcript, None] = None,
+    sink: Optional[OutputSink] = None,
+) -> Provenance:
     logger.info(f"Generating transcript from: {asr_output_dir}")
     start_time = time.time()
-    whisper_transcript = load_whisper_transcript(asr_output_dir)
-    daan_transcript = whisper_json_to_daan_format(whisper_transcript)
+    if whisper_transcript is None:
+        whisper_transcript = load_whisper_transcript(asr_output_dir)
+    word_index = WordIndexBuilder() if WORD_INDEX else None
+    daan_transcript = whisper_json_to_daan_format(whisper_transcript, word_index)
 
     # write daan-es-transcript.json
-    write_transcript_to_json(daan_transcript, asr_output_dir, DAAN_JSON_FILE)
+    sink = sink or LocalSink(asr_output_dir)
+    data = transcript_to_json(daan_transcript)
+    current_span().set("bytes", len(data))
+    sink.put(DAAN_JSON_FILE, data)
+    if word_index:
+        sink.put(WORD_INDEX_FILE, word_index.to_bytes())
 
     end_time = (time.time() - start_time) * 1000
     provenance = Provenance(
@@ -35,35 +65,95 @@ def generate_daan_transcript(asr_output_dir: str) -> Provenance:
         activity_description="Converts the output of Whisper to the DAAN index format",
         processing_time_ms=end_time,
         start_time_unix=start_time,
-        input_data=os.path.join(asr_output_dir, WHISPER_JSON_FILE),
-        output_data=os.path.join(asr_output_dir, DAAN_JSON_FILE),
+        input_data=os.path.join(
+            asr_output_dir, find_whisper_transcript(asr_output_dir) or WHISPER_JSON_FILE
+        ),
+        output_data=sink.location(DAAN_JSON_FILE),
     )
     return provenance
 
 
+# the file name of the Whisper transcript in asr_output_dir, whatever the layout
+# and compression it was written with (see WHISPER_JSON_FILES), "" if there is none
+def find_whisper_transcript(asr_output_dir: str) -> str:
+    for filename in WHISPER_JSON_FILES:
+        if os.path.exists(os.path.join(asr_output_dir, filename)):
+            return filename
+    return ""
+
+
 def load_whisper_transcript(asr_output_dir: str) -> dict:
-    path = os.path.join(asr_output_dir, WHISPER_JSON_FILE)
-    whisper_transcript = json.load(open(path))
+    filename = find_whisper_transcript(asr_output_dir) or WHISPER_JSON_FILE
+    with open(os.path.join(asr_output_dir, filename), "rb") as f:
+        whisper_transcript = decode_whisper_transcript(f.read())
     return whisper_transcript
 
 
-def whisper_json_to_daan_format(whisper_transcript: dict) -> List[ParsedResult]:
+# the postings of the words are added to the word_index (if passed) on the way.
+# A transcript that was read from file (a dict) is made a Transcript first
+def whisper_json_to_daan_format(
+    whisper_transcript: Union[dict, Transcript],
+    word_index: Optional[WordIndexBuilder] = None,
+) -> List[ParsedResult]:
+    transcript = (
+        Transcript.from_dict(whisper_transcript)
+        if isinstance(whisper_transcript, dict)
+        else whisper_transcript
+    )
     i = 0  # sequenceNr counter
-    daan_transcript = []
-    for segment in whisper_transcript["segments"]:
-        wordTimes = []
-        for word in segment["words"]:
-            wordTimes.append(int(word["start"] * 1000))  # as seen in dane-asr-worker
+    daan_transcript: List[ParsedResult] = []
+    deferred = transcript.word_alignment == "deferred"
+    # as seen in dane-asr-worker: the start of every word in (truncated) ms
+    word_times = transcript.word_times_ms()
+    for segment_index, segment in enumerate(transcript.segments):
+        start, end = transcript.word_range(segment_index)
+        wordTimes = word_times[start:end].tolist()
+        estimated = deferred and start == end
+        if estimated:
+            wordTimes = estimate_word_times(segment)
+        if word_index is not None:
+            add_postings(word_index, len(daan_transcript), segment, wordTimes)
 
         subtitle: ParsedResult = {
             "wordTimes": wordTimes,
             "sequenceNr": i,
-            "start": segment["start"],
+            "start": segment.start,
             # converts i to a 5-char long string prepended with 0s
             # (similar to kaldi output)
             "fragmentId": f"{i:05d}",
-            "words": segment["text"],
-            "carrierId": whisper_transcript["carrierId"],
+            "words": segment.text,
+            "carrierId": transcript.carrier_id,
         }
+        if estimated:
+            subtitle["wordTimesEstimated"] = True
         daan_transcript.append(subtitle)
     return daan_transcript
+
+
+# the offsets are those of the words in the text (i.e. the "words" of the DAAN
+# transcript), the times those of the Whisper words where they line up
+def add_postings(
+    word_index: WordIndexBuilder,
+    segment_index: int,
+    segment: TranscriptSegment,
+    word_times: list,
+):
+    texts = segment.text.split()
+    if len(texts) != len(word_times):  # e.g. W_WORD_TIMESTAMPS=n
+        word_times = [int(segment.start * 1000)] * len(texts)
+    for word_offset, (text, start_ms) in enumerate(zip(texts, word_times)):
+        word_index.add(segment_index, word_offset, text, start_ms)
+
+
+# until the words of a segment are aligned (see alignment.py), every word gets a
+# share of the segment's duration proportional to its length, so the DAAN
+# transcript still has a time for every word
+def estimate_word_times(segment: TranscriptSegment) -> List[int]:
+    lengths = [len(word) + 1 for word in segment.text.split()]  # + the space
+    ms_per_char = (segment.end - segment.start) * 1000 / max(sum(lengths), 1)
+    word_times = []
+    start_ms = segment.start * 1000
+    for length in lengths:
+        word_times.append(int(start_ms))
+        start_ms += length * ms_per_char
+    return word_times
@@ -2,6 +2,5 @@
 
 echo "Starting Whisper ASR worker"
 
-python main.py "$@"
-
-echo "The worker has finished"
\ No newline at end of file
+# exec, so the worker itself receives SIGTERM and can drain (see DRAIN_TIMEOUT_S)
+exec python main.py "$@"
\ No newline at end of file
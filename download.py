@@ -1,11 +1,17 @@
 from dataclasses import dataclass
 from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+import hashlib
 import logging
 import os
 import requests
+import shutil
 import time
+from typing import AsyncIterator, BinaryIO, Tuple
+from uuid import uuid4
 from s3_util import S3Store, parse_s3_uri, validate_s3_uri
 from config import (
+    FFMPEG_TIMEOUT_S,
     INPUT_S3_ENDPOINT_URL,
     INPUT_S3_ACCES_KEY_ID,
     INPUT_S3_SECRET_ACCES_KEY,
@@ -16,9 +22,15 @@ from base_util import (
     Provenance,
     remove_all_input_output,
 )
+from input_cache import fetch_input
+from tracing import current_span, span
 
 logger = logging.getLogger(__name__)
 
+# a stream URL has to outlive the transcode reading from it, including the probe
+# that comes before it
+STREAM_URL_MARGIN_S = 600
+
 
 @dataclass
 class DownloadResult:
@@ -28,16 +40,44 @@ class DownloadResult:
     content_length: int = -1  # download_data.get("content_length", -1),
 
 
+@dataclass
+class UploadResult:
+    file_path: str  # temporary location, until the pipeline claims it
+    sha256: str
+    content_length: int
+
+
 def download_uri(
     uri: str, input_dir: str, filename: str, extension: str
 ) -> DownloadResult:
     logger.info(f"Trying to download {uri}")
+    with span("download", uri=uri) as download_span:
+        if validate_s3_uri(uri):
+            logger.info("URI seems to be an S3 URI")
+            result = s3_download(uri, input_dir, filename, extension)
+        elif validate_http_uri(uri):
+            logger.info("URI seems to be an HTTP URI")
+            result = http_download(uri, input_dir, filename, extension)
+        else:
+            raise ValueError("Input failure: URI is neither S3, nor HTTP")
+        download_span.set("bytes", result.content_length)
+        return result
+
+
+# returns a URL that e.g. ffmpeg can read the input from without a local copy
+def get_stream_url(uri: str) -> str:
     if validate_s3_uri(uri):
-        logger.info("URI seems to be an S3 URI")
-        return s3_download(uri, input_dir, filename, extension)
+        bucket, object_name = parse_s3_uri(uri)
+        s3 = S3Store(
+            s3_endpoint_url=INPUT_S3_ENDPOINT_URL,
+            access_key_id=INPUT_S3_ACCES_KEY_ID,
+            secret_access_key=INPUT_S3_SECRET_ACCES_KEY,
+        )
+        return s3.generate_presigned_url(
+            bucket, object_name, expires_in=FFMPEG_TIMEOUT_S + STREAM_URL_MARGIN_S
+        )
     if validate_http_uri(uri):
-        logger.info("URI seems to be an HTTP URI")
-        return http_download(uri, input_dir, filename, extension)
+        return uri
     raise ValueError("Input failure: URI is neither S3, nor HTTP")
 
 
@@ -57,25 +97,78 @@ def http_download(
     input_file = os.path.join(input_dir, filename)
     mime_type = extension_to_mime_type(extension)
 
+    # only the input is replaced (it may be a hard link to the input cache, so
+    # it's not written into), the rest of the asset dir is kept
     if os.path.exists(input_file):
-        logger.info(f"File {input_file} already exists, overwriting...")
-        remove_all_input_output(input_dir)
+        logger.info(f"File {input_file} already exists, replacing it")
+        os.remove(input_file)
 
     # Create /data/<asset_id>/ folder if not exists
     if not os.path.exists(input_dir):
         logger.info(f"{input_dir} does not exist, creating it now")
         os.makedirs(input_dir)
-    with open(input_file, "wb") as file:
-        response = requests.get(url)
+    validator, content_length = get_http_validator(url)
+    cache_hit = fetch_input(
+        url, validator, input_file, lambda path: _http_fetch(url, path), content_length
+    )
+    provenance.steps.append("Input cache hit" if cache_hit else "Downloaded input")
+    current_span().set("cache_hit", cache_hit)
+    provenance.processing_time_ms = (time.time() - start_time) * 1000
+
+    return DownloadResult(
+        input_file, mime_type, provenance, os.path.getsize(input_file)
+    )
+
+
+# what identifies the version of the remote file (ETag, or else Last-Modified),
+# and its size. Empty if the server doesn't tell (so the input is not cached)
+def get_http_validator(url: str) -> Tuple[str, int]:
+    try:
+        with span("http_head"):
+            response = requests.head(url, allow_redirects=True, timeout=30)
+    except requests.RequestException:
+        logger.exception(f"HEAD request to {url} failed")
+        return "", -1
+    if response.status_code != 200:
+        return "", -1
+    content_length = int(response.headers.get("Content-Length", -1))
+    if etag := response.headers.get("ETag"):
+        return f"etag:{etag}", content_length
+    if last_modified := response.headers.get("Last-Modified"):
+        return f"last-modified:{last_modified}:{content_length}", content_length
+    return "", content_length
+
+
+# the size of the remote input (HEAD/head_object), -1 if it's unknown
+def get_content_length(uri: str) -> int:
+    if validate_s3_uri(uri):
+        bucket, object_name = parse_s3_uri(uri)
+        s3 = S3Store(
+            s3_endpoint_url=INPUT_S3_ENDPOINT_URL,
+            access_key_id=INPUT_S3_ACCES_KEY_ID,
+            secret_access_key=INPUT_S3_SECRET_ACCES_KEY,
+        )
+        try:
+            head = s3.client.head_object(Bucket=bucket, Key=object_name)
+            return head["ContentLength"]
+        except Exception:
+            logger.exception(f"Could not get the size of {uri}")
+            return -1
+    if validate_http_uri(uri):
+        return get_http_validator(uri)[1]
+    return -1
+
+
+# streams the response to disk, rather than holding multi-GB inputs in memory
+def _http_fetch(url: str, input_file: str):
+    with span("http_fetch"), requests.get(url, stream=True) as response:
         if response.status_code != 200:
             raise HTTPException(
                 status_code=response.status_code, detail=f"Could not download {url}"
             )
-        file.write(response.content)
-        file.close()
-    provenance.processing_time_ms = (time.time() - start_time) * 1000
-
-    return DownloadResult(input_file, mime_type, provenance)  # TODO add content_length
+        with open(input_file, "wb") as file:
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                file.write(chunk)
 
 
 def s3_download(
@@ -100,9 +193,10 @@ def s3_download(
     )
     mime_type = extension_to_mime_type(extension)
 
+    # only the input is replaced (see http_download)
     if os.path.exists(input_file):
-        logger.info(f"File {input_file} already exists, attempting to delete")
-        remove_all_input_output(input_dir)
+        logger.info(f"File {input_file} already exists, replacing it")
+        os.remove(input_file)
 
     s3 = S3Store(
         s3_endpoint_url=INPUT_S3_ENDPOINT_URL,
@@ -113,11 +207,87 @@ def s3_download(
     if not os.path.exists(input_dir):
         logger.info(f"{input_dir} does not exist, creating it now")
         os.makedirs(input_dir)
-    success = s3.download_file(bucket, object_name, input_dir)
+    try:
+        with span("s3_head_object"):
+            head = s3.client.head_object(Bucket=bucket, Key=object_name)
+        validator, content_length = f"etag:{head['ETag']}", head["ContentLength"]
+    except Exception:
+        logger.exception(f"Could not get the ETag of {url}")
+        validator, content_length = "", -1
 
-    if not success:
-        raise Exception(f"Could not download {url} from S3")
+    def fetch(path: str):
+        try:
+            with span("s3_download_file"):
+                s3.client.download_file(Bucket=bucket, Key=object_name, Filename=path)
+        except Exception as e:
+            raise Exception(f"Could not download {url} from S3") from e
 
+    cache_hit = fetch_input(url, validator, input_file, fetch, content_length)
+    provenance.steps.append("Input cache hit" if cache_hit else "Downloaded input")
+    current_span().set("cache_hit", cache_hit)
     provenance.processing_time_ms = (time.time() - start_time) * 1000  # time in ms
 
-    return DownloadResult(input_file, mime_type, provenance)  # TODO add content_length
+    return DownloadResult(
+        input_file, mime_type, provenance, os.path.getsize(input_file)
+    )
+
+
+def _write_chunk(file: BinaryIO, sha256: "hashlib._Hash", chunk: bytes):
+    sha256.update(chunk)
+    file.write(chunk)
+
+
+# streams a request body to disk chunk by chunk (bounded memory), hashing on the fly
+async def receive_upload(chunks: AsyncIterator[bytes], upload_dir: str) -> UploadResult:
+    if not os.path.exists(upload_dir):
+        logger.info(f"{upload_dir} does not exist, creating it now")
+        os.makedirs(upload_dir)
+    upload_file = os.path.join(upload_dir, f"{uuid4()}.part")
+    logger.info(f"Receiving upload into {upload_file}")
+    sha256 = hashlib.sha256()
+    content_length = 0
+    try:
+        with open(upload_file, "wb") as file:
+            async for chunk in chunks:
+                # the disk (and hashing) would block the event loop, i.e. the API
+                await run_in_threadpool(_write_chunk, file, sha256, chunk)
+                content_length += len(chunk)
+    except Exception:
+        os.remove(upload_file)
+        raise
+    logger.info(f"Received {content_length} bytes (sha256={sha256.hexdigest()})")
+    return UploadResult(upload_file, sha256.hexdigest(), content_length)
+
+
+# moves an input that was uploaded or prefetched into the asset dir, instead of
+# downloading the input
+def claim_staged_input(
+    staged_file: str, input_uri: str, input_dir: str, filename: str, extension: str
+) -> DownloadResult:
+    logger.info(f"Moving staged file {staged_file} into {input_dir}")
+    start_time = time.time()
+
+    provenance = Provenance(
+        activity_name="Claim Staged Input",
+        activity_description="Takes the uploaded or prefetched input file to be transcribed",
+        start_time_unix=start_time,
+        input_data=input_uri,
+    )
+
+    input_file = os.path.join(input_dir, filename)
+    mime_type = extension_to_mime_type(extension)
+
+    if os.path.exists(input_file):
+        logger.info(f"File {input_file} already exists, overwriting...")
+        remove_all_input_output(input_dir)
+
+    # Create /data/<asset_id>/ folder if not exists
+    if not os.path.exists(input_dir):
+        logger.info(f"{input_dir} does not exist, creating it now")
+        os.makedirs(input_dir)
+    content_length = os.path.getsize(staged_file)
+    with span("claim_staged_input", bytes=content_length):
+        shutil.move(staged_file, input_file)
+    provenance.processing_time_ms = (time.time() - start_time) * 1000
+
+    return DownloadResult(input_file, mime_type, provenance, content_length)
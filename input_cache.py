@@ -0,0 +1,220 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+from dataclasses import asdict, dataclass
+from typing import Callable, List, Tuple
+from base_util import file_lock
+from config import DATA_BASE_DIR, INPUT_CACHE_MAX_BYTES
+
+
+logger = logging.getLogger(__name__)
+
+# every entry is a dir named after the hash of the input URI, holding the media
+# (DATA_FILE) and what it was validated with (META_FILE). The mtime of META_FILE
+# is the last time the entry was used
+CACHE_DIR = os.path.join(DATA_BASE_DIR, ".cache", "inputs")
+LOCK_DIR = os.path.join(CACHE_DIR, ".locks")
+# an empty file per input that was streamed rather than downloaded (named after
+# the hash of its URI), for the STREAMED_MAX_INPUTS most recent ones. They're not
+# cache entries, so eviction (by bytes) doesn't need to account for them
+STREAMED_DIR = os.path.join(CACHE_DIR, ".streamed")
+STREAMED_MAX_INPUTS = 1000
+DATA_FILE = "data"
+META_FILE = "meta.json"
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    uncacheable: int = 0  # the remote object has no ETag or Last-Modified
+    bytes_saved: int = 0  # not downloaded thanks to a hit
+    bytes_downloaded: int = 0
+    evictions: int = 0
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+cache_stats = CacheStats()
+
+
+def is_enabled() -> bool:
+    return INPUT_CACHE_MAX_BYTES > 0
+
+
+# puts the input at target_file, from the cache if the entry for uri is still
+# valid (same validator, e.g. the ETag) and otherwise with fetch, which writes the
+# input to the path it is given. Returns True on a cache hit
+def fetch_input(
+    uri: str,
+    validator: str,
+    target_file: str,
+    fetch: Callable[[str], None],
+    content_length: int = -1,
+) -> bool:
+    if not is_enabled() or not validator or content_length > INPUT_CACHE_MAX_BYTES:
+        if is_enabled():
+            logger.info(f"{uri} cannot be validated or is too large to cache")
+            cache_stats.uncacheable += 1
+        fetch(target_file)
+        return False
+
+    key = _get_key(uri)
+    entry_dir = os.path.join(CACHE_DIR, key)
+    data_file = os.path.join(entry_dir, DATA_FILE)
+    with file_lock(os.path.join(LOCK_DIR, f"{key}.lock")):
+        size = _get_valid_size(entry_dir, validator)
+        if size >= 0:
+            logger.info(f"Input cache hit for {uri} ({size} bytes)")
+            cache_stats.hits += 1
+            cache_stats.bytes_saved += size
+            os.utime(os.path.join(entry_dir, META_FILE))
+            _link(data_file, target_file)
+            return True
+
+        logger.info(f"Input cache miss for {uri}, downloading it into the cache")
+        cache_stats.misses += 1
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        # make room first, so the download doesn't fill up the disk
+        evict(INPUT_CACHE_MAX_BYTES - max(content_length, 0), keep=key)
+        os.makedirs(entry_dir)
+        try:
+            fetch(f"{data_file}.part")
+            os.replace(f"{data_file}.part", data_file)
+        except Exception:
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            raise
+        size = os.path.getsize(data_file)
+        cache_stats.bytes_downloaded += size
+        with open(os.path.join(entry_dir, META_FILE), "w") as f:
+            json.dump({"uri": uri, "validator": validator, "size": size}, f)
+        _link(data_file, target_file)
+    _remove(os.path.join(STREAMED_DIR, key))  # cached from now on
+    evict(INPUT_CACHE_MAX_BYTES, keep=key)
+    return False
+
+
+# whether there is an entry for uri, without checking if it's still valid
+def is_cached(uri: str) -> bool:
+    meta_file = os.path.join(CACHE_DIR, _get_key(uri), META_FILE)
+    return is_enabled() and os.path.exists(meta_file)
+
+
+# inputs are streamed into ffmpeg (see STREAM_VIDEO_INPUT) only the first time,
+# as streaming doesn't fill the cache: a retry or re-run downloads them into it
+def mark_streamed(uri: str):
+    if not is_enabled():
+        return
+    os.makedirs(STREAMED_DIR, exist_ok=True)
+    with open(os.path.join(STREAMED_DIR, _get_key(uri)), "w"):
+        pass
+    # forget the least recently streamed inputs (their retries are long done)
+    markers = []
+    for key in os.listdir(STREAMED_DIR):
+        try:
+            markers.append((os.path.getmtime(os.path.join(STREAMED_DIR, key)), key))
+        except OSError:
+            continue  # removed meanwhile
+    for _, key in sorted(markers)[:-STREAMED_MAX_INPUTS]:
+        _remove(os.path.join(STREAMED_DIR, key))
+
+
+def was_streamed(uri: str) -> bool:
+    return os.path.exists(os.path.join(STREAMED_DIR, _get_key(uri)))
+
+
+def _get_key(uri: str) -> str:
+    return hashlib.sha256(uri.encode("utf-8")).hexdigest()
+
+
+# returns the size of the cached input, or -1 if there's no valid entry
+def _get_valid_size(entry_dir: str, validator: str) -> int:
+    try:
+        with open(os.path.join(entry_dir, META_FILE), "r") as f:
+            meta = json.load(f)
+        size = os.path.getsize(os.path.join(entry_dir, DATA_FILE))
+    except (OSError, ValueError):
+        return -1
+    if meta.get("validator") != validator or meta.get("size") != size:
+        return -1
+    return size
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# the cache and the asset dirs are both in DATA_BASE_DIR, so a hard link costs
+# no copy and survives the asset dir being cleaned up
+def _link(data_file: str, target_file: str):
+    os.makedirs(os.path.dirname(target_file), exist_ok=True)
+    if os.path.exists(target_file):
+        os.remove(target_file)
+    try:
+        os.link(data_file, target_file)
+    except OSError:
+        shutil.copyfile(data_file, target_file)
+
+
+# removes the least recently used entries until the cache fits in max_bytes
+def evict(max_bytes: int, keep: str = ""):
+    entries = sorted(_list_entries(), key=lambda entry: entry[1])  # oldest first
+    total_bytes = sum(size for _, _, size in entries)
+    for key, _, size in entries:
+        if total_bytes <= max_bytes:
+            break
+        if key == keep:
+            continue
+        try:
+            # skip entries that are being fetched or read right now
+            with file_lock(os.path.join(LOCK_DIR, f"{key}.lock"), blocking=False):
+                logger.info(f"Evicting {key} ({size} bytes) from the input cache")
+                shutil.rmtree(os.path.join(CACHE_DIR, key), ignore_errors=True)
+        except BlockingIOError:
+            continue
+        total_bytes -= size
+        cache_stats.evictions += 1
+
+
+# (key, last used, size) of every entry, including the ones that are being
+# fetched or were left incomplete by a crash
+def _list_entries() -> List[Tuple[str, float, int]]:
+    entries: List[Tuple[str, float, int]] = []
+    if not os.path.exists(CACHE_DIR):
+        return entries
+    for key in os.listdir(CACHE_DIR):
+        entry_dir = os.path.join(CACHE_DIR, key)
+        if entry_dir in [LOCK_DIR, STREAMED_DIR]:
+            continue
+        try:
+            meta_file = os.path.join(entry_dir, META_FILE)
+            last_used = os.path.getmtime(
+                meta_file if os.path.exists(meta_file) else entry_dir
+            )
+            size = sum(  # the media, possibly still being fetched (.part)
+                os.path.getsize(os.path.join(entry_dir, fn))
+                for fn in os.listdir(entry_dir)
+                if fn != META_FILE
+            )
+        except OSError:
+            continue  # removed meanwhile
+        entries.append((key, last_used, size))
+    return entries
+
+
+def get_cache_stats() -> dict:
+    entries = _list_entries()
+    return {
+        **asdict(cache_stats),
+        "hit_rate": cache_stats.hit_rate(),
+        "entries": len(entries),
+        "bytes_cached": sum(size for _, _, size in entries),
+        "max_bytes": INPUT_CACHE_MAX_BYTES,
+    }
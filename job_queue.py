@@ -0,0 +1,359 @@
+import json
+import logging
+import math
+import os
+import socket
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from dataclasses import dataclass
+from enum import Enum
+from typing import Dict, Iterator, Optional
+from urllib.parse import urlparse
+from uuid import uuid4
+
+from asr import run
+from base_util import CancelToken, TaskCancelled, get_asset_info
+from batch import read_manifest
+from config import (
+    DRAIN_TIMEOUT_S,
+    JOB_QUEUE_LEASE_S,
+    JOB_QUEUE_MAX_ATTEMPTS,
+    JOB_QUEUE_POLL_INTERVAL_S,
+    MODEL_BASE_DIR,
+    W_DEVICE,
+    W_MODEL,
+)
+from whisper import load_model
+
+
+logger = logging.getLogger(__name__)
+
+# how often keep_lease checks whether the worker was stopped (the drain starts)
+STOP_CHECK_INTERVAL_S = 1.0
+
+
+class JobStatus(Enum):
+    QUEUED = "QUEUED"
+    LEASED = "LEASED"
+    DONE = "DONE"
+    FAILED = "FAILED"
+
+
+@dataclass
+class Job:
+    id: str
+    input_uri: str
+    output_uri: str = ""
+    attempts: int = 0  # including the current one
+    lease_id: str = ""  # changes with every lease, so a stale owner can't finish it
+
+
+# a queue shared by workers that pull jobs from it. A leased job is invisible to
+# other workers until its lease expires (e.g. because the worker died), so the
+# owner extends the lease while it works on the job. Only SQLite is implemented,
+# a Redis or SQS queue would implement the same methods
+class JobQueue(ABC):
+    @abstractmethod
+    def put(self, input_uri: str, output_uri: str = "") -> str:
+        pass
+
+    # the oldest job that is queued or whose lease expired, None if there is none
+    @abstractmethod
+    def lease(self, worker_id: str, lease_s: float) -> Optional[Job]:
+        pass
+
+    # False if the lease was lost (it expired and the job was leased again)
+    @abstractmethod
+    def extend(self, job: Job, lease_s: float) -> bool:
+        pass
+
+    @abstractmethod
+    def complete(self, job: Job, result: dict) -> bool:
+        pass
+
+    # queues the job again, or fails it when it has no attempts left. Without an
+    # error_msg (e.g. the worker is shutting down) the attempt doesn't count
+    @abstractmethod
+    def release(self, job: Job, error_msg: str = "") -> bool:
+        pass
+
+    @abstractmethod
+    def get_counts(self) -> Dict[str, int]:
+        pass
+
+
+# the workers on a host share the database file (e.g. in DATA_BASE_DIR). SQLite's
+# locking isn't reliable on network filesystems, so use it on a single host only
+class SQLiteJobQueue(JobQueue):
+    def __init__(self, path: str, max_attempts: int = JOB_QUEUE_MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        # sqlite3 connections can't be shared between threads (e.g. the heartbeat)
+        self.local = threading.local()
+        with self._transaction() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, "
+                "input_uri TEXT NOT NULL, "
+                "output_uri TEXT NOT NULL DEFAULT '', "
+                "status TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "lease_id TEXT NOT NULL DEFAULT '', "
+                "worker_id TEXT NOT NULL DEFAULT '', "
+                "lease_expires_unix REAL NOT NULL DEFAULT 0, "
+                "error_msg TEXT NOT NULL DEFAULT '', "
+                "result TEXT NOT NULL DEFAULT '', "
+                "created_unix REAL NOT NULL, "
+                "updated_unix REAL NOT NULL)"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_unix)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        if not hasattr(self.local, "db"):
+            # autocommit, the transactions are explicit
+            db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            # readers (e.g. get_counts) don't block the workers that lease
+            db.execute("PRAGMA journal_mode=WAL")
+            self.local.db = db
+        return self.local.db
+
+    # IMMEDIATE takes the write lock up front, so two workers can't select the same
+    # job before either of them leased it
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def put(self, input_uri: str, output_uri: str = "") -> str:
+        job_id = str(uuid4())
+        now = time.time()
+        with self._transaction() as db:
+            db.execute(
+                "INSERT INTO jobs (id, input_uri, output_uri, status, created_unix, "
+                "updated_unix) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, input_uri, output_uri, JobStatus.QUEUED.value, now, now),
+            )
+        return job_id
+
+    def lease(self, worker_id: str, lease_s: float) -> Optional[Job]:
+        now = time.time()
+        with self._transaction() as db:
+            while True:
+                row = db.execute(
+                    "SELECT * FROM jobs WHERE status = ? OR (status = ? AND "
+                    "lease_expires_unix < ?) ORDER BY created_unix LIMIT 1",
+                    (JobStatus.QUEUED.value, JobStatus.LEASED.value, now),
+                ).fetchone()
+                if row is None:
+                    return None
+                if row["attempts"] < self.max_attempts:
+                    break
+                # its workers keep dying on it, so it doesn't take down the next one
+                logger.warning(f"Job {row['id']} lost its lease {row['attempts']}x")
+                db.execute(
+                    "UPDATE jobs SET status = ?, error_msg = ?, updated_unix = ? "
+                    "WHERE id = ?",
+                    (
+                        JobStatus.FAILED.value,
+                        f"The lease expired {row['attempts']} times",
+                        now,
+                        row["id"],
+                    ),
+                )
+
+            job = Job(
+                row["id"],
+                row["input_uri"],
+                row["output_uri"],
+                row["attempts"] + 1,
+                str(uuid4()),
+            )
+            db.execute(
+                "UPDATE jobs SET status = ?, attempts = ?, lease_id = ?, worker_id = ?, "
+                "lease_expires_unix = ?, updated_unix = ? WHERE id = ?",
+                (
+                    JobStatus.LEASED.value,
+                    job.attempts,
+                    job.lease_id,
+                    worker_id,
+                    now + lease_s,
+                    now,
+                    job.id,
+                ),
+            )
+        return job
+
+    # updates the job if (and only if) the caller still holds the lease
+    def _update_leased(self, job: Job, assignments: str, values: tuple) -> bool:
+        with self._transaction() as db:
+            cursor = db.execute(
+                f"UPDATE jobs SET {assignments}, updated_unix = ? "
+                "WHERE id = ? AND lease_id = ? AND status = ?",
+                (*values, time.time(), job.id, job.lease_id, JobStatus.LEASED.value),
+            )
+            return cursor.rowcount == 1
+
+    def extend(self, job: Job, lease_s: float) -> bool:
+        return self._update_leased(
+            job, "lease_expires_unix = ?", (time.time() + lease_s,)
+        )
+
+    def complete(self, job: Job, result: dict) -> bool:
+        return self._update_leased(
+            job,
+            "status = ?, result = ?, error_msg = ''",
+            (JobStatus.DONE.value, json.dumps(result)),
+        )
+
+    def release(self, job: Job, error_msg: str = "") -> bool:
+        if not error_msg:
+            return self._update_leased(
+                job,
+                "status = ?, attempts = attempts - 1",
+                (JobStatus.QUEUED.value,),
+            )
+        failed = job.attempts >= self.max_attempts
+        return self._update_leased(
+            job,
+            "status = ?, error_msg = ?",
+            (
+                JobStatus.FAILED.value if failed else JobStatus.QUEUED.value,
+                error_msg,
+            ),
+        )
+
+    def get_counts(self) -> Dict[str, int]:
+        rows = (
+            self._connect()
+            .execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+            .fetchall()
+        )
+        return {status.value: 0 for status in JobStatus} | {
+            row[0]: row[1] for row in rows
+        }
+
+
+# a path, or a sqlite:// URL (sqlite:///abs/path/queue.db)
+def get_job_queue(queue_uri: str) -> JobQueue:
+    parsed = urlparse(queue_uri)
+    if parsed.scheme in ["", "sqlite"]:
+        return SQLiteJobQueue(parsed.path if parsed.scheme else queue_uri)
+    raise ValueError(f"Unsupported job queue {queue_uri}, use a (sqlite://) path")
+
+
+# adds the entries of a batch manifest (see batch.py) to the queue
+def enqueue_manifest(
+    queue: JobQueue,
+    manifest_file: str,
+    input_template: str = "",
+    output_template: str = "",
+) -> int:
+    input_uris = read_manifest(manifest_file, input_template)
+    for input_uri in input_uris:
+        asset_id, _ = get_asset_info(urlparse(input_uri).path)
+        output_uri = (
+            output_template.format(asset_id=asset_id) if output_template else ""
+        )
+        queue.put(input_uri, output_uri)
+    logger.info(f"Queued {len(input_uris)} jobs")
+    return len(input_uris)
+
+
+def get_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+# pulls jobs from the queue until stop is set (e.g. on SIGTERM), or the queue is
+# empty with exit_when_empty. There is no dispatcher: every worker (with its own
+# model) just takes the next job, so adding workers adds throughput
+def run_queue_worker(
+    queue: JobQueue,
+    stop: Optional[threading.Event] = None,
+    exit_when_empty: bool = False,
+    model=None,
+) -> Dict[str, int]:
+    worker_id = get_worker_id()
+    stop = stop or threading.Event()
+    model = model or load_model(MODEL_BASE_DIR, W_MODEL, W_DEVICE)
+    logger.info(f"Worker {worker_id} pulling jobs from the queue")
+    counts = {"done": 0, "failed": 0}
+    while not stop.is_set():
+        job = queue.lease(worker_id, JOB_QUEUE_LEASE_S)
+        if job is None:
+            if exit_when_empty:
+                break
+            stop.wait(JOB_QUEUE_POLL_INTERVAL_S)
+            continue
+        counts["done" if process_job(queue, job, model, stop) else "failed"] += 1
+    logger.info(f"Worker {worker_id} stopped: {counts}")
+    return counts
+
+
+def process_job(queue: JobQueue, job: Job, model, stop: threading.Event) -> bool:
+    logger.info(f"Processing job {job.id} (attempt {job.attempts}): {job.input_uri}")
+    cancel = CancelToken()
+    finished = threading.Event()
+    heartbeat = threading.Thread(
+        target=keep_lease, args=(queue, job, cancel, finished, stop), daemon=True
+    )
+    heartbeat.start()
+    try:
+        result = run(job.input_uri, job.output_uri, model, cancel=cancel)
+        return queue.complete(job, result)
+    except TaskCancelled as e:
+        logger.info(f"Job {job.id} was cancelled: {e}")
+        if e.keep_output:  # stopped, another worker (or restart) continues it
+            queue.release(job)
+        return False
+    except Exception as e:
+        logger.exception(f"Job {job.id} failed")
+        queue.release(job, str(e))
+        return False
+    finally:
+        finished.set()
+        heartbeat.join()
+
+
+# extends the lease (at a third of its duration) while the job runs. The run is
+# cancelled when the lease is lost, or when the worker is stopped and the job
+# didn't finish within DRAIN_TIMEOUT_S after the worker was stopped
+def keep_lease(
+    queue: JobQueue,
+    job: Job,
+    cancel: CancelToken,
+    finished: threading.Event,
+    stop: threading.Event,
+):
+    next_extend = time.time() + JOB_QUEUE_LEASE_S / 3
+    drain_deadline = math.inf
+    while True:
+        if stop.is_set() and drain_deadline == math.inf:
+            drain_deadline = time.time() + DRAIN_TIMEOUT_S
+        if time.time() >= drain_deadline:
+            cancel.cancel("The worker is shutting down", keep_output=True)
+            return
+        if time.time() >= next_extend:
+            next_extend = time.time() + JOB_QUEUE_LEASE_S / 3
+            try:
+                if not queue.extend(job, JOB_QUEUE_LEASE_S):
+                    cancel.cancel(f"Lost the lease of job {job.id}")
+                    return
+            except Exception:
+                logger.exception(f"Failed to extend the lease of job {job.id}")
+        wait_s = min(next_extend, drain_deadline) - time.time()
+        if drain_deadline == math.inf:
+            wait_s = min(wait_s, STOP_CHECK_INTERVAL_S)
+        if finished.wait(max(wait_s, 0)):
+            return
@@ -1,9 +1,10 @@
-from api import api
 import uvicorn
 import logging
+import signal
 import sys
+import threading
 from argparse import ArgumentParser
-from config import LOG_FORMAT
+from config import LOG_FORMAT, validate_config
 
 
 # initialises the root logger
@@ -21,6 +22,31 @@ if __name__ == "__main__":
     parser = ArgumentParser(description="whisper-asr-worker")
     parser.add_argument("--log", action="store", dest="loglevel", default="INFO")
     parser.add_argument("--port", action="store", dest="port", default="5333")
+    # offline batch mode: process a manifest of input URIs/IDs instead of serving
+    parser.add_argument("--batch", action="store", dest="manifest", default="")
+    parser.add_argument("--run-dir", action="store", dest="run_dir", default="")
+    parser.add_argument(
+        "--concurrency", action="store", dest="concurrency", default="2"
+    )
+    parser.add_argument(
+        "--input-template", action="store", dest="input_template", default=""
+    )
+    parser.add_argument(
+        "--output-template", action="store", dest="output_template", default=""
+    )
+    # regenerate the DAAN transcripts of a directory tree or S3 prefix
+    parser.add_argument(
+        "--convert-daan", action="store", dest="convert_source", default=""
+    )
+    parser.add_argument("--workers", action="store", dest="workers", default="0")
+    parser.add_argument("--state", action="store", dest="state_file", default="")
+    parser.add_argument("--force", action="store_true", dest="force")
+    # pull-based worker mode: lease jobs from a shared queue (see job_queue.py)
+    parser.add_argument("--queue", action="store", dest="queue", default="")
+    parser.add_argument("--enqueue", action="store", dest="enqueue", default="")
+    parser.add_argument("--exit-when-empty", action="store_true", dest="exit_empty")
+    # align the deferred word timestamps of (comma separated) assets in DATA_BASE_DIR
+    parser.add_argument("--align", action="store", dest="align", default="")
     args = parser.parse_args()
 
     # initialises the root logger
@@ -35,6 +61,60 @@ if __name__ == "__main__":
     logger.setLevel(log_level)
     logger.info(f"Logger initialized (log level: {log_level})")
     logger.info(f"Got the following CMD line arguments: {args}")
+    validate_config()
+
+    if args.queue:
+        from job_queue import enqueue_manifest, get_job_queue, run_queue_worker
+
+        queue = get_job_queue(args.queue)
+        if args.enqueue:
+            enqueue_manifest(
+                queue, args.enqueue, args.input_template, args.output_template
+            )
+            sys.exit(0)
+        # on SIGTERM the running job gets DRAIN_TIMEOUT_S, then it's released
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        run_queue_worker(queue, stop, args.exit_empty)
+        logger.info(f"Jobs in the queue: {queue.get_counts()}")
+        sys.exit(0)
+
+    if args.align:
+        from alignment import align_assets
+        from config import MODEL_BASE_DIR, W_DEVICE, W_MODEL
+        from whisper import load_model
+
+        results = align_assets(
+            args.align.split(","), load_model(MODEL_BASE_DIR, W_MODEL, W_DEVICE)
+        )
+        logger.info(f"Aligned: {results}")
+        sys.exit(1 if any(r.startswith("failed") for r in results.values()) else 0)
+
+    if args.manifest:
+        from batch import run_batch
+
+        run_batch(
+            args.manifest,
+            args.run_dir or f"{args.manifest}.run",
+            int(args.concurrency),
+            args.input_template,
+            args.output_template,
+        )
+        sys.exit(0)
+
+    if args.convert_source:
+        from daan_bulk import convert_all, get_default_state_file
+
+        summary = convert_all(
+            args.convert_source,
+            args.state_file or get_default_state_file(args.convert_source),
+            int(args.workers) or None,  # None: one worker per CPU
+            args.force,
+        )
+        sys.exit(1 if summary["failed"] else 0)
+
+    # the API loads the model in the background once it's started
+    from api import api
 
     port = int(args.port)
     log_config = uvicorn.config.LOGGING_CONFIG
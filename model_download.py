@@ -1,10 +1,15 @@
+import glob
+import hashlib
 import logging
 import os
+import shutil
 import tarfile
+import tempfile
+from typing import IO, Dict, cast
 from urllib.parse import urlparse
 import requests
 from s3_util import S3Store, parse_s3_uri, validate_s3_uri
-from base_util import get_asset_info, validate_http_uri
+from base_util import file_lock, get_asset_info, validate_http_uri
 from config import (
     MODEL_S3_ENDPOINT_URL,
     MODEL_S3_ACCES_KEY_ID,
@@ -14,23 +19,104 @@ from config import (
 
 logger = logging.getLogger(__name__)
 
+# optional manifest in the archive, in the format of sha256sum: "<sha256>  <path>"
+CHECKSUM_MANIFEST = "SHA256SUMS"
+# written into the model dir after a complete, verified extraction: a dir without
+# it was left behind by a crash (or by an older version of this worker)
+INSTALLED_MANIFEST = ".installed.sha256sums"
+CHUNK_SIZE = 1024 * 1024
+
 
 # e.g. {base_dir}/modelx.tar.gz will be extracted in {base_dir}/modelx
 def extract_model(destination: str, extension: str) -> str:
     tar_path = f"{destination}.{extension}"
     logger.info(f"Extracting  {tar_path} into {destination}")
-    if not os.path.exists(destination):  # Create dir for model to be extracted in
-        os.makedirs(destination)
-    logger.info(f"Extracting the model into {destination}")
-    with tarfile.open(tar_path) as tar:
-        tar.extractall(path=destination)
+    with open(tar_path, "rb") as f:
+        install_model(f, destination)
     # cleanup: delete the tar file
     os.remove(tar_path)
-    if os.path.exists(os.path.join(destination, "model.bin")):
-        logger.info(f"model.bin found in {destination}. Model extracted successfully!")
-        return destination
-    else:
-        raise Exception(f"{destination} does not contain a model.bin file. Exiting...")
+    return destination
+
+
+def is_installed(destination: str) -> bool:
+    return os.path.exists(os.path.join(destination, INSTALLED_MANIFEST))
+
+
+# extracts the (gzipped) tar stream into a temporary dir next to destination
+# while it's being downloaded, verifies it and then renames it to destination.
+# Callers should hold the model lock (see model_lock)
+def install_model(stream: IO[bytes], destination: str) -> str:
+    parent_dir = os.path.dirname(os.path.abspath(destination))
+    os.makedirs(parent_dir, exist_ok=True)
+    prefix = f".{os.path.basename(destination)}.tmp-"
+    for stale_dir in glob.glob(os.path.join(parent_dir, f"{prefix}*")):
+        logger.warning(f"Removing {stale_dir} left behind by an earlier run")
+        shutil.rmtree(stale_dir, ignore_errors=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent_dir, prefix=prefix)
+    try:
+        checksums = _extract_stream(stream, tmp_dir)
+        verify_model(tmp_dir, checksums)
+        with open(os.path.join(tmp_dir, INSTALLED_MANIFEST), "w") as f:
+            f.writelines(f"{sha256}  {path}\n" for path, sha256 in checksums.items())
+        if os.path.exists(destination):  # incomplete, see is_installed
+            logger.warning(f"Removing incomplete model in {destination}")
+            shutil.rmtree(destination)
+        os.rename(tmp_dir, destination)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    logger.info(f"model.bin found in {destination}. Model extracted successfully!")
+    return destination
+
+
+# extracts the regular files and dirs of the archive in a single pass over the
+# stream, returns the SHA-256 of every extracted file
+def _extract_stream(stream: IO[bytes], output_dir: str) -> Dict[str, str]:
+    checksums = {}
+    with tarfile.open(fileobj=stream, mode="r|*") as tar:
+        for member in tar:
+            path = os.path.normpath(member.name)
+            target = os.path.join(output_dir, path)
+            if path.startswith("..") or os.path.isabs(path):
+                raise ValueError(f"Refusing to extract {member.name} outside the model")
+            if member.isdir():
+                os.makedirs(target, exist_ok=True)
+                continue
+            if not member.isfile():
+                logger.warning(f"Skipping {member.name}: not a regular file")
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            source = tar.extractfile(member)
+            sha256 = hashlib.sha256()
+            with open(target, "wb") as f:
+                while chunk := source.read(CHUNK_SIZE):  # type: ignore[union-attr]
+                    sha256.update(chunk)
+                    f.write(chunk)
+            checksums[path] = sha256.hexdigest()
+    return checksums
+
+
+def verify_model(model_dir: str, checksums: Dict[str, str]):
+    if "model.bin" not in checksums:
+        raise Exception(f"{model_dir} does not contain a model.bin file. Exiting...")
+    if CHECKSUM_MANIFEST not in checksums:
+        logger.warning(f"No {CHECKSUM_MANIFEST} in the model, cannot verify it")
+        return
+    with open(os.path.join(model_dir, CHECKSUM_MANIFEST), "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            expected, path = line.split(maxsplit=1)
+            path = os.path.normpath(path.strip().lstrip("*"))
+            if checksums.get(path) != expected.lower():
+                raise Exception(f"Checksum mismatch for {path} in the model archive")
+    logger.info(f"All files in {CHECKSUM_MANIFEST} verified")
+
+
+# one download/extraction per model, also between workers on the same host
+def model_lock(destination: str):
+    base_dir, asset_id = os.path.split(os.path.abspath(destination))
+    return file_lock(os.path.join(base_dir, ".locks", f"{asset_id}.lock"))
 
 
 # makes sure the model is obtained from S3/HTTP/Huggingface,
@@ -52,33 +138,42 @@ def get_model_location(base_dir: str, whisper_model: str) -> str:
 def check_s3_location(base_dir: str, whisper_model: str) -> str:
     logger.info(f"{whisper_model} is an S3 URI. Attempting to download")
     bucket, object_name = parse_s3_uri(whisper_model)
-    asset_id, extension = get_asset_info(object_name)
+    asset_id, _ = get_asset_info(object_name)
     destination = os.path.join(base_dir, asset_id)
-    if os.path.exists(destination):
+    if is_installed(destination):
         logger.info("Model already exists")
         return destination
-    s3 = S3Store(
-        s3_endpoint_url=MODEL_S3_ENDPOINT_URL,
-        access_key_id=MODEL_S3_ACCES_KEY_ID,
-        secret_access_key=MODEL_S3_SECRET_ACCES_KEY,
-    )
-    success = s3.download_file(bucket, object_name, base_dir)
-    if not success:
-        raise Exception(f"Could not download {whisper_model} into {base_dir}")
-    return extract_model(destination, extension)
+    with model_lock(destination):
+        if is_installed(destination):  # installed by another worker meanwhile
+            logger.info("Model already exists")
+            return destination
+        s3 = S3Store(
+            s3_endpoint_url=MODEL_S3_ENDPOINT_URL,
+            access_key_id=MODEL_S3_ACCES_KEY_ID,
+            secret_access_key=MODEL_S3_SECRET_ACCES_KEY,
+        )
+        try:
+            s3_object = s3.client.get_object(Bucket=bucket, Key=object_name)
+        except Exception as e:
+            raise Exception(
+                f"Could not download {whisper_model} into {base_dir}"
+            ) from e
+        return install_model(s3_object["Body"], destination)
 
 
 def check_http_location(base_dir: str, whisper_model: str) -> str:
     logger.info(f"{whisper_model} is an HTTP URI. Attempting to download")
-    asset_id, extension = get_asset_info(urlparse(whisper_model).path)
+    asset_id, _ = get_asset_info(urlparse(whisper_model).path)
     destination = os.path.join(base_dir, asset_id)
-    if os.path.exists(destination):
+    if is_installed(destination):
         logger.info("Model already exists")
         return destination
-    with open(f"{destination}.{extension}", "wb") as file:
-        response = requests.get(whisper_model)
-        if response.status_code >= 400:
-            raise Exception(f"Could not download {whisper_model} into {base_dir}")
-        file.write(response.content)
-        file.close()
-    return extract_model(destination, extension)
+    with model_lock(destination):
+        if is_installed(destination):  # installed by another worker meanwhile
+            logger.info("Model already exists")
+            return destination
+        with requests.get(whisper_model, stream=True) as response:
+            if response.status_code >= 400:
+                raise Exception(f"Could not download {whisper_model} into {base_dir}")
+            response.raw.decode_content = True  # undo a Content-Encoding: gzip
+            return install_model(cast(IO[bytes], response.raw), destination)
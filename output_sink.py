@@ -0,0 +1,111 @@
+import logging
+import os
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List
+from config import (
+    OUTPUT_S3_ENDPOINT_URL,
+    OUTPUT_S3_ACCES_KEY_ID,
+    OUTPUT_S3_SECRET_ACCES_KEY,
+    OUTPUT_UPLOAD_RETRIES,
+)
+from s3_util import S3Store, parse_s3_uri
+from tracing import propagate, span
+
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPES = {
+    ".json": "application/json",
+    ".ndjson": "application/x-ndjson",
+    ".gz": "application/gzip",
+    ".zst": "application/zstd",
+}
+
+
+# where the output files (transcripts, provenance) of a run are written to
+class OutputSink(ABC):
+    # stores the file, possibly in the background (see wait)
+    @abstractmethod
+    def put(self, filename: str, data: bytes):
+        pass
+
+    # blocks until everything put so far is stored, raises if anything failed
+    def wait(self):
+        pass
+
+    # waits for the last files to be stored and releases the resources
+    def close(self):
+        self.wait()
+
+    @abstractmethod
+    def location(self, filename: str) -> str:
+        pass
+
+
+class LocalSink(OutputSink):
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+
+    def put(self, filename: str, data: bytes):
+        logger.info(f"Saving {filename} to {self.output_dir}")
+        os.makedirs(self.output_dir, exist_ok=True)
+        with span("write_output", filename=filename, bytes=len(data)):
+            with open(self.location(filename), "wb+") as f:
+                f.write(data)
+
+    def location(self, filename: str) -> str:
+        return os.path.join(self.output_dir, filename)
+
+
+# uploads every file straight from memory as soon as it is put, so e.g. the
+# Whisper transcript is uploaded while the DAAN transcript is being generated
+class S3Sink(OutputSink):
+    def __init__(self, output_uri: str, max_workers: int = 2):
+        if not OUTPUT_S3_ENDPOINT_URL:
+            raise Exception("Transfer to S3 configured without an S3_ENDPOINT_URL!")
+        self.output_uri = output_uri.rstrip("/")
+        self.bucket, self.path = parse_s3_uri(output_uri)
+        self.s3 = S3Store(
+            s3_endpoint_url=OUTPUT_S3_ENDPOINT_URL,
+            access_key_id=OUTPUT_S3_ACCES_KEY_ID,
+            secret_access_key=OUTPUT_S3_SECRET_ACCES_KEY,
+        )
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.uploads: List[Future] = []
+
+    def put(self, filename: str, data: bytes):
+        logger.info(f"Uploading {filename} ({len(data)} bytes) to {self.output_uri}")
+        self.uploads.append(self.pool.submit(propagate(self._upload), filename, data))
+
+    def _upload(self, filename: str, data: bytes):
+        with span("upload_output", filename=filename, bytes=len(data)):
+            self.s3.upload_bytes(
+                self.bucket,
+                os.path.join(self.path, filename),
+                data,
+                get_content_type(filename),
+                OUTPUT_UPLOAD_RETRIES,
+            )
+
+    def wait(self):
+        uploads, self.uploads = self.uploads, []
+        for upload in uploads:
+            upload.result()  # re-raises the error of a failed upload
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.pool.shutdown(cancel_futures=True)
+
+    def location(self, filename: str) -> str:
+        return f"{self.output_uri}/{filename}"
+
+
+def get_output_sink(output_dir: str, output_uri: str) -> OutputSink:
+    return S3Sink(output_uri) if output_uri else LocalSink(output_dir)
+
+
+def get_content_type(filename: str) -> str:
+    return CONTENT_TYPES.get(os.path.splitext(filename)[1], "application/octet-stream")
@@ -0,0 +1,172 @@
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from types import FrameType
+from typing import ContextManager, Dict, Iterator, List, Optional
+
+from config import PROFILE_MEMORY_FRAMES, PROFILE_SAMPLE_INTERVAL_MS
+from output_sink import get_output_sink
+
+
+logger = logging.getLogger(__name__)
+
+CPU_PROFILE_FILE = "cpu-profile.folded"
+MEMORY_PROFILE_FILE = "memory-profile.folded"
+# a new memory snapshot is taken when the peak of the traced memory grew by this
+# factor, so the last one shows what was allocated (close to) the peak
+SNAPSHOT_GROWTH = 1.25
+
+
+# samples the Python stacks of the thread that starts it, and of the threads
+# started meanwhile (e.g. uploads), every PROFILE_SAMPLE_INTERVAL_MS. The stacks
+# are written in the "folded" format (frame;frame;frame count) of flamegraph.pl,
+# speedscope and inferno. With memory, tracemalloc traces the allocations: the
+# snapshot closest to the peak is written in the same format (bytes per stack).
+# Subprocesses (ffmpeg) are not sampled, see the trace of the run for those
+class SamplingProfiler:
+    def __init__(
+        self,
+        memory: bool = False,
+        interval_s: float = PROFILE_SAMPLE_INTERVAL_MS / 1000,
+        memory_frames: int = PROFILE_MEMORY_FRAMES,
+    ):
+        self.memory = memory
+        self.interval_s = interval_s
+        self.memory_frames = memory_frames
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.snapshot: Optional[tracemalloc.Snapshot] = None
+        self.snapshot_bytes = 0
+        self.snapshot_lock = threading.Lock()
+        self.started_tracemalloc = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.start_time = time.time()
+        self.profiled_thread = threading.get_ident()
+        # the threads that were there already (the API's) are left out
+        self.other_threads = {t.ident for t in threading.enumerate()}
+        self.other_threads.discard(self.profiled_thread)
+        # tracemalloc is process wide, another profile may be tracing already
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start(self.memory_frames)
+            self.started_tracemalloc = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        if self.started_tracemalloc:
+            if self.snapshot is None:
+                self.take_snapshot(force=True)
+            tracemalloc.stop()
+        logger.info(
+            f"Profiled {self.samples} samples in {time.time() - self.start_time:.1f}s"
+        )
+
+    def _run(self):
+        while not self.stopped.wait(self.interval_s):
+            self._sample()
+            if self.started_tracemalloc:
+                self.take_snapshot()
+
+    def _sample(self):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        self.samples += 1
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id in self.other_threads or thread_id == self.thread.ident:
+                continue
+            self.stacks[(names.get(thread_id, str(thread_id)), *_get_stack(frame))] += 1
+
+    # called every sample, when the peak grew. The sampler may only get to it after
+    # the peak (e.g. under load), so code that knows when its memory peaks can
+    # force a snapshot there
+    def take_snapshot(self, force: bool = False):
+        if not tracemalloc.is_tracing():
+            return
+        with self.snapshot_lock:  # the sampler's and a forced one
+            _, peak = tracemalloc.get_traced_memory()
+            if force or peak > self.snapshot_bytes * SNAPSHOT_GROWTH:
+                self.snapshot = tracemalloc.take_snapshot()
+                self.snapshot_bytes = peak
+
+    def to_folded(self) -> bytes:
+        return _to_folded(self.stacks)
+
+    # the allocated bytes per stack, as of the snapshot closest to the peak
+    def memory_to_folded(self) -> bytes:
+        sizes: Counter = Counter()
+        for stat in self.snapshot.statistics("traceback") if self.snapshot else []:
+            stack = tuple(
+                f"{os.path.basename(frame.filename)}:{frame.lineno}"
+                for frame in stat.traceback  # oldest first
+            )
+            sizes[stack] += stat.size
+        return _to_folded(sizes)
+
+    # filename -> contents of the profile
+    def get_outputs(self) -> Dict[str, bytes]:
+        outputs = {CPU_PROFILE_FILE: self.to_folded()}
+        if self.memory and self.snapshot:
+            outputs[MEMORY_PROFILE_FILE] = self.memory_to_folded()
+        return outputs
+
+
+# the frames of the stack, outermost first. The line of the function (rather than
+# the current line) is used, so the samples of a function add up
+def _get_stack(frame: Optional[FrameType]) -> List[str]:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(
+            f"{code.co_qualname} ({os.path.basename(code.co_filename)}:"
+            f"{code.co_firstlineno})"
+        )
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def _to_folded(counts: Counter) -> bytes:
+    lines = [
+        # ; separates the frames, so it can't be part of one
+        ";".join(frame.replace(";", ":") for frame in stack) + f" {count}"
+        for stack, count in counts.most_common()
+    ]
+    return "\n".join(lines).encode("utf-8") + b"\n"
+
+
+# profiles the block when enabled. When not, nothing runs at all
+def profile_run(enabled: bool, memory: bool = False) -> ContextManager:
+    return _profile(memory) if enabled else nullcontext()
+
+
+@contextmanager
+def _profile(memory: bool) -> Iterator[SamplingProfiler]:
+    profiler = SamplingProfiler(memory)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+
+
+# stores the profile next to the provenance of the run (in the output_uri or the
+# asset dir), returns the locations of the files
+def save_profile(
+    profiler: SamplingProfiler, data_dir: str, output_uri: str
+) -> List[str]:
+    outputs = profiler.get_outputs()
+    sink = get_output_sink(data_dir, output_uri)
+    try:
+        for filename, data in outputs.items():
+            sink.put(filename, data)
+    finally:
+        sink.close()
+    return [sink.location(filename) for filename in outputs]
@@ -1,10 +1,13 @@
-import boto3
+import io
 import logging
 import os
+import random
+import time
 from pathlib import Path
 import tarfile
 from typing import List, Tuple
 from urllib.parse import urlparse
+from tracing import span
 
 
 logger = logging.getLogger(__name__)
@@ -94,12 +97,15 @@ class S3Store:
     def __init__(
         self, s3_endpoint_url: str, access_key_id: str, secret_access_key: str
     ):
-        self.client: boto3.client = boto3.client(
-            "s3",
-            endpoint_url=s3_endpoint_url,
-            aws_access_key_id=access_key_id,
-            aws_secret_access_key=secret_access_key,
-        )
+        with span("s3_create_client"):
+            import boto3  # takes a while to import, and not every run uses S3
+
+            self.client = boto3.client(
+                "s3",
+                endpoint_url=s3_endpoint_url,
+                aws_access_key_id=access_key_id,
+                aws_secret_access_key=secret_access_key,
+            )
 
     def transfer_to_s3(
         self, bucket: str, path: str, file_list: List[str], tar_archive_path: str = ""
@@ -133,6 +139,66 @@ class S3Store:
                 return False
         return True
 
+    # uploads from memory, large objects are uploaded in (parallel) parts. Failed
+    # uploads are retried with exponential backoff, raises after the last attempt
+    def upload_bytes(
+        self,
+        bucket: str,
+        object_name: str,
+        data: bytes,
+        content_type: str = "",
+        retries: int = 4,
+        backoff_s: float = 1.0,
+    ):
+        extra_args = {"ContentType": content_type} if content_type else None
+        for attempt in range(retries + 1):
+            try:
+                self.client.upload_fileobj(
+                    io.BytesIO(data), bucket, object_name, ExtraArgs=extra_args
+                )
+                return
+            except Exception:
+                if attempt == retries:
+                    raise
+                delay = backoff_s * 2**attempt * random.uniform(0.5, 1.5)
+                logger.warning(
+                    f"Upload of {object_name} failed, retrying in {delay:.1f}s",
+                    exc_info=True,
+                )
+                time.sleep(delay)
+
+    def copy_within_s3(
+        self,
+        source_bucket: str,
+        source_path: str,
+        bucket: str,
+        path: str,
+        file_names: List[str],
+    ) -> bool:
+        for fn in file_names:
+            try:
+                self.client.copy(
+                    CopySource={
+                        "Bucket": source_bucket,
+                        "Key": os.path.join(source_path, fn),
+                    },
+                    Bucket=bucket,
+                    Key=os.path.join(path, fn),
+                )
+            except Exception:
+                logger.exception(f"Failed to copy {fn}")
+                return False
+        return True
+
+    def generate_presigned_url(
+        self, bucket: str, object_name: str, expires_in: int = 3600
+    ) -> str:
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": bucket, "Key": object_name},
+            ExpiresIn=expires_in,
+        )
+
     def download_file(self, bucket: str, object_name: str, output_folder: str) -> bool:
         logger.info(f"Downloading {bucket}:{object_name} into {output_folder}")
         if not os.path.exists(output_folder):
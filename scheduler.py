@@ -0,0 +1,195 @@
+import logging
+import os
+import shutil
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+from config import (
+    DATA_BASE_DIR,
+    DISK_RESERVE_BYTES,
+    MAX_QUEUED_TASKS,
+    MEMORY_RESERVE_BYTES,
+    SCHEDULING_AGING_FACTOR,
+    SCHEDULING_POLICY,
+    W_DEVICE,
+)
+from download import get_content_length, get_stream_url
+from transcode import probe_media
+
+
+logger = logging.getLogger(__name__)
+
+# the transcode step writes 16kHz mono 16-bit WAV
+WAV_BYTES_PER_S = 16000 * 2
+# faster-whisper decodes the whole WAV into 16kHz float32 samples in memory
+AUDIO_BYTES_PER_S = 16000 * 4
+# assumed when the duration can't be probed (e.g. a server refusing range requests)
+UNKNOWN_DURATION_S = 3600.0
+# assumed until the first task was transcribed (see ModelStats in api.py)
+DEFAULT_REAL_TIME_FACTOR = 0.1 if W_DEVICE == "cuda" else 1.0
+
+
+@dataclass
+class JobCost:
+    content_length: int = -1  # bytes, -1 if unknown
+    duration_s: float = -1  # -1 if unknown
+
+    def get_duration_s(self) -> float:
+        return self.duration_s if self.duration_s > 0 else UNKNOWN_DURATION_S
+
+    # the downloaded input plus the WAV extracted from it
+    def disk_bytes(self) -> int:
+        return max(self.content_length, 0) + int(
+            self.get_duration_s() * WAV_BYTES_PER_S
+        )
+
+    def memory_bytes(self) -> int:
+        return int(self.get_duration_s() * AUDIO_BYTES_PER_S)
+
+    def processing_s(self, real_time_factor: float) -> float:
+        return self.get_duration_s() * real_time_factor
+
+
+@dataclass
+class QueuedJob:
+    id: str
+    priority: int = 0  # higher classes are always started first
+    submitted_unix: float = field(default_factory=time.time)
+    cost: Optional[JobCost] = None  # None until it's estimated
+
+
+# the size from a HEAD/head_object request (or of the uploaded file) and the duration
+# from ffprobe, which only reads the headers of a remote input
+def estimate_cost(input_uri: str, local_file: str = "") -> JobCost:
+    cost = JobCost()
+    try:
+        if local_file:
+            cost.content_length = os.path.getsize(local_file)
+        else:
+            cost.content_length = get_content_length(input_uri)
+        cost.duration_s = probe_media(local_file or get_stream_url(input_uri)).duration
+    except Exception:
+        logger.exception(f"Could not estimate the cost of {input_uri}")
+    logger.info(f"Estimated cost of {input_uri}: {cost}")
+    return cost
+
+
+# why a job with this cost doesn't fit in the given disk/memory (-1: unknown), empty
+# if it does
+def get_budget_error(cost: JobCost, disk_bytes: int, memory_bytes: int) -> str:
+    if disk_bytes >= 0 and cost.disk_bytes() > disk_bytes - DISK_RESERVE_BYTES:
+        return (
+            f"Needs ~{cost.disk_bytes()} bytes of disk, {disk_bytes} bytes "
+            f"available in DATA_BASE_DIR (keeping {DISK_RESERVE_BYTES} free)"
+        )
+    if memory_bytes >= 0 and cost.memory_bytes() > memory_bytes - MEMORY_RESERVE_BYTES:
+        return (
+            f"Needs ~{cost.memory_bytes()} bytes of memory, {memory_bytes} bytes "
+            f"available (keeping {MEMORY_RESERVE_BYTES} free)"
+        )
+    return ""
+
+
+# (total, free) bytes of the disk DATA_BASE_DIR is on
+def get_disk_space() -> Tuple[int, int]:
+    usage = shutil.disk_usage(DATA_BASE_DIR or os.getcwd())
+    return usage.total, usage.free
+
+
+# (total, available) bytes of memory, (-1, -1) where /proc/meminfo doesn't exist
+def get_memory() -> Tuple[int, int]:
+    try:
+        with open("/proc/meminfo", "r") as f:
+            meminfo = {line.split(":")[0]: int(line.split()[1]) * 1024 for line in f}
+        return meminfo["MemTotal"], meminfo["MemAvailable"]
+    except (OSError, KeyError, ValueError, IndexError):
+        return -1, -1
+
+
+# lower is started first
+def get_score(
+    job: QueuedJob, policy: str, real_time_factor: float, now: float
+) -> Tuple[int, float]:
+    if job.cost is None or policy == "fifo":
+        return -job.priority, job.submitted_unix
+    score = job.cost.processing_s(real_time_factor)
+    if policy == "aging":
+        score -= SCHEDULING_AGING_FACTOR * (now - job.submitted_unix)
+    return -job.priority, score
+
+
+# the queue of tasks that wait for the (single) model, see SCHEDULING_POLICY
+class Scheduler:
+    def __init__(
+        self, policy: str = SCHEDULING_POLICY, max_queued: int = MAX_QUEUED_TASKS
+    ):
+        self.policy = policy
+        self.max_queued = max_queued
+        self.jobs: Dict[str, QueuedJob] = {}
+        self.changed = threading.Condition()
+
+    def is_full(self) -> bool:
+        return len(self.jobs) >= self.max_queued
+
+    def add(self, job: QueuedJob):
+        with self.changed:
+            self.jobs[job.id] = job
+            self.changed.notify_all()
+
+    def set_cost(self, job_id: str, cost: JobCost):
+        with self.changed:
+            if job := self.jobs.get(job_id):
+                job.cost = cost
+                self.changed.notify_all()
+
+    def remove(self, job_id: str) -> bool:
+        with self.changed:
+            return self.jobs.pop(job_id, None) is not None
+
+    # the jobs in the order they would start if they all fit, the ones that aren't
+    # estimated yet last
+    def get_order(self, real_time_factor: float, now: float = -1) -> List[QueuedJob]:
+        now = now if now >= 0 else time.time()
+        with self.changed:
+            jobs = list(self.jobs.values())
+        return sorted(
+            jobs,
+            key=lambda job: (
+                job.cost is None,
+                get_score(job, self.policy, real_time_factor, now),
+            ),
+        )
+
+    # takes the first job (in order) that fits in the free disk and memory, waiting
+    # at most timeout_s for one. Jobs that don't fit are skipped rather than
+    # blocking the ones behind them
+    def pop_next(
+        self, real_time_factor: float, timeout_s: float
+    ) -> Optional[QueuedJob]:
+        with self.changed:
+            for job in self.get_order(real_time_factor):
+                if job.cost is None:
+                    break
+                _, free_disk = get_disk_space()
+                _, available_memory = get_memory()
+                if error := get_budget_error(job.cost, free_disk, available_memory):
+                    logger.info(f"Not starting task {job.id} yet: {error}")
+                    continue
+                del self.jobs[job.id]
+                return job
+            self.changed.wait(timeout_s)
+        return None
+
+    # seconds until each job is expected to be done, after the running one
+    def get_etas(
+        self, real_time_factor: float, running_remaining_s: float = 0
+    ) -> Dict[str, float]:
+        etas = {}
+        eta = running_remaining_s
+        for job in self.get_order(real_time_factor):
+            if job.cost is None:
+                break
+            eta += job.cost.processing_s(real_time_factor)
+            etas[job.id] = eta
+        return etas
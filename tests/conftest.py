@@ -0,0 +1,9 @@
+import json
+import pytest
+
+
+# the Whisper transcript of data/whisper-test (words as rows)
+@pytest.fixture
+def whisper_transcript() -> dict:
+    with open("data/whisper-test/whisper-transcript.json") as f:
+        return json.load(f)
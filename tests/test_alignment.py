@@ -0,0 +1,174 @@
+import json
+import os
+import pytest
+import shutil
+import wave
+
+# Mocking environment used in alignment
+os.environ["DATA_BASE_DIR"] = "data"
+os.environ["MODEL_BASE_DIR"] = "tests/input/extract_model_test"
+
+from alignment import TranscriptCache, align_asset, align_assets  # noqa
+from asr_backend import StubBackend  # noqa
+from config import DAAN_JSON_FILE, PROV_FILENAME, WHISPER_JSON_FILE  # noqa
+from daan_transcript import estimate_word_times, whisper_json_to_daan_format  # noqa
+from transcode import TranscodeResult  # noqa
+from transcript import Transcript  # noqa
+from transcript_format import decode_whisper_transcript  # noqa
+from whisper import run_asr  # noqa
+
+
+def write_audio(path: str, duration_s: int):
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(16000)
+        f.writeframes(b"\x00\x00" * 16000 * duration_s)
+
+
+@pytest.fixture
+def deferred(mocker):
+    mocker.patch("whisper.W_DEFER_WORD_TIMESTAMPS", True)
+
+
+# a transcript of 3 segments whose words were deferred, with its audio
+@pytest.fixture
+def asset_dir(tmp_path, mocker, deferred) -> str:
+    mocker.patch("alignment.DATA_BASE_DIR", str(tmp_path))
+    mocker.patch("base_util.DATA_BASE_DIR", str(tmp_path))  # the asset lock
+    mocker.patch("alignment.transcript_cache", TranscriptCache())
+    data_dir = os.path.join(tmp_path, "asset")
+    os.makedirs(data_dir)
+    audio_file = os.path.join(data_dir, "asset_16k.wav")
+    write_audio(audio_file, 12)
+    run_asr(audio_file, data_dir, "asset", StubBackend(real_time_factor=0))
+    return data_dir
+
+
+def load_transcript(data_dir: str) -> dict:
+    with open(os.path.join(data_dir, WHISPER_JSON_FILE), "rb") as f:
+        return decode_whisper_transcript(f.read())
+
+
+def test_deferred_transcript_has_no_words(asset_dir):
+    transcript = load_transcript(asset_dir)
+    assert transcript["word_alignment"] == "deferred"
+    assert all(not s["words"] and s["tokens"] for s in transcript["segments"])
+
+
+def test_align_time_range(asset_dir, mocker):
+    model = StubBackend(real_time_factor=0)
+    align = mocker.spy(model, "align")
+    segments = align_asset("asset", model, start_s=6, end_s=8)
+    assert [s["id"] for s in segments] == [2]
+    assert len(segments[0]["words"]) == StubBackend.WORDS_PER_SEGMENT
+    assert segments[0]["words"][0] == {
+        "text": "woord1_0",
+        "start": 5.0,
+        "end": 5.5,
+        "confidence": 0.9,
+    }
+
+    transcript = load_transcript(asset_dir)
+    assert [bool(s["words"]) for s in transcript["segments"]] == [False, True, False]
+    assert transcript["word_alignment"] == "deferred"
+    # aligned segments are served from the (cached) transcript
+    assert align_asset("asset", model, start_s=5, end_s=10) == segments
+    assert align.call_count == 1
+
+
+def test_align_assets_regenerates_daan_transcript(asset_dir, tmp_path):
+    assert align_assets(["asset", "unknown"], StubBackend(real_time_factor=0)) == {
+        "asset": "3 segments aligned",
+        "unknown": f"failed: No Whisper transcript of unknown in {tmp_path}/unknown",
+    }
+    transcript = load_transcript(asset_dir)
+    assert transcript["word_alignment"] == "aligned"
+    with open(os.path.join(asset_dir, DAAN_JSON_FILE)) as f:
+        daan_transcript = json.load(f)
+    assert daan_transcript == whisper_json_to_daan_format(transcript)
+    assert daan_transcript[2]["wordTimes"][:2] == [10000, 10200]
+    assert not any("wordTimesEstimated" in s for s in daan_transcript)
+
+
+# e.g. the audio was cleaned up, the input_uri is in the provenance of the run
+def test_align_without_audio_fetches_input(asset_dir, mocker):
+    audio_file = os.path.join(asset_dir, "asset_16k.wav")
+    os.remove(audio_file)
+    with pytest.raises(FileNotFoundError):
+        align_asset("asset", StubBackend(real_time_factor=0))
+
+    with open(os.path.join(asset_dir, PROV_FILENAME), "w") as f:
+        json.dump({"input_data": "http://x/asset.mp4?token=1"}, f)
+
+    def download(uri, input_dir, filename, extension):
+        assert os.path.dirname(input_dir) == os.path.dirname(asset_dir)
+        input_file = os.path.join(input_dir, filename)
+        with open(input_file, "wb") as f:
+            f.write(b"video")
+        return mocker.Mock(file_path=input_file)
+
+    download_uri = mocker.patch("alignment.download_uri", side_effect=download)
+    try_transcode = mocker.patch(
+        "alignment.try_transcode",
+        return_value=TranscodeResult(audio_file, mocker.Mock(), 12),
+    )
+    assert len(align_asset("asset", StubBackend(real_time_factor=0))) == 3
+    uri, input_dir, filename, extension = download_uri.call_args.args
+    assert (uri, filename, extension) == (
+        "http://x/asset.mp4?token=1",
+        "asset.mp4",
+        ".mp4",
+    )
+    # downloaded into a scratch dir, moved into the asset dir
+    assert not os.path.exists(input_dir)
+    input_file = os.path.join(asset_dir, "asset.mp4")
+    try_transcode.assert_called_once_with(input_file, "asset", asset_dir)
+    assert os.path.exists(os.path.join(asset_dir, DAAN_JSON_FILE))
+
+
+# the input was 16kHz mono audio, so it's the audio itself: it is not downloaded
+# again (which would clear the asset dir)
+@pytest.mark.skipif(not shutil.which("ffprobe"), reason="needs ffmpeg")
+def test_align_asr_ready_input(asset_dir, mocker):
+    os.rename(
+        os.path.join(asset_dir, "asset_16k.wav"), os.path.join(asset_dir, "asset.wav")
+    )
+    with open(os.path.join(asset_dir, PROV_FILENAME), "w") as f:
+        json.dump({"input_data": "http://x/asset.wav"}, f)
+    download_uri = mocker.patch("alignment.download_uri")
+    assert len(align_asset("asset", StubBackend(real_time_factor=0))) == 3
+    download_uri.assert_not_called()
+    for fn in [PROV_FILENAME, DAAN_JSON_FILE, WHISPER_JSON_FILE, "asset.wav"]:
+        assert os.path.exists(os.path.join(asset_dir, fn))
+    assert load_transcript(asset_dir)["word_alignment"] == "aligned"
+
+
+def test_estimate_word_times():
+    segment = {"start": 1.0, "end": 2.0, "text": "een twee drie", "words": []}
+    # 4 + 5 + 5 characters (with spaces)
+    transcript = Transcript.from_dict({"carrierId": "asset", "segments": [segment]})
+    assert estimate_word_times(transcript.segments[0]) == [1000, 1285, 1642]
+    transcript = {
+        "carrierId": "asset",
+        "word_alignment": "deferred",
+        "segments": [segment],
+    }
+    daan_segment = whisper_json_to_daan_format(transcript)[0]
+    assert daan_segment["wordTimes"] == [1000, 1285, 1642]
+    assert daan_segment["wordTimesEstimated"]
+    del transcript["word_alignment"]  # words were left out (W_WORD_TIMESTAMPS=n)
+    daan_segment = whisper_json_to_daan_format(transcript)[0]
+    assert daan_segment["wordTimes"] == []
+    assert "wordTimesEstimated" not in daan_segment
+
+
+def test_transcript_cache():
+    cache = TranscriptCache(max_assets=2)
+    for asset_id in ["a", "b"]:
+        cache.put(asset_id, 1, {"carrierId": asset_id})
+    assert cache.get("a", 1) == {"carrierId": "a"}
+    cache.put("c", 1, {"carrierId": "c"})  # evicts b, a was used more recently
+    assert cache.get("b", 1) is None
+    assert cache.get("a", 2) is None  # the transcript changed
+    assert cache.get("c", 1) == {"carrierId": "c"}
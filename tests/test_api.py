@@ -0,0 +1,290 @@
+import json
+import math
+import os
+import pytest
+import threading
+import time
+from fastapi.testclient import TestClient
+
+# Mocking environment used in api
+os.environ["DATA_BASE_DIR"] = "data"
+os.environ["MODEL_BASE_DIR"] = "tests/input/extract_model_test"
+
+import api  # noqa
+from asr_backend import StubBackend  # noqa
+from scheduler import JobCost  # noqa
+from tracing import span  # noqa
+
+
+@pytest.fixture(autouse=True)
+def api_state(mocker, tmp_path):
+    mocker.patch("api.draining", False)
+    mocker.patch("api.QUEUE_FILE", os.path.join(tmp_path, "queued-tasks.json"))
+    mocker.patch("api.OUTBOX_FILE", os.path.join(tmp_path, "outbox.db"))
+
+
+# the model loads right away, tasks are run with run_task (instead of asr.run)
+@pytest.fixture
+def worker(mocker):
+    def get_client(run_task) -> TestClient:
+        mocker.patch("api.model_state", api.ModelState.LOADING)
+        mocker.patch("api.load_model", return_value=StubBackend())
+        mocker.patch("api.W_WARM_UP", False)
+        mocker.patch("api.model_stats", api.ModelStats())
+        mocker.patch("api.scheduler", api.Scheduler("sjf"))
+        mocker.patch("api.estimate_cost", return_value=JobCost(1000, 60))
+        mocker.patch("api.run", side_effect=run_task)
+        return TestClient(api.api)
+
+    return get_client
+
+
+def wait_for(condition) -> bool:
+    for _ in range(100):
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def submit(client: TestClient, input_uri: str) -> str:
+    return client.post("/tasks", json={"input_uri": input_uri}).json()["task_id"]
+
+
+def test_health_while_loading_model(mocker):
+    model_loaded = threading.Event()
+
+    stub = StubBackend()
+
+    def slow_load_model(*args, **kwargs):
+        model_loaded.wait(timeout=10)
+        return stub
+
+    mocker.patch("api.model", None)
+    mocker.patch("api.model_state", api.ModelState.LOADING)
+    mocker.patch("api.model_error", None)
+    mocker.patch("api.load_model", side_effect=slow_load_model)
+    mocker.patch("api.W_WARM_UP", True)
+    mocker.patch("api.warm_up_model", return_value=0.5)
+    mocker.patch("api.model_stats", api.ModelStats())
+    with TestClient(api.api) as client:
+        assert client.get("/health/live").status_code == 200
+        assert client.get("/health/ready").status_code == 503
+        response = client.post("/tasks", json={"input_uri": "http://x/y.mp3"})
+        assert response.status_code == 503
+        assert "loading the model" in response.json()["msg"]
+
+        model_loaded.set()
+        for _ in range(100):
+            if client.get("/health/ready").status_code == 200:
+                break
+            time.sleep(0.05)
+        ready = client.get("/health/ready").json()
+        assert ready["model"] == "READY" and not ready["busy"]
+        assert ready["model_stats"]["warm_up_s"] == 0.5
+        assert ready["backend"]["backend"] == "stub"
+        assert api.model is stub
+
+
+def test_health_failed_model(mocker):
+    mocker.patch("api.model", None)
+    mocker.patch("api.model_state", api.ModelState.LOADING)
+    mocker.patch("api.model_error", None)
+    mocker.patch("api.load_model", side_effect=ValueError("no model"))
+    with TestClient(api.api) as client:
+        for _ in range(100):
+            if client.get("/health/live").status_code == 500:
+                break
+            time.sleep(0.05)
+        assert client.get("/health/live").json() == {
+            "model": "FAILED",
+            "msg": "no model",
+        }
+        assert client.get("/health/ready").status_code == 503
+
+
+def test_update_model_stats(mocker):
+    mocker.patch("api.model_stats", api.ModelStats())
+    for real_time_factor in [0.5, -1, 0.1, 0.2]:
+        api.update_model_stats(real_time_factor)
+    assert api.model_stats.transcribed_tasks == 3
+    assert api.model_stats.first_task_real_time_factor == 0.5
+    assert round(api.model_stats.steady_state_real_time_factor, 3) == 0.15
+
+
+def test_tasks_are_queued(worker):
+    release = threading.Event()
+
+    def slow_run(input_uri, *args):
+        release.wait(timeout=10)
+        return {"real_time_factor": 0.2}
+
+    with worker(slow_run) as client:
+        assert wait_for(lambda: client.get("/health/ready").status_code == 200)
+        task_ids = [submit(client, f"http://x/{i}.mp3") for i in range(2)]
+        # running the first task
+        assert wait_for(lambda: client.get("/status").status_code == 503)
+        queued = client.get(f"/tasks/{task_ids[1]}").json()["data"]
+        assert queued["status"] == "CREATED"
+        assert queued["duration_s"] == 60
+        # 60s of the running task + 60s of its own, at the default real-time factor
+        assert queued["eta_s"] == 120 * api.DEFAULT_REAL_TIME_FACTOR
+
+        release.set()
+        assert wait_for(
+            lambda: all(api.all_tasks[i].status == api.Status.DONE for i in task_ids)
+        )
+        assert api.all_tasks[task_ids[1]].eta_s is None
+
+
+def test_get_task_trace(worker):
+    def traced_run(input_uri, *args):
+        with span("transcode", audio_s=60.0):
+            return {"real_time_factor": 0.2}
+
+    with worker(traced_run) as client:
+        assert wait_for(lambda: client.get("/health/ready").status_code == 200)
+        task_id = submit(client, "http://x/traced.mp3")
+        assert wait_for(lambda: api.all_tasks[task_id].status == api.Status.DONE)
+
+        events = client.get(f"/tasks/{task_id}/trace").json()["traceEvents"]
+        assert [e["name"] for e in events] == ["task", "transcode"]
+        assert events[0]["args"] == {"task_id": task_id}
+        otlp = client.get(f"/tasks/{task_id}/trace", params={"format": "otlp"})
+        assert len(otlp.json()["resourceSpans"][0]["scopeSpans"][0]["spans"]) == 2
+        assert client.get(f"/tasks/{task_id}/trace?format=x").status_code == 400
+        assert client.get("/tasks/unknown/trace").status_code == 404
+
+
+def test_callback_url(worker, mocker):
+    gate = threading.Event()
+
+    def gated_run(input_uri, *args):
+        gate.wait(5)
+        return {"real_time_factor": 0.2}
+
+    with worker(gated_run) as client:
+        notify = mocker.patch.object(api.webhooks, "notify")
+        assert wait_for(lambda: client.get("/health/ready").status_code == 200)
+        response = client.post(
+            "/tasks", json={"input_uri": "http://x/a.mp3", "callback_url": "ftp://x"}
+        )
+        assert response.status_code == 400
+
+        task_id = client.post(
+            "/tasks",
+            json={"input_uri": "http://x/a.mp3", "callback_url": "http://client/a"},
+        ).json()["task_id"]
+        # an identical submission is attached, its callback_url notified too
+        client.post(
+            "/tasks",
+            json={"input_uri": "http://x/a.mp3", "callback_url": "http://client/b"},
+        )
+        gate.set()
+        assert wait_for(lambda: notify.call_count == 2)
+        assert [c.args[0] for c in notify.call_args_list] == [
+            "http://client/a",
+            "http://client/b",
+        ]
+        payload = notify.call_args.args[1]
+        assert payload["id"] == task_id
+        assert payload["status"] == "DONE"
+        assert payload["response"] == {"real_time_factor": 0.2}
+
+        # attached after it's done: notified right away
+        client.post(
+            "/tasks",
+            json={"input_uri": "http://x/a.mp3", "callback_url": "http://client/c"},
+        )
+        assert notify.call_args.args[0] == "http://client/c"
+        assert client.get("/webhooks").json()["data"] == {"PENDING": 0, "FAILED": 0}
+
+
+def test_get_asset_words(worker, mocker):
+    with worker(lambda *args: {}) as client:
+        assert wait_for(lambda: client.get("/health/ready").status_code == 200)
+        align_asset = mocker.patch(
+            "api.align_asset",
+            return_value=[
+                {"id": 2, "start": 5.0, "end": 10.0, "text": "woord", "words": []}
+            ],
+        )
+        response = client.get("/assets/asset/words", params={"start_s": 6})
+        assert response.json()["data"][0]["id"] == 2
+        assert align_asset.call_args.args[2:] == (6.0, math.inf)
+        align_asset.side_effect = FileNotFoundError("No Whisper transcript")
+        assert client.get("/assets/unknown/words").status_code == 404
+
+
+def test_profile(worker, mocker, tmp_path):
+    with worker(lambda *args: {"real_time_factor": 0.2}) as client:
+        assert wait_for(lambda: client.get("/health/ready").status_code == 200)
+        request = {"input_uri": "http://x/a.mp3", "profile": True}
+        assert client.post("/tasks", json=request).status_code == 400
+
+        mocker.patch("api.PROFILING_ENABLED", True)
+        mocker.patch("api.DATA_BASE_DIR", str(tmp_path))
+        task_id = client.post("/tasks", json=request).json()["task_id"]
+        assert wait_for(
+            lambda: client.get(f"/tasks/{task_id}").json()["data"]["status"] == "DONE"
+        )
+        response = client.get(f"/tasks/{task_id}").json()["data"]["response"]
+        assert response["real_time_factor"] == 0.2
+        assert response["profile"] == [
+            os.path.join(tmp_path, "a", "cpu-profile.folded")
+        ]
+        assert os.path.exists(response["profile"][0])
+
+
+def run_until_cancelled(input_uri, output_uri, model, staged_file, on_progress, cancel):
+    while True:
+        on_progress("asr", 0.5)
+        cancel.check()
+        time.sleep(0.01)
+
+
+def test_delete_cancels_running_task(worker, mocker):
+    with worker(run_until_cancelled) as client:
+        notify = mocker.patch.object(api.webhooks, "notify")
+        assert wait_for(lambda: client.get("/health/ready").status_code == 200)
+        task_id = client.post(
+            "/tasks",
+            json={
+                "input_uri": "http://x/cancel.mp3",
+                "callback_url": "http://client/a",
+            },
+        ).json()["task_id"]
+        assert wait_for(lambda: task_id in api.cancel_tokens)
+
+        client.delete(f"/tasks/{task_id}")
+        assert wait_for(lambda: task_id not in api.cancel_tokens)
+        assert client.get("/status").status_code == 200
+        assert task_id not in api.all_tasks
+        # the client removed the task, so it's not told that it failed
+        notify.assert_not_called()
+
+
+def test_drain_requeues_tasks(worker, mocker):
+    mocker.patch("api.DRAIN_TIMEOUT_S", 0.1)
+    with worker(run_until_cancelled) as client:
+        assert wait_for(lambda: client.get("/health/ready").status_code == 200)
+        running_id = submit(client, "http://x/running.mp3")
+        assert wait_for(lambda: running_id in api.cancel_tokens)
+        queued_id = submit(client, "http://x/queued.mp3")
+    # leaving the client drained the worker
+    assert (
+        client.post("/tasks", json={"input_uri": "http://x/late.mp3"}).status_code
+        == 503
+    )
+    with open(api.QUEUE_FILE) as f:
+        saved = {entry["task"]["id"]: entry["task"] for entry in json.load(f)}
+    assert set(saved) == {running_id, queued_id}
+    assert saved[running_id]["status"] == "CREATED"
+
+    # after a restart the tasks are queued again
+    mocker.patch("api.all_tasks", {})
+    mocker.patch("api.scheduler", api.Scheduler("sjf"))
+    api.restore_queue()
+    assert set(api.scheduler.jobs) == {running_id, queued_id}
+    assert api.all_tasks[queued_id].input_uri == "http://x/queued.mp3"
+    assert not os.path.exists(api.QUEUE_FILE)
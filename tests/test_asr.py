@@ -0,0 +1,52 @@
+import os
+
+# Mocking environment used in asr
+os.environ["DATA_BASE_DIR"] = "data"
+os.environ["MODEL_BASE_DIR"] = "tests/input/extract_model_test"
+
+from asr import _get_audio, asr_already_done  # noqa
+from base_util import CancelToken  # noqa
+from daan_transcript import find_whisper_transcript, load_whisper_transcript  # noqa
+from transcode import TranscodeResult  # noqa
+from transcript_format import encode_whisper_transcript  # noqa
+
+
+# the first attempt streams the input, a retry (e.g. after the worker was
+# drained) downloads it into the input cache
+def test_input_streamed_only_once(tmp_path, mocker):
+    cache_dir = os.path.join(tmp_path, ".cache", "inputs")
+    mocker.patch("input_cache.CACHE_DIR", cache_dir)
+    mocker.patch("input_cache.STREAMED_DIR", os.path.join(cache_dir, ".streamed"))
+    mocker.patch("asr.STREAM_VIDEO_INPUT", True)
+    audio = TranscodeResult("asset_16k.wav", mocker.Mock(), 12)
+    try_stream_transcode = mocker.patch("asr.try_stream_transcode", return_value=audio)
+    download_uri = mocker.patch("asr.download_uri")
+    mocker.patch("asr.try_transcode", return_value=audio)
+
+    data_dir = os.path.join(tmp_path, "asset")
+    for _ in range(2):
+        _get_audio(
+            "http://x/asset.mp4",
+            "asset.mp4",
+            "asset",
+            ".mp4",
+            data_dir,
+            "",
+            [],
+            None,
+            CancelToken(),
+        )
+    try_stream_transcode.assert_called_once()
+    download_uri.assert_called_once_with(
+        "http://x/asset.mp4", data_dir, "asset.mp4", ".mp4"
+    )
+
+
+# e.g. written before TRANSCRIPT_LAYOUT and TRANSCRIPT_COMPRESSION were changed
+def test_transcript_with_another_encoding_is_found(tmp_path, whisper_transcript):
+    assert not asr_already_done(str(tmp_path))
+    with open(os.path.join(tmp_path, "whisper-transcript.ndjson.gz"), "wb") as f:
+        f.write(encode_whisper_transcript(whisper_transcript, "ndjson", False, "gzip"))
+    assert asr_already_done(str(tmp_path))
+    assert find_whisper_transcript(str(tmp_path)) == "whisper-transcript.ndjson.gz"
+    assert load_whisper_transcript(str(tmp_path)) == whisper_transcript
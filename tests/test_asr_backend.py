@@ -0,0 +1,142 @@
+import os
+import pytest
+import shutil
+import sys
+import time
+import wave
+from typing import Iterator
+
+# Mocking environment used in asr_backend
+os.environ["DATA_BASE_DIR"] = "data"
+os.environ["MODEL_BASE_DIR"] = "tests/input/extract_model_test"
+
+from asr_backend import (  # noqa
+    AsrBackend,
+    Segment,
+    StubBackend,
+    get_audio_duration,
+    get_backend,
+    read_audio,
+)
+from base_util import CancelToken, TaskCancelled  # noqa
+from whisper import run_asr  # noqa
+
+
+def write_wav(path: str, duration_s: float):
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(16000)
+        f.writeframes(b"\x00\x00" * int(duration_s * 16000))
+
+
+@pytest.fixture
+def wav_file(tmp_path) -> str:
+    path = os.path.join(tmp_path, "stub-test.wav")
+    write_wav(path, 12)
+    return path
+
+
+def test_stub_backend(wav_file):
+    backend = StubBackend(real_time_factor=0.02, memory_bytes=1024)
+    start_time = time.time()
+    segments = list(backend.transcribe(wav_file))
+    assert time.time() - start_time >= 12 * 0.02
+    assert [(s.start, s.end) for s in segments] == [(0, 5), (5, 10), (10, 12)]
+    assert segments[2].words[-1].end == 12
+    assert segments == list(backend.transcribe(wav_file))  # deterministic
+    assert backend.resource_info() == {
+        "backend": "stub",
+        "device": "cpu",
+        "real_time_factor": 0.02,
+        "memory_bytes": 1024,
+    }
+
+
+def test_get_backend():
+    assert isinstance(get_backend("stub", "", "large-v2", "cuda"), StubBackend)
+
+
+def test_get_audio_duration(wav_file):
+    assert get_audio_duration(wav_file) == 12
+
+
+def test_run_asr_with_stub(wav_file, tmp_path):
+    output_dir = os.path.join(tmp_path, "output")
+    progress = []
+    provenance, transcript = run_asr(
+        wav_file,
+        output_dir,
+        "stub-test",
+        StubBackend(real_time_factor=0),
+        12,
+        lambda stage, fraction: progress.append(fraction),
+    )
+    assert transcript.carrier_id == "stub-test"
+    assert len(transcript.segments) == 3
+    assert progress[-1] == 1.0
+    assert os.path.exists(provenance.output_data)
+
+
+def test_gpu_measure_stopped_when_cancelled(wav_file, tmp_path, mocker):
+    gpu_measure = mocker.MagicMock()
+    gpu_measure.GpuMemoryMeasure.return_value.stop_measure_gpu_mem.return_value = (
+        1,
+        2,
+    )
+    mocker.patch.dict(sys.modules, {"gpu_measure": gpu_measure})
+    model = StubBackend(real_time_factor=0)
+    model.device = "cuda"
+    cancel = CancelToken()
+
+    def cancel_after_first_segment(stage, fraction):
+        cancel.cancel("deleted")
+
+    with pytest.raises(TaskCancelled):
+        run_asr(
+            wav_file,
+            str(tmp_path),
+            "stub-test",
+            model,
+            12,
+            cancel_after_first_segment,
+            cancel=cancel,
+        )
+    measure = gpu_measure.GpuMemoryMeasure.return_value
+    measure.start_measure_gpu_mem.assert_called_once()
+    measure.stop_measure_gpu_mem.assert_called_once()
+
+
+# the whole pipeline (but the download) on any machine with ffmpeg
+@pytest.mark.skipif(not shutil.which("ffprobe"), reason="needs ffmpeg")
+def test_pipeline_with_stub(wav_file, tmp_path, mocker):
+    from asr import run
+
+    mocker.patch("asr.DATA_BASE_DIR", str(tmp_path))
+    mocker.patch("base_util.DATA_BASE_DIR", str(tmp_path))  # the asset lock
+    outputs = run(
+        "upload://0123/stub-test.wav",
+        "",
+        StubBackend(real_time_factor=0),
+        wav_file,
+    )
+    assert outputs["audio_duration_s"] == 12
+    asset_dir = os.path.join(tmp_path, "stub-test")
+    for filename in ["whisper_transcript", "daan_transcript", "provenance"]:
+        assert os.path.exists(os.path.join(asset_dir, outputs[filename]))
+
+
+def test_read_audio(wav_file):
+    audio = read_audio(wav_file, 5.0, 7.5)
+    assert audio.shape == (40000,)
+    assert audio.dtype.name == "float32"
+    assert read_audio(wav_file, 10.0, 15.0).shape == (32000,)  # until the end
+
+
+def test_incomplete_backend_is_not_created():
+    class NoAlignBackend(AsrBackend):
+        def transcribe(self, audio_file: str) -> Iterator[Segment]:
+            return iter([])
+
+    with pytest.raises(TypeError):
+        NoAlignBackend()  # type: ignore[abstract]
@@ -0,0 +1,67 @@
+import os
+import sys
+import threading
+import time
+
+# Mocking environment used in base_util
+os.environ["DATA_BASE_DIR"] = "data"
+os.environ["MODEL_BASE_DIR"] = "tests/input/extract_model_test"
+
+from base_util import file_lock, run_command  # noqa
+
+
+def test_file_lock_is_exclusive(tmp_path):
+    lock_file = os.path.join(tmp_path, ".locks", "asset.lock")
+    events = []
+
+    def hold_lock(name: str):
+        with file_lock(lock_file):
+            events.append(f"{name}-start")
+            time.sleep(0.1)
+            events.append(f"{name}-end")
+
+    threads = [threading.Thread(target=hold_lock, args=(n,)) for n in ["a", "b"]]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(events) == 4
+    # the second holder only starts after the first one released the lock
+    assert events[0][0] == events[1][0]
+    assert events[2][0] == events[3][0]
+
+
+def test_run_command_returns_stdout():
+    success, output = run_command([sys.executable, "-c", "print('hello world')"])
+    assert success
+    assert output == "hello world\n"
+
+
+def test_run_command_passes_lines_to_callback():
+    lines = []
+    success, output = run_command(
+        [sys.executable, "-c", "print('progress=1'); print('progress=end')"],
+        on_output_line=lines.append,
+    )
+    assert success
+    assert output == ""
+    assert lines == ["progress=1", "progress=end"]
+
+
+def test_run_command_keeps_tail_of_stderr():
+    script = "import sys\nfor i in range(10000): print(i, file=sys.stderr)\nsys.exit(3)"
+    success, output = run_command([sys.executable, "-c", script], max_stderr_bytes=1000)
+    assert not success
+    assert len(output) <= 1000
+    assert output.endswith("9999\n")
+
+
+def test_run_command_kills_on_timeout():
+    start_time = time.time()
+    success, output = run_command(
+        [sys.executable, "-c", "import time; time.sleep(30)"], timeout_s=0.5
+    )
+    assert not success
+    assert "timeout" in output
+    assert time.time() - start_time < 10
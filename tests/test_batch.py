@@ -0,0 +1,61 @@
+import json
+import os
+import pytest
+
+# Mocking environment used in batch
+os.environ["DATA_BASE_DIR"] = "data"
+os.environ["MODEL_BASE_DIR"] = "tests/input/extract_model_test"
+
+from batch import STATE_FILE, read_manifest, run_batch  # noqa
+from download import DownloadResult  # noqa
+
+
+def test_read_manifest(tmp_path):
+    manifest_file = os.path.join(tmp_path, "manifest.txt")
+    with open(manifest_file, "w") as f:
+        f.write("# programme ids\n2101608150135908431\n\ns3://bucket/other.mp3\n")
+    assert read_manifest(manifest_file, "s3://bucket/{id}.mp4") == [
+        "s3://bucket/2101608150135908431.mp4",
+        "s3://bucket/other.mp3",
+    ]
+    with pytest.raises(ValueError):
+        read_manifest(manifest_file)
+
+
+def test_run_batch_resumes(mocker, tmp_path):
+    manifest_file = os.path.join(tmp_path, "manifest.txt")
+    with open(manifest_file, "w") as f:
+        f.write("s3://bucket/a.mp3\ns3://bucket/b.mp3\ns3://bucket/c.mp3\n")
+    run_dir = os.path.join(tmp_path, "run")
+    os.makedirs(run_dir)
+    with open(os.path.join(run_dir, STATE_FILE), "w") as f:
+        f.write(json.dumps({"input_uri": "s3://bucket/a.mp3", "status": "DONE"}))
+        f.write("\n")
+
+    mocker.patch("batch.load_model", return_value=None)
+    mocker.patch(
+        "batch.download_uri",
+        side_effect=lambda uri, input_dir, fn, ext: DownloadResult(
+            os.path.join(input_dir, fn), "audio/mpeg", None  # type: ignore
+        ),
+    )
+    run = mocker.patch(
+        "batch.run",
+        side_effect=[
+            {"audio_duration_s": 100.0, "real_time_factor": 0.1},
+            Exception("Could not download"),
+        ],
+    )
+    mocker.patch("batch.DATA_BASE_DIR", str(tmp_path))
+
+    summary = run_batch(manifest_file, run_dir, concurrency=2)
+
+    assert [c.args[0] for c in run.call_args_list] == [
+        "s3://bucket/b.mp3",
+        "s3://bucket/c.mp3",
+    ]
+    assert summary["total"] == 3
+    assert summary["skipped"] == 1
+    assert summary["done"] == 1
+    assert summary["failed"][0]["input_uri"] == "s3://bucket/c.mp3"
+    assert summary["real_time_factor"] == pytest.approx(0.1)
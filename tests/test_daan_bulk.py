@@ -0,0 +1,76 @@
+import boto3
+import json
+import os
+import shutil
+from moto import mock_aws
+
+# Mocking environment used in daan_bulk
+os.environ["DATA_BASE_DIR"] = "data"
+os.environ["MODEL_BASE_DIR"] = "tests/input/extract_model_test"
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+from config import WHISPER_JSON_FILE  # noqa
+from daan_bulk import convert_all, find_local_jobs, find_s3_jobs  # noqa
+
+
+def test_convert_all_local_tree(tmp_path):
+    for asset_id in ["asset-1", "asset-2"]:
+        os.makedirs(os.path.join(tmp_path, "tree", asset_id))
+        shutil.copy(
+            "data/whisper-test/whisper-transcript.json",
+            os.path.join(tmp_path, "tree", asset_id, "whisper-transcript.json"),
+        )
+    root = os.path.join(tmp_path, "tree")
+    state_file = os.path.join(tmp_path, "state.json")
+
+    summary = convert_all(root, state_file, workers=2)
+    assert summary["converted"] == 2
+    assert summary["failed"] == []
+    assert summary["words"] > 0
+    with open("data/whisper-test/daan-es-transcript.json") as f:
+        expected = json.load(f)
+    with open(os.path.join(root, "asset-1", "daan-es-transcript.json")) as f:
+        assert json.load(f) == expected
+    assert os.path.exists(os.path.join(root, "asset-2", "word-index.bin"))
+
+    # unchanged Whisper transcripts are not converted again
+    summary = convert_all(root, state_file, workers=2)
+    assert summary["converted"] == 0
+    assert summary["skipped"] == 2
+
+
+# transcripts written with another layout or compression are converted too, the
+# one with the current settings if an asset has both
+def test_finds_transcripts_of_any_encoding(tmp_path):
+    for asset_id, filenames in [
+        ("asset-1", ["whisper-transcript.ndjson.gz"]),
+        ("asset-2", ["whisper-transcript.ndjson.gz", WHISPER_JSON_FILE]),
+    ]:
+        os.makedirs(os.path.join(tmp_path, asset_id))
+        for filename in filenames:
+            with open(os.path.join(tmp_path, asset_id, filename), "wb") as f:
+                f.write(b"")
+    jobs = sorted(job.source for job in find_local_jobs(str(tmp_path)))
+    assert jobs == [
+        os.path.join(tmp_path, "asset-1", "whisper-transcript.ndjson.gz"),
+        os.path.join(tmp_path, "asset-2", WHISPER_JSON_FILE),
+    ]
+
+
+def test_finds_s3_transcripts_of_any_encoding(mocker):
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="output")
+        mocker.patch("daan_bulk._s3_client", client)
+        for key in [
+            "assets/asset-1/whisper-transcript.ndjson.gz",
+            "assets/asset-2/whisper-transcript.ndjson.gz",
+            f"assets/asset-2/{WHISPER_JSON_FILE}",
+            "assets/asset-2/provenance.json",
+        ]:
+            client.put_object(Bucket="output", Key=key, Body=b"")
+        jobs = sorted(job.source for job in find_s3_jobs("s3://output/assets"))
+    assert jobs == [
+        "s3://output/assets/asset-1/whisper-transcript.ndjson.gz",
+        f"s3://output/assets/asset-2/{WHISPER_JSON_FILE}",
+    ]
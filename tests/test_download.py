@@ -0,0 +1,93 @@
+import asyncio
+import hashlib
+import os
+import threading
+
+# Mocking environment used in download
+os.environ["DATA_BASE_DIR"] = "data"
+os.environ["MODEL_BASE_DIR"] = "tests/input/extract_model_test"
+
+from download import (  # noqa
+    _write_chunk,
+    claim_staged_input,
+    get_stream_url,
+    http_download,
+    receive_upload,
+)
+
+
+async def _chunks(data: bytes, chunk_size: int):
+    for i in range(0, len(data), chunk_size):
+        yield data[i : i + chunk_size]
+
+
+def test_receive_and_claim_staged_input(tmp_path):
+    data = os.urandom(100_000)
+    upload = asyncio.run(
+        receive_upload(_chunks(data, 4096), os.path.join(tmp_path, ".uploads"))
+    )
+    assert upload.sha256 == hashlib.sha256(data).hexdigest()
+    assert upload.content_length == len(data)
+
+    input_dir = os.path.join(tmp_path, "asset")
+    dl_result = claim_staged_input(
+        upload.file_path, "upload://hash/asset.mp3", input_dir, "asset.mp3", ".mp3"
+    )
+    assert dl_result.file_path == os.path.join(input_dir, "asset.mp3")
+    assert dl_result.mime_type == "audio/mpeg"
+    assert dl_result.content_length == len(data)
+    assert not os.path.exists(upload.file_path)
+    with open(dl_result.file_path, "rb") as f:
+        assert f.read() == data
+
+
+# the event loop (i.e. the API) isn't blocked while the chunks are written
+def test_upload_written_off_the_event_loop(tmp_path, mocker):
+    threads = []
+
+    def record_thread(*args):
+        threads.append(threading.current_thread())
+        _write_chunk(*args)
+
+    mocker.patch("download._write_chunk", side_effect=record_thread)
+    data = os.urandom(10_000)
+    upload = asyncio.run(receive_upload(_chunks(data, 4096), str(tmp_path)))
+    assert upload.sha256 == hashlib.sha256(data).hexdigest()
+    assert len(threads) == 3
+    assert threading.main_thread() not in threads
+
+
+# e.g. a re-run after the transcode failed: the input in the asset dir (a hard
+# link to the cached input) is linked again, the rest of the asset dir is kept
+def test_download_keeps_asset_dir(tmp_path, mocker):
+    cache_dir = os.path.join(tmp_path, ".cache", "inputs")
+    mocker.patch("input_cache.CACHE_DIR", cache_dir)
+    mocker.patch("input_cache.LOCK_DIR", os.path.join(cache_dir, ".locks"))
+    mocker.patch("download.get_http_validator", return_value=("etag:1", 5))
+
+    def fetch(url: str, path: str):
+        with open(path, "wb") as f:
+            f.write(b"video")
+
+    http_fetch = mocker.patch("download._http_fetch", side_effect=fetch)
+    asset_dir = os.path.join(tmp_path, "asset")
+    http_download("http://x/asset.mp4", asset_dir, "asset.mp4", ".mp4")
+    with open(os.path.join(asset_dir, "provenance.json"), "w") as f:
+        f.write("{}")
+
+    result = http_download("http://x/asset.mp4", asset_dir, "asset.mp4", ".mp4")
+    assert http_fetch.call_count == 1  # from the cache
+    assert os.path.exists(os.path.join(asset_dir, "provenance.json"))
+    with open(result.file_path, "rb") as f:
+        assert f.read() == b"video"
+
+
+# ffmpeg reads the presigned URL for as long as the transcode runs
+def test_stream_url_outlives_the_transcode(mocker):
+    mocker.patch("download.FFMPEG_TIMEOUT_S", 4 * 3600)
+    s3_store = mocker.patch("download.S3Store")
+    get_stream_url("s3://bucket/asset.mp4")
+    generate_presigned_url = s3_store.return_value.generate_presigned_url
+    assert generate_presigned_url.call_args.args == ("bucket", "asset.mp4")
+    assert generate_presigned_url.call_args.kwargs["expires_in"] > 4 * 3600
+    assert get_stream_url("http://x/asset.mp4") == "http://x/asset.mp4"
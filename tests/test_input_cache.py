@@ -0,0 +1,129 @@
+import os
+import pytest
+
+# Mocking environment used in input_cache
+os.environ["DATA_BASE_DIR"] = "data"
+os.environ["MODEL_BASE_DIR"] = "tests/input/extract_model_test"
+
+import input_cache  # noqa
+from input_cache import (  # noqa
+    CacheStats,
+    fetch_input,
+    get_cache_stats,
+    is_cached,
+    mark_streamed,
+    was_streamed,
+)
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, mocker):
+    cache_dir = os.path.join(tmp_path, ".cache", "inputs")
+    mocker.patch("input_cache.CACHE_DIR", cache_dir)
+    mocker.patch("input_cache.LOCK_DIR", os.path.join(cache_dir, ".locks"))
+    mocker.patch("input_cache.STREAMED_DIR", os.path.join(cache_dir, ".streamed"))
+    mocker.patch("input_cache.INPUT_CACHE_MAX_BYTES", 250)
+    mocker.patch("input_cache.cache_stats", CacheStats())
+    return cache_dir
+
+
+def fetcher(data: bytes, fetched: list):
+    def fetch(path: str):
+        fetched.append(path)
+        with open(path, "wb") as f:
+            f.write(data)
+
+    return fetch
+
+
+def read(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_hit_miss_and_validation(tmp_path):
+    fetched: list = []
+    target = os.path.join(tmp_path, "asset", "input.mp4")
+    assert not fetch_input(
+        "s3://b/input.mp4", "etag:1", target, fetcher(b"v1", fetched)
+    )
+    assert not is_cached("s3://b/other.mp4") and is_cached("s3://b/input.mp4")
+
+    # e.g. a retry after the asset dir was cleaned up
+    os.remove(target)
+    assert fetch_input("s3://b/input.mp4", "etag:1", target, fetcher(b"v1", fetched))
+    assert read(target) == b"v1"
+    assert len(fetched) == 1
+
+    # the remote object changed
+    assert not fetch_input(
+        "s3://b/input.mp4", "etag:2", target, fetcher(b"v2", fetched)
+    )
+    assert read(target) == b"v2"
+    assert len(fetched) == 2
+
+    stats = get_cache_stats()
+    assert (stats["hits"], stats["misses"], stats["bytes_saved"]) == (1, 2, 2)
+    assert stats["entries"] == 1 and stats["bytes_cached"] == 2
+
+
+def test_lru_eviction(tmp_path):
+    fetched: list = []
+    for name in ["a", "b", "a", "c"]:  # b is the least recently used one
+        fetch_input(
+            f"http://x/{name}.mp4",
+            "etag:1",
+            os.path.join(tmp_path, "asset", f"{name}.mp4"),
+            fetcher(bytes(100), fetched),
+            content_length=100,
+        )
+    assert is_cached("http://x/a.mp4") and is_cached("http://x/c.mp4")
+    assert not is_cached("http://x/b.mp4")
+    # evicting doesn't affect the inputs that are in use
+    assert read(os.path.join(tmp_path, "asset", "b.mp4")) == bytes(100)
+    assert get_cache_stats()["evictions"] == 1
+
+
+def test_uncacheable(tmp_path, cache_dir):
+    fetched: list = []
+    target = os.path.join(tmp_path, "input.mp4")
+    fetch_input("http://x/a.mp4", "", target, fetcher(b"data", fetched))
+    fetch_input("http://x/b.mp4", "etag:1", target, fetcher(b"data", fetched), 1000)
+    assert fetched == [target, target]
+    assert get_cache_stats()["uncacheable"] == 2
+    assert not os.path.exists(cache_dir)
+
+
+def test_failed_fetch_leaves_no_entry(tmp_path):
+    def fail(path: str):
+        with open(path, "wb") as f:
+            f.write(b"partial")
+        raise ConnectionError()
+
+    with pytest.raises(ConnectionError):
+        fetch_input("http://x/a.mp4", "etag:1", os.path.join(tmp_path, "a"), fail)
+    assert not is_cached("http://x/a.mp4")
+    assert get_cache_stats()["entries"] == 0
+
+
+def test_streamed_once(tmp_path):
+    mark_streamed("http://x/a.mp4")
+    assert was_streamed("http://x/a.mp4") and not is_cached("http://x/a.mp4")
+    assert not was_streamed("http://x/b.mp4")
+
+    # the next run downloads it into the cache
+    target = os.path.join(tmp_path, "asset", "a.mp4")
+    fetch_input("http://x/a.mp4", "etag:1", target, fetcher(b"a", []))
+    assert is_cached("http://x/a.mp4") and not was_streamed("http://x/a.mp4")
+
+
+# the markers aren't cache entries, and only the most recent ones are kept
+def test_streamed_inputs_are_bounded(mocker):
+    mocker.patch("input_cache.STREAMED_MAX_INPUTS", 2)
+    for i, uri in enumerate(["http://x/a.mp4", "http://x/b.mp4"]):
+        mark_streamed(uri)
+        marker = os.path.join(input_cache.STREAMED_DIR, input_cache._get_key(uri))
+        os.utime(marker, (i, i))  # streamed one after the other
+    mark_streamed("http://x/c.mp4")
+    assert [was_streamed(f"http://x/{fn}.mp4") for fn in "abc"] == [False, True, True]
+    assert get_cache_stats()["entries"] == 0
@@ -0,0 +1,212 @@
+import os
+import pytest
+import threading
+import time
+
+# Mocking environment used in job_queue
+os.environ["DATA_BASE_DIR"] = "data"
+os.environ["MODEL_BASE_DIR"] = "tests/input/extract_model_test"
+
+from base_util import TaskCancelled  # noqa
+from job_queue import (  # noqa
+    JobQueue,
+    JobStatus,
+    SQLiteJobQueue,
+    enqueue_manifest,
+    get_job_queue,
+    run_queue_worker,
+)
+
+
+@pytest.fixture
+def queue(tmp_path) -> SQLiteJobQueue:
+    return SQLiteJobQueue(os.path.join(tmp_path, "queue.db"), max_attempts=2)
+
+
+def get_status(queue: SQLiteJobQueue, job_id: str) -> str:
+    row = (
+        queue._connect()
+        .execute("SELECT status FROM jobs WHERE id = ?", (job_id,))
+        .fetchone()
+    )
+    return row[0]
+
+
+def test_lease_and_complete(queue):
+    first = queue.put("http://x/first.mp3", "s3://bucket/first")
+    queue.put("http://x/second.mp3")
+    job = queue.lease("worker-1", 60)
+    assert (job.id, job.output_uri, job.attempts) == (first, "s3://bucket/first", 1)
+    assert queue.lease("worker-2", 60).input_uri == "http://x/second.mp3"
+    assert queue.lease("worker-3", 60) is None  # both are leased
+    assert queue.extend(job, 60)
+    assert queue.complete(job, {"audio_duration_s": 1.0})
+    assert queue.get_counts() == {"QUEUED": 0, "LEASED": 1, "DONE": 1, "FAILED": 0}
+
+
+def test_expired_lease_is_taken_over(queue):
+    queue.put("http://x/input.mp3")
+    job = queue.lease("worker-1", -1)  # as if worker-1 died
+    taken_over = queue.lease("worker-2", 60)
+    assert taken_over.id == job.id and taken_over.attempts == 2
+    assert not queue.extend(job, 60)  # so worker-1 would cancel its run
+    assert not queue.complete(job, {})
+    assert queue.complete(taken_over, {})
+
+
+def test_job_fails_after_max_attempts(queue):
+    job_id = queue.put("http://x/input.mp3")
+    assert queue.release(queue.lease("worker-1", 60), "Broken input")
+    assert get_status(queue, job_id) == JobStatus.QUEUED.value
+    assert queue.release(queue.lease("worker-1", 60), "Broken input")
+    assert get_status(queue, job_id) == JobStatus.FAILED.value
+    assert queue.lease("worker-1", 60) is None
+
+
+def test_job_whose_workers_keep_dying_fails(queue):
+    job_id = queue.put("http://x/input.mp3")
+    queue.lease("worker-1", -1)
+    queue.lease("worker-2", -1)
+    assert queue.lease("worker-3", 60) is None
+    assert get_status(queue, job_id) == JobStatus.FAILED.value
+
+
+def test_release_without_error_does_not_count(queue):
+    queue.put("http://x/input.mp3")
+    for _ in range(3):  # more than max_attempts
+        job = queue.lease("worker-1", 60)
+        assert job.attempts == 1
+        assert queue.release(job)
+
+
+def test_concurrent_leases_are_exclusive(tmp_path):
+    path = os.path.join(tmp_path, "queue.db")
+    for i in range(40):
+        SQLiteJobQueue(path).put(f"http://x/{i}.mp3")
+    leased = []
+
+    def work():
+        queue = SQLiteJobQueue(path)  # like a worker process of its own
+        while job := queue.lease(threading.current_thread().name, 60):
+            leased.append(job.id)
+            queue.complete(job, {})
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(leased) == len(set(leased)) == 40
+
+
+def test_get_job_queue(tmp_path):
+    path = os.path.join(tmp_path, "queue.db")
+    assert isinstance(get_job_queue(f"sqlite://{path}"), SQLiteJobQueue)
+    assert os.path.exists(path)
+    with pytest.raises(ValueError):
+        get_job_queue("redis://127.0.0.1/0")
+
+
+def test_incomplete_queue_is_not_created():
+    class PutOnlyQueue(JobQueue):
+        def put(self, input_uri: str, output_uri: str = "") -> str:
+            return ""
+
+    with pytest.raises(TypeError):
+        PutOnlyQueue()  # type: ignore[abstract]
+
+
+def test_enqueue_manifest(queue, tmp_path):
+    manifest = os.path.join(tmp_path, "manifest.txt")
+    with open(manifest, "w") as f:
+        f.write("id-1\n# comment\nid-2\n")
+    count = enqueue_manifest(
+        queue, manifest, "s3://input/{id}.mp4", "s3://output/{asset_id}"
+    )
+    assert count == 2
+    assert queue.lease("worker-1", 60).output_uri == "s3://output/id-1"
+
+
+def test_worker_completes_and_releases_jobs(queue, mocker):
+    def run(input_uri, output_uri, model, cancel):
+        if "broken" in input_uri:
+            raise ValueError("Broken input")
+        return {"audio_duration_s": 1.0}
+
+    mocker.patch("job_queue.run", side_effect=run)
+    queue.put("http://x/good.mp3")
+    broken = queue.put("http://x/broken.mp3")
+    counts = run_queue_worker(queue, exit_when_empty=True, model="model")
+    # the broken job is retried until it has no attempts left
+    assert counts == {"done": 1, "failed": 2}
+    assert get_status(queue, broken) == JobStatus.FAILED.value
+
+
+def test_worker_extends_its_lease(queue, mocker):
+    mocker.patch("job_queue.JOB_QUEUE_LEASE_S", 0.3)
+    extend = mocker.spy(queue, "extend")
+
+    def run(input_uri, output_uri, model, cancel):
+        time.sleep(0.5)  # longer than the lease
+        return {}
+
+    mocker.patch("job_queue.run", side_effect=run)
+    job_id = queue.put("http://x/input.mp3")
+    assert run_queue_worker(queue, exit_when_empty=True, model="model")["done"] == 1
+    assert extend.call_count >= 1
+    assert get_status(queue, job_id) == JobStatus.DONE.value
+
+
+def test_worker_cancels_run_when_lease_is_lost(queue, mocker):
+    mocker.patch("job_queue.JOB_QUEUE_LEASE_S", 0.3)
+    mocker.patch.object(queue, "extend", return_value=False)
+
+    def run(input_uri, output_uri, model, cancel):
+        cancel.event.wait(5)
+        cancel.check()
+
+    mocker.patch("job_queue.run", side_effect=run)
+    queue.put("http://x/input.mp3")
+    start_time = time.time()
+    assert run_queue_worker(queue, exit_when_empty=True, model="model") == {
+        "done": 0,
+        "failed": 1,
+    }
+    assert time.time() - start_time < 5
+
+
+def test_stopped_worker_releases_its_job(queue, mocker):
+    mocker.patch("job_queue.JOB_QUEUE_LEASE_S", 0.3)
+    mocker.patch("job_queue.DRAIN_TIMEOUT_S", 0)
+    stop = threading.Event()
+
+    def run(input_uri, output_uri, model, cancel):
+        stop.set()  # e.g. SIGTERM
+        cancel.event.wait(5)
+        raise TaskCancelled(cancel.reason, cancel.keep_output)
+
+    mocker.patch("job_queue.run", side_effect=run)
+    job_id = queue.put("http://x/input.mp3")
+    run_queue_worker(queue, stop, model="model")
+    assert get_status(queue, job_id) == JobStatus.QUEUED.value
+    assert queue.lease("worker-2", 60).attempts == 1
+
+
+def test_drain_does_not_wait_for_the_next_extension(queue, mocker):
+    mocker.patch("job_queue.JOB_QUEUE_LEASE_S", 60)
+    mocker.patch("job_queue.DRAIN_TIMEOUT_S", 0.2)
+    mocker.patch("job_queue.STOP_CHECK_INTERVAL_S", 0.05)
+    stop = threading.Event()
+
+    def run(input_uri, output_uri, model, cancel):
+        stop.set()
+        cancel.event.wait(5)
+        raise TaskCancelled(cancel.reason, cancel.keep_output)
+
+    mocker.patch("job_queue.run", side_effect=run)
+    job_id = queue.put("http://x/input.mp3")
+    start_time = time.time()
+    run_queue_worker(queue, stop, model="model")
+    # cancelled at the deadline, not at the extension after it (20s)
+    assert time.time() - start_time < 1
+    assert get_status(queue, job_id) == JobStatus.QUEUED.value
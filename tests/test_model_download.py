@@ -1,3 +1,5 @@
+import hashlib
+import io
 import tarfile
 import pytest
 import shutil
@@ -8,7 +10,27 @@ os.environ["DATA_BASE_DIR"] = "data"
 os.environ["MODEL_BASE_DIR"] = "tests/input/extract_model_test"
 os.environ["S3_ENDPOINT_URL"] = "http://url.com"
 
-from model_download import extract_model, get_model_location  # noqa
+from model_download import (  # noqa
+    check_http_location,
+    extract_model,
+    get_model_location,
+    install_model,
+    is_installed,
+)
+
+
+# a gzipped model archive with model.bin and (optionally) a SHA256SUMS manifest
+def create_model_archive(model_bin: bytes, manifest_sha256: str = "") -> bytes:
+    files = {"./model.bin": model_bin, "./config.json": b"{}"}
+    if manifest_sha256:
+        files["./SHA256SUMS"] = f"{manifest_sha256}  model.bin\n".encode()
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return archive.getvalue()
 
 
 @pytest.mark.parametrize(
@@ -68,6 +90,47 @@ def test_get_model_location(whisper_model, expected_output, mocker):
     assert get_model_location("model", whisper_model) == expected_output
 
 
-# TODO: test check_s3_location (have to mock: S3Store, s3.dl_file, extract_model)
+def test_install_model_verifies_manifest(tmp_path):
+    destination = os.path.join(tmp_path, "model")
+    sha256 = hashlib.sha256(b"weights").hexdigest()
+    archive = create_model_archive(b"weights", sha256)
+    assert install_model(io.BytesIO(archive), destination) == destination
+    assert is_installed(destination)
+    with open(os.path.join(destination, "model.bin"), "rb") as f:
+        assert f.read() == b"weights"
+
+    shutil.rmtree(destination)
+    archive = create_model_archive(b"corrupted", sha256)
+    with pytest.raises(Exception, match="Checksum mismatch"):
+        install_model(io.BytesIO(archive), destination)
+    assert not os.path.exists(destination)
+    assert os.listdir(tmp_path) == []  # no temporary dir left behind
+
+
+def test_install_model_replaces_incomplete_model(tmp_path):
+    destination = os.path.join(tmp_path, "model")
+    os.makedirs(destination)  # e.g. left behind by a crash during extraction
+    with open(os.path.join(destination, "model.bin"), "wb") as f:
+        f.write(b"wei")
+    assert not is_installed(destination)
+    install_model(io.BytesIO(create_model_archive(b"weights")), destination)
+    with open(os.path.join(destination, "model.bin"), "rb") as f:
+        assert f.read() == b"weights"
+
+
+def test_check_http_location(tmp_path, mocker):
+    response = mocker.MagicMock(status_code=200)
+    response.raw = io.BytesIO(create_model_archive(b"weights"))
+    get = mocker.patch("model_download.requests.get")
+    get.return_value.__enter__.return_value = response
+    model_uri = "http://model-hosting.beng.nl/whisper-test.tar.gz"
+
+    expected_output = os.path.join(tmp_path, "whisper-test.tar")  # see get_asset_info
+    assert check_http_location(str(tmp_path), model_uri) == expected_output
+    assert is_installed(expected_output)
+    # the second time the installed model is used
+    assert check_http_location(str(tmp_path), model_uri) == expected_output
+    assert get.call_count == 1
+
 
-# TODO: test check_http_location (have to mock: whole "with" block?, extract_model)
+# TODO: test check_s3_location (have to mock: S3Store.client.get_object)
@@ -0,0 +1,82 @@
+import boto3
+import os
+import pytest
+from moto import mock_aws
+
+# Mocking environment used in output_sink
+os.environ["DATA_BASE_DIR"] = "data"
+os.environ["MODEL_BASE_DIR"] = "tests/input/extract_model_test"
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+from output_sink import LocalSink, OutputSink, S3Sink, get_content_type  # noqa
+from s3_util import S3Store  # noqa
+
+
+@pytest.fixture
+def s3_client(mocker):
+    mocker.patch("output_sink.OUTPUT_S3_ENDPOINT_URL", "https://s3.amazonaws.com")
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="output")
+        yield client
+
+
+def test_local_sink(tmp_path):
+    sink = LocalSink(os.path.join(tmp_path, "asset"))
+    sink.put("whisper-transcript.json", b"{}")
+    sink.close()
+    with open(os.path.join(tmp_path, "asset", "whisper-transcript.json"), "rb") as f:
+        assert f.read() == b"{}"
+
+
+def test_s3_sink(s3_client):
+    sink = S3Sink("s3://output/assets/asset")
+    sink.put("whisper-transcript.json.gz", b"data")
+    sink.close()
+    obj = s3_client.get_object(
+        Bucket="output", Key="assets/asset/whisper-transcript.json.gz"
+    )
+    assert obj["Body"].read() == b"data"
+    assert obj["ContentType"] == "application/gzip"
+    assert sink.location("x.json") == "s3://output/assets/asset/x.json"
+
+
+def test_s3_sink_failed_upload(s3_client, mocker):
+    mocker.patch("s3_util.time.sleep")
+    sink = S3Sink("s3://no-such-bucket/asset")
+    sink.put("provenance.json", b"{}")
+    with pytest.raises(Exception):
+        sink.close()
+
+
+def test_upload_bytes_retries(mocker):
+    mocker.patch("s3_util.time.sleep")
+    s3 = S3Store("https://s3.amazonaws.com", "key", "secret")
+    upload = mocker.patch.object(
+        s3.client,
+        "upload_fileobj",
+        side_effect=[ConnectionError(), ConnectionError(), None],
+    )
+    s3.upload_bytes("output", "asset/provenance.json", b"{}", retries=2)
+    assert upload.call_count == 3
+
+    upload.reset_mock(side_effect=True)
+    upload.side_effect = ConnectionError()
+    with pytest.raises(ConnectionError):
+        s3.upload_bytes("output", "asset/provenance.json", b"{}", retries=2)
+    assert upload.call_count == 3
+
+
+def test_get_content_type():
+    assert get_content_type("daan-es-transcript.json") == "application/json"
+    assert get_content_type("whisper-transcript.ndjson") == "application/x-ndjson"
+    assert get_content_type("whisper-transcript.ndjson.zst") == "application/zstd"
+
+
+def test_incomplete_sink_is_not_created():
+    class NoLocationSink(OutputSink):
+        def put(self, filename: str, data: bytes):
+            pass
+
+    with pytest.raises(TypeError):
+        NoLocationSink()  # type: ignore[abstract]
@@ -0,0 +1,95 @@
+import inspect
+import os
+import threading
+import time
+import tracemalloc
+
+# Mocking environment used in profiler
+os.environ["DATA_BASE_DIR"] = "data"
+os.environ["MODEL_BASE_DIR"] = "tests/input/extract_model_test"
+
+from profiler import (  # noqa
+    CPU_PROFILE_FILE,
+    MEMORY_PROFILE_FILE,
+    SamplingProfiler,
+    profile_run,
+    save_profile,
+)
+
+
+def busy(duration_s: float):
+    end_time = time.time() + duration_s
+    while time.time() < end_time:
+        pass
+
+
+def allocate() -> list:
+    return [bytearray(1024) for _ in range(2000)]
+
+
+def get_folded(data: bytes) -> dict:
+    return {
+        stack: int(count)
+        for stack, count in (line.rsplit(" ", 1) for line in data.decode().splitlines())
+    }
+
+
+def test_samples_the_profiled_threads():
+    idle = threading.Event()
+    existing_thread = threading.Thread(target=idle.wait, name="existing")
+    existing_thread.start()
+    with profile_run(True) as profiler:
+        upload = threading.Thread(target=busy, args=(0.2,), name="upload")
+        upload.start()
+        busy(0.2)
+        upload.join()
+    idle.set()
+
+    folded = get_folded(profiler.to_folded())
+    busy_stacks = [s for s in folded if s.split(";")[-1].startswith("busy ")]
+    assert {s.split(";")[0] for s in busy_stacks} == {"MainThread", "upload"}
+    assert sum(folded[s] for s in busy_stacks) > 10
+    assert not any(s.startswith("existing") for s in folded)
+
+
+def test_memory_snapshot_at_the_peak():
+    with profile_run(True, memory=True) as profiler:
+        allocated = allocate()
+        profiler.take_snapshot(force=True)
+        del allocated
+    assert not tracemalloc.is_tracing()
+
+    outputs = profiler.get_outputs()
+    assert set(outputs) == {CPU_PROFILE_FILE, MEMORY_PROFILE_FILE}
+    folded = get_folded(outputs[MEMORY_PROFILE_FILE])
+    # the frames are file:line, the lines of allocate() are its frame
+    lines, first_line = inspect.getsourcelines(allocate)
+    allocate_frames = {
+        f"test_profiler.py:{line}"
+        for line in range(first_line, first_line + len(lines))
+    }
+    allocated_bytes = sum(
+        count
+        for stack, count in folded.items()
+        if stack.split(";")[-1] in allocate_frames
+    )
+    assert allocated_bytes >= 2000 * 1024
+
+
+def test_disabled_profile_does_nothing():
+    with profile_run(False) as profiler:
+        pass
+    assert profiler is None
+
+
+def test_save_profile(tmp_path):
+    profiler = SamplingProfiler(interval_s=0.001)
+    profiler.start()
+    busy(0.05)
+    profiler.stop()
+    data_dir = os.path.join(tmp_path, "asset")
+    assert save_profile(profiler, data_dir, "") == [
+        os.path.join(data_dir, CPU_PROFILE_FILE)
+    ]
+    with open(os.path.join(data_dir, CPU_PROFILE_FILE), "rb") as f:
+        assert f.read() == profiler.to_folded()
@@ -0,0 +1,104 @@
+import os
+import pytest
+
+# Mocking environment used in scheduler
+os.environ["DATA_BASE_DIR"] = "data"
+os.environ["MODEL_BASE_DIR"] = "tests/input/extract_model_test"
+
+from scheduler import (  # noqa
+    JobCost,
+    QueuedJob,
+    Scheduler,
+    estimate_cost,
+    get_budget_error,
+)
+
+GiB = 1024**3
+
+
+def get_jobs():
+    return [
+        QueuedJob("long", submitted_unix=0, cost=JobCost(GiB, 36000)),
+        QueuedJob("short", submitted_unix=3700, cost=JobCost(1024**2, 30)),
+        QueuedJob("medium", submitted_unix=3800, cost=JobCost(100 * 1024**2, 600)),
+    ]
+
+
+@pytest.mark.parametrize(
+    "policy, expected_order",
+    [
+        ("fifo", ["long", "short", "medium"]),
+        ("sjf", ["short", "medium", "long"]),
+        # having waited longer than its own processing time, the long job goes first
+        ("aging", ["long", "short", "medium"]),
+    ],
+)
+def test_order(policy, expected_order):
+    scheduler = Scheduler(policy)
+    for job in get_jobs():
+        scheduler.add(job)
+    order = scheduler.get_order(real_time_factor=0.1, now=3800)
+    assert [job.id for job in order] == expected_order
+
+
+def test_priority_classes_go_first():
+    scheduler = Scheduler("sjf")
+    for job in get_jobs():
+        scheduler.add(job)
+    scheduler.add(QueuedJob("urgent", priority=1, cost=JobCost(GiB, 36000)))
+    scheduler.add(QueuedJob("not_estimated"))
+    order = [job.id for job in scheduler.get_order(real_time_factor=0.1)]
+    assert order == ["urgent", "short", "medium", "long", "not_estimated"]
+
+
+def test_pop_next_skips_jobs_that_do_not_fit(mocker):
+    mocker.patch("scheduler.get_disk_space", return_value=(100 * GiB, 2 * GiB))
+    mocker.patch("scheduler.get_memory", return_value=(-1, -1))
+    scheduler = Scheduler("fifo")
+    for job in get_jobs():
+        scheduler.add(job)
+    # the 1 GiB input + 1 GiB WAV of "long" don't fit next to DISK_RESERVE_BYTES
+    assert scheduler.pop_next(0.1, timeout_s=0).id == "short"
+    assert scheduler.pop_next(0.1, timeout_s=0).id == "medium"
+    assert scheduler.pop_next(0.1, timeout_s=0) is None
+    assert list(scheduler.jobs) == ["long"]
+
+
+def test_get_etas():
+    scheduler = Scheduler("sjf")
+    for job in get_jobs():
+        scheduler.add(job)
+    scheduler.add(QueuedJob("not_estimated"))
+    assert scheduler.get_etas(0.1, running_remaining_s=10) == {
+        "short": pytest.approx(13),
+        "medium": pytest.approx(73),
+        "long": pytest.approx(3673),
+    }
+
+
+def test_get_budget_error():
+    cost = JobCost(GiB, 3600)
+    assert get_budget_error(cost, 10 * GiB, 10 * GiB) == ""
+    assert "disk" in get_budget_error(cost, 2 * GiB, 10 * GiB)
+    assert "memory" in get_budget_error(cost, 10 * GiB, GiB)
+    assert get_budget_error(cost, -1, -1) == ""  # unknown
+
+
+def test_estimate_cost_of_upload(mocker, tmp_path):
+    upload = os.path.join(tmp_path, "upload.mp3")
+    with open(upload, "wb") as f:
+        f.write(b"0" * 1000)
+    probe_media = mocker.patch("scheduler.probe_media")
+    probe_media.return_value.duration = 30.0
+    get_content_length = mocker.patch("scheduler.get_content_length")
+    assert estimate_cost("upload://x/upload.mp3", upload) == JobCost(1000, 30.0)
+    probe_media.assert_called_once_with(upload)
+    get_content_length.assert_not_called()
+
+
+def test_estimate_cost_failure(mocker):
+    mocker.patch("scheduler.get_content_length", return_value=-1)
+    mocker.patch("scheduler.probe_media", side_effect=ValueError("no such input"))
+    cost = estimate_cost("http://127.0.0.1:1/missing.mp3")
+    assert cost == JobCost(-1, -1)
+    assert cost.get_duration_s() > 0  # still ordered, as an hour long input
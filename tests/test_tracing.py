@@ -0,0 +1,170 @@
+import json
+import os
+import pytest
+import shutil
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+# Mocking environment used in tracing
+os.environ["DATA_BASE_DIR"] = "data"
+os.environ["MODEL_BASE_DIR"] = "tests/input/extract_model_test"
+
+from asr_backend import StubBackend  # noqa
+from tracing import (  # noqa
+    NO_SPAN,
+    current_span,
+    export_trace,
+    propagate,
+    span,
+    start_trace,
+    to_chrome_trace,
+    to_otlp,
+)
+
+
+def get_spans(trace) -> dict:
+    return {s.name: s for s in trace.spans}
+
+
+def test_nested_spans():
+    with start_trace("run", asset_id="asset") as trace:
+        with span("download", uri="s3://bucket/asset.mp4") as download_span:
+            download_span.set("bytes", 1024)
+            with span("s3_download_file"):
+                pass
+        current_span().set("segments", 3)
+    spans = get_spans(trace)
+    assert spans["run"].parent_id == ""
+    assert spans["download"].parent_id == spans["run"].span_id
+    assert spans["s3_download_file"].parent_id == spans["download"].span_id
+    assert spans["download"].attributes == {
+        "uri": "s3://bucket/asset.mp4",
+        "bytes": 1024,
+    }
+    assert spans["run"].attributes == {"asset_id": "asset", "segments": 3}
+    assert all(s.end_unix_ns >= s.start_unix_ns > 0 for s in trace.spans)
+
+
+def test_nested_trace_is_a_span():
+    with start_trace("task") as trace:
+        with start_trace("asr.run") as inner_trace:
+            pass
+    assert inner_trace is trace
+    spans = get_spans(trace)
+    assert spans["asr.run"].parent_id == spans["task"].span_id
+
+
+def test_span_records_error():
+    with pytest.raises(ValueError):
+        with start_trace("run") as trace:
+            with span("transcode"):
+                raise ValueError("no audio stream")
+    assert get_spans(trace)["transcode"].error == "ValueError: no audio stream"
+    assert get_spans(trace)["run"].error == "ValueError: no audio stream"
+
+
+def test_span_outside_of_trace_is_not_recorded():
+    with span("download") as download_span:
+        download_span.set("bytes", 1024)
+    assert download_span is NO_SPAN
+    assert NO_SPAN.attributes == {}
+
+
+def upload(name: str):
+    with span(name):
+        pass
+
+
+def test_propagate_to_thread():
+    with start_trace("run") as trace:
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            for _ in range(2):
+                pool.submit(propagate(upload), "upload")
+            pool.submit(upload, "not_propagated")
+    spans = [s for s in trace.spans if s.name == "upload"]
+    assert len(spans) == 2
+    assert {s.parent_id for s in spans} == {get_spans(trace)["run"].span_id}
+    assert "not_propagated" not in get_spans(trace)
+
+
+def test_to_chrome_trace():
+    with start_trace("run") as trace:
+        with span("transcode", audio_s=12.5):
+            pass
+    chrome_trace = to_chrome_trace(trace)
+    events = {e["name"]: e for e in chrome_trace["traceEvents"]}
+    assert events["run"]["ts"] == 0
+    assert events["transcode"]["ph"] == "X"
+    assert events["transcode"]["args"] == {"audio_s": 12.5}
+    assert events["run"]["dur"] >= events["transcode"]["dur"]
+    assert chrome_trace["otherData"]["trace_id"] == trace.trace_id
+
+
+def test_to_otlp():
+    with pytest.raises(RuntimeError):
+        with start_trace("run") as trace:
+            with span("upload", bytes=10, retried=False, filename="x.json"):
+                raise RuntimeError("upload failed")
+    resource_spans = to_otlp(trace)["resourceSpans"][0]
+    spans = {s["name"]: s for s in resource_spans["scopeSpans"][0]["spans"]}
+    assert "parentSpanId" not in spans["run"]
+    assert spans["upload"]["parentSpanId"] == spans["run"]["spanId"]
+    assert spans["upload"]["traceId"] == trace.trace_id
+    assert spans["upload"]["attributes"] == [
+        {"key": "bytes", "value": {"intValue": "10"}},
+        {"key": "retried", "value": {"boolValue": False}},
+        {"key": "filename", "value": {"stringValue": "x.json"}},
+    ]
+    assert spans["upload"]["status"] == {
+        "code": 2,
+        "message": "RuntimeError: upload failed",
+    }
+    assert int(spans["run"]["endTimeUnixNano"]) >= int(
+        spans["run"]["startTimeUnixNano"]
+    )
+
+
+def test_export_trace(tmp_path):
+    with start_trace("asr.run", asset_id="asset") as trace:
+        pass
+    export_trace(trace, str(tmp_path), "otlp")
+    path = os.path.join(tmp_path, f"asset-{trace.trace_id}.otlp.json")
+    with open(path) as f:
+        assert "resourceSpans" in json.load(f)
+
+
+@pytest.mark.skipif(not shutil.which("ffprobe"), reason="needs ffmpeg")
+def test_pipeline_is_traced(tmp_path, mocker):
+    from asr import run
+
+    mocker.patch("asr.DATA_BASE_DIR", str(tmp_path))
+    mocker.patch("base_util.DATA_BASE_DIR", str(tmp_path))  # the asset lock
+    mocker.patch("tracing.TRACE_DIR", os.path.join(tmp_path, "traces"))
+    staged_file = os.path.join(tmp_path, "staged.wav")
+    with wave.open(staged_file, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(16000)
+        f.writeframes(b"\x00\x00" * 16000 * 12)
+    run("upload://0123/traced.wav", "", StubBackend(real_time_factor=0), staged_file)
+
+    (trace_file,) = os.listdir(os.path.join(tmp_path, "traces"))
+    assert trace_file.startswith("traced-")
+    with open(os.path.join(tmp_path, "traces", trace_file)) as f:
+        events = {e["name"]: e for e in json.load(f)["traceEvents"]}
+    for name in [
+        "asr.run",
+        "claim_staged_input",
+        "transcode",
+        "probe_media",
+        "run_command",
+        "asr",
+        "transcribe",
+        "encode_whisper_transcript",
+        "daan_transcript",
+        "write_output",
+    ]:
+        assert name in events
+    assert events["transcode"]["args"]["skipped"] == "already ASR-ready audio"
+    assert events["transcribe"]["args"]["segments"] == 3
+    assert events["claim_staged_input"]["args"]["bytes"] == 16000 * 2 * 12 + 44
@@ -0,0 +1,93 @@
+import json
+import os
+import pytest
+
+# Mocking environment used in transcode
+os.environ["DATA_BASE_DIR"] = "data"
+os.environ["MODEL_BASE_DIR"] = "tests/input/extract_model_test"
+
+from base_util import CancelToken, TaskCancelled  # noqa
+from transcode import AudioStream, MediaInfo, extract_audio, probe_media  # noqa
+
+
+@pytest.mark.parametrize(
+    "stream_count, audio_streams, expected_output",
+    [
+        (1, (AudioStream(0, "pcm_s16le", 16000, 1),), True),
+        (1, (AudioStream(0, "mp3", 16000, 1),), True),
+        (1, (AudioStream(0, "mp3", 48000, 2),), False),  # needs resampling
+        (1, (AudioStream(0, "aac", 16000, 1),), False),  # not in the whitelist
+        (2, (AudioStream(0, "pcm_s16le", 16000, 1),), False),  # e.g. has video
+        (0, (), False),
+    ],
+)
+def test_is_asr_ready(stream_count, audio_streams, expected_output):
+    media_info = MediaInfo("wav", 10.0, stream_count, audio_streams)
+    assert media_info.is_asr_ready() == expected_output
+
+
+def test_first_usable_audio_stream():
+    media_info = MediaInfo(
+        "mxf",
+        10.0,
+        3,
+        (
+            AudioStream(0, "pcm_s24le", 0, 0),  # empty track
+            AudioStream(1, "pcm_s24le", 48000, 1),
+        ),
+    )
+    stream = media_info.first_usable_audio_stream()
+    assert stream and stream.index == 1
+
+
+def test_probe_media_is_cached(mocker, tmp_path):
+    probe_output = {
+        "streams": [
+            {"codec_type": "video", "codec_name": "h264"},
+            {
+                "codec_type": "audio",
+                "codec_name": "aac",
+                "sample_rate": "48000",
+                "channels": 2,
+            },
+        ],
+        "format": {"format_name": "matroska,webm", "duration": "12.5"},
+    }
+    run_command = mocker.patch(
+        "transcode.run_command", return_value=(True, json.dumps(probe_output))
+    )
+    input_file = os.path.join(tmp_path, "video.mkv")
+    with open(input_file, "wb") as f:
+        f.write(b"not really a video")
+
+    media_info = probe_media(input_file)
+    assert media_info == probe_media(input_file)
+    assert run_command.call_count == 1
+    # the object behind a URL may change
+    probe_media("http://x/video.mkv")
+    probe_media("http://x/video.mkv")
+    assert run_command.call_count == 3
+    assert media_info.duration == 12.5
+    assert media_info.stream_count == 2
+    assert media_info.audio_streams == (AudioStream(0, "aac", 48000, 2),)
+
+
+def test_cancelled_extract_audio_is_cleaned_up(mocker, tmp_path):
+    def run_ffmpeg(command, timeout_s, on_output_line):
+        with open(command[-1], "wb") as f:  # the .part file
+            f.write(b"partial audio")
+        on_output_line("out_time_us=1000000")
+        on_output_line("out_time_us=2000000")
+        return True, ""
+
+    mocker.patch("transcode.run_command", side_effect=run_ffmpeg)
+    cancel = CancelToken()
+    media_info = MediaInfo("mp4", 10, 2, (AudioStream(0, "aac", 48000, 2),))
+    asr_path = os.path.join(tmp_path, "asset_16k.wav")
+
+    def on_progress(stage: str, progress: float):
+        cancel.cancel("deleted")
+
+    with pytest.raises(TaskCancelled):
+        extract_audio("video.mp4", asr_path, media_info, on_progress, cancel)
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,92 @@
+import json
+import os
+import pytest
+
+# Mocking environment used in transcript
+os.environ["DATA_BASE_DIR"] = "data"
+os.environ["MODEL_BASE_DIR"] = "tests/input/extract_model_test"
+
+from asr_backend import Segment, Word  # noqa
+from daan_transcript import whisper_json_to_daan_format  # noqa
+from transcript import Transcript  # noqa
+from transcript_format import encode_whisper_transcript  # noqa
+from whisper import process_segments  # noqa
+
+
+def test_round_trip(whisper_transcript):
+    transcript = Transcript.from_dict(whisper_transcript)
+    assert transcript.word_count == sum(
+        len(s["words"]) for s in whisper_transcript["segments"]
+    )
+    assert transcript.to_dict() == whisper_transcript
+
+
+@pytest.mark.parametrize("layout", ["json", "ndjson"])
+@pytest.mark.parametrize("columnar_words", [False, True])
+@pytest.mark.parametrize("compression", ["none", "gzip"])
+@pytest.mark.parametrize("tokens", [False, True])
+def test_encodes_like_the_dicts(
+    whisper_transcript, layout, columnar_words, compression, tokens, mocker
+):
+    mocker.patch("transcript_format.SEGMENT_BATCH", 2)
+    deferred = {**whisper_transcript, "word_alignment": "deferred"}
+    empty = {"carrierId": "asset", "segments": []}
+    segment = whisper_transcript["segments"][0]
+    # more segments than fit in a batch
+    batches = {
+        **whisper_transcript,
+        "segments": [{**segment, "id": i} for i in range(5)],
+    }
+    for data in [whisper_transcript, deferred, empty, batches]:
+        options = (layout, columnar_words, compression, tokens)
+        assert encode_whisper_transcript(
+            Transcript.from_dict(data), *options
+        ) == encode_whisper_transcript(data, *options)
+
+
+def test_daan_from_the_arrays(whisper_transcript):
+    with open("data/whisper-test/daan-es-transcript.json") as f:
+        daan_transcript = json.load(f)
+    transcript = Transcript.from_dict(whisper_transcript)
+    assert whisper_json_to_daan_format(transcript) == daan_transcript
+    # like int(start * 1000), also for the starts that aren't exact in binary
+    assert transcript.word_times_ms().tolist() == [
+        int(w["start"] * 1000)
+        for s in whisper_transcript["segments"]
+        for w in s["words"]
+    ]
+
+
+def test_process_segments(mocker):
+    segments = [
+        Segment(
+            0,
+            0,
+            0.0,
+            1.5,
+            " Hallo wereld",
+            [50364, 2],
+            words=[
+                Word(0.0, 0.5, " Hallo", 0.9),
+                Word(0.5, 1.5, " wereld", 0.8),
+            ],
+        ),
+        Segment(1, 150, 1.5, 2.0, " Tot ziens", [3]),
+    ]
+    transcript = process_segments(segments, "asset")
+    assert transcript.carrier_id == "asset"
+    assert transcript.segments[0].text == "Hallo wereld"
+    assert transcript.get_words(0) == [
+        {"text": "Hallo", "start": 0.0, "end": 0.5, "confidence": 0.9},
+        {"text": "wereld", "start": 0.5, "end": 1.5, "confidence": 0.8},
+    ]
+    assert transcript.get_words(1, columnar=True) == {
+        "text": [],
+        "start": [],
+        "end": [],
+        "confidence": [],
+    }
+    assert transcript.to_dict()["segments"][1]["tokens"] == [3]
+
+    mocker.patch("whisper.W_WORD_TIMESTAMPS", False)
+    assert process_segments(segments, "asset").word_count == 0
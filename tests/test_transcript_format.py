@@ -0,0 +1,43 @@
+import json
+import os
+import pytest
+
+# Mocking environment used in transcript_format
+os.environ["DATA_BASE_DIR"] = "data"
+os.environ["MODEL_BASE_DIR"] = "tests/input/extract_model_test"
+
+from transcript_format import (  # noqa
+    decode_whisper_transcript,
+    encode_whisper_transcript,
+)
+
+
+@pytest.mark.parametrize("layout", ["json", "ndjson"])
+@pytest.mark.parametrize("columnar_words", [False, True])
+@pytest.mark.parametrize("compression", ["none", "gzip", "zstd"])
+def test_round_trip(whisper_transcript, layout, columnar_words, compression):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")  # optional dependency
+    data = encode_whisper_transcript(
+        whisper_transcript, layout, columnar_words, compression, tokens=True
+    )
+    assert decode_whisper_transcript(data) == whisper_transcript
+
+
+def test_without_tokens(whisper_transcript):
+    data = encode_whisper_transcript(whisper_transcript, tokens=False)
+    decoded = decode_whisper_transcript(data)
+    assert "tokens" not in decoded["segments"][0]
+    assert "tokens" in whisper_transcript["segments"][0]  # input is not modified
+    assert decoded["segments"][0]["words"] == whisper_transcript["segments"][0]["words"]
+
+
+def test_ndjson_without_segments():
+    data = encode_whisper_transcript({"carrierId": "x", "segments": []}, "ndjson")
+    assert decode_whisper_transcript(data) == {"carrierId": "x", "segments": []}
+
+
+def test_reads_stdlib_json(whisper_transcript):
+    # transcripts written before the encoding options were added
+    data = json.dumps(whisper_transcript, indent=4).encode("utf-8")
+    assert decode_whisper_transcript(data) == whisper_transcript
@@ -0,0 +1,152 @@
+import json
+import os
+import pytest
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Mocking environment used in webhooks
+os.environ["DATA_BASE_DIR"] = "data"
+os.environ["MODEL_BASE_DIR"] = "tests/input/extract_model_test"
+
+from webhooks import Outbox, WebhookDispatcher, get_signature  # noqa
+
+
+# records the POSTed bodies, answers with the next of its status codes (then 200)
+class Receiver(ThreadingHTTPServer):
+    def __init__(self, status_codes: list):
+        super().__init__(("127.0.0.1", 0), ReceiverHandler)
+        self.status_codes = status_codes
+        self.requests: list = []
+        self.received = threading.Event()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}/hook"
+
+
+class ReceiverHandler(BaseHTTPRequestHandler):
+    server: Receiver
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        status_code = (
+            self.server.status_codes.pop(0) if self.server.status_codes else 200
+        )
+        self.server.requests.append((status_code, dict(self.headers), body))
+        self.send_response(status_code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        if status_code == 200:
+            self.server.received.set()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def receiver():
+    def start(status_codes: list) -> Receiver:
+        server = Receiver(status_codes)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    servers: list = []
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+@pytest.fixture
+def outbox(tmp_path) -> Outbox:
+    return Outbox(os.path.join(tmp_path, "outbox.db"), max_attempts=3)
+
+
+def get_events(body: bytes) -> list:
+    return json.loads(body)["events"]
+
+
+def test_deliver_and_retry(outbox, receiver, mocker):
+    mocker.patch("webhooks.WEBHOOK_BACKOFF_S", 0.05)
+    server = receiver([503, 429])
+    dispatcher = WebhookDispatcher(outbox)
+    dispatcher.start()
+    event_id = dispatcher.notify(server.url, {"id": "task-1", "status": "DONE"})
+    assert server.received.wait(5)
+    dispatcher.stop()
+
+    assert [r[0] for r in server.requests] == [503, 429, 200]
+    # a retry is the same event
+    assert {get_events(r[2])[0]["event_id"] for r in server.requests} == {event_id}
+    assert get_events(server.requests[-1][2]) == [
+        {"event_id": event_id, "id": "task-1", "status": "DONE"}
+    ]
+    assert outbox.get_counts() == {"PENDING": 0, "FAILED": 0}
+
+
+def test_client_error_is_not_retried(outbox, receiver):
+    server = receiver([404])
+    dispatcher = WebhookDispatcher(outbox)
+    dispatcher.notify(server.url, {"id": "task-1"})
+    assert dispatcher.deliver_next()
+    assert not dispatcher.deliver_next()
+    assert outbox.get_counts() == {"PENDING": 0, "FAILED": 1}
+
+
+def test_delivery_fails_after_max_attempts(outbox, mocker):
+    mocker.patch("webhooks.WEBHOOK_BACKOFF_S", 0)
+    dispatcher = WebhookDispatcher(outbox)
+    dispatcher.notify("http://127.0.0.1:1/unreachable", {"id": "task-1"})
+    for attempts in range(1, 4):
+        assert dispatcher.deliver_next()
+        assert outbox.get_counts()["FAILED"] == (1 if attempts == 3 else 0)
+    assert not dispatcher.deliver_next()
+
+
+def test_backoff_doubles(outbox, mocker):
+    mocker.patch("webhooks.WEBHOOK_BACKOFF_S", 10)
+    outbox.put("http://x/hook", {})
+    for backoff_s in [10, 20]:
+        outbox.failed(outbox.next_due(1), "503")
+        next_attempt_unix = outbox.next_attempt_unix()
+        assert next_attempt_unix - time.time() == pytest.approx(backoff_s, abs=1)
+        mocker.patch("time.time", return_value=next_attempt_unix)
+
+
+def test_batches_per_callback_url(outbox, receiver):
+    server = receiver([])
+    other_server = receiver([])
+    dispatcher = WebhookDispatcher(outbox, batch_size=2, batch_wait_s=0.2)
+    for i in range(3):
+        dispatcher.notify(server.url, {"id": f"task-{i}"})
+    dispatcher.notify(other_server.url, {"id": "task-3"})
+
+    start_time = time.time()
+    while dispatcher.deliver_next():
+        pass
+    assert [[e["id"] for e in get_events(r[2])] for r in server.requests] == [
+        ["task-0", "task-1"],
+        ["task-2"],
+    ]
+    assert len(other_server.requests) == 1
+    # only the batches that weren't full waited for more completions
+    assert time.time() - start_time < 1
+
+
+def test_outbox_survives_restart(outbox, tmp_path):
+    outbox.put("http://x/hook", {"id": "task-1"})
+    restarted = Outbox(os.path.join(tmp_path, "outbox.db"))
+    (delivery,) = restarted.next_due(10)
+    assert delivery.payload == {"id": "task-1"}
+
+
+def test_signature(outbox, receiver, mocker):
+    mocker.patch("webhooks.WEBHOOK_SECRET", "secret")
+    server = receiver([])
+    dispatcher = WebhookDispatcher(outbox)
+    dispatcher.notify(server.url, {"id": "task-1"})
+    dispatcher.deliver_next()
+    _, headers, body = server.requests[0]
+    assert headers["X-Webhook-Signature"] == get_signature(body, "secret")
+    assert get_signature(b"{}", "secret").startswith("sha256=")
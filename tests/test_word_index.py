@@ -0,0 +1,63 @@
+import json
+import os
+
+# Mocking environment used in word_index
+os.environ["DATA_BASE_DIR"] = "data"
+os.environ["MODEL_BASE_DIR"] = "tests/input/extract_model_test"
+
+from daan_transcript import generate_daan_transcript  # noqa
+from word_index import Posting, WordIndex, WordIndexBuilder, normalise  # noqa
+
+
+def write_index(path: str, builder: WordIndexBuilder) -> str:
+    with open(path, "wb") as f:
+        f.write(builder.to_bytes())
+    return path
+
+
+def test_normalise():
+    assert normalise("Één,") == "een"
+    assert normalise("'s-Hertogenbosch") == "shertogenbosch"
+    assert normalise("...") == ""
+
+
+def test_lookup(tmp_path):
+    builder = WordIndexBuilder()
+    for i, word in enumerate(["Zee", "zon", "zee.", "-", "strand", "zéé"]):
+        builder.add(i // 3, i % 3, word, i * 1000)
+    path = write_index(os.path.join(tmp_path, "word-index.bin"), builder)
+
+    with WordIndex(path) as index:
+        assert index.term_count == 3
+        assert index.lookup("ZEE") == [
+            Posting(0, 0, 0),
+            Posting(0, 2, 2000),
+            Posting(1, 2, 5000),
+        ]
+        assert index.lookup("strand") == [Posting(1, 1, 4000)]
+        for missing in ["aap", "zeer", "zz", ""]:
+            assert index.lookup(missing) == []
+
+
+def test_empty_index(tmp_path):
+    path = write_index(os.path.join(tmp_path, "word-index.bin"), WordIndexBuilder())
+    with WordIndex(path) as index:
+        assert index.lookup("zee") == []
+
+
+def test_written_with_daan_transcript(tmp_path):
+    with open("data/whisper-test/whisper-transcript.json") as f:
+        whisper_transcript = json.load(f)
+    generate_daan_transcript(str(tmp_path), whisper_transcript)
+    with open(os.path.join(tmp_path, "daan-es-transcript.json")) as f:
+        daan_transcript = json.load(f)
+
+    with WordIndex(os.path.join(tmp_path, "word-index.bin")) as index:
+        postings = index.lookup("je")
+        assert [p.word_offset for p in postings] == [2, 6, 12]
+        for posting in postings:
+            subtitle = daan_transcript[posting.segment]
+            assert subtitle["words"].split()[posting.word_offset] == "je"
+            assert posting.start_ms in subtitle["wordTimes"]
+        # the punctuation is not part of the term
+        assert index.lookup("bent")[0].start_ms == 4240
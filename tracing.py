@@ -0,0 +1,211 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from uuid import uuid4
+from config import TRACE_DIR, TRACE_FORMAT
+
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = "whisper-asr-worker"
+
+
+@dataclass
+class Span:
+    name: str
+    span_id: str
+    parent_id: str  # empty for the root span
+    start_unix_ns: int
+    end_unix_ns: int = 0
+    thread_id: int = 0
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    error: str = ""
+
+    # e.g. the bytes, audio seconds or segments the span processed
+    def set(self, key: str, value: Any):
+        if self.span_id:  # not NO_SPAN
+            self.attributes[key] = value
+
+
+# returned by span() outside of a trace, so callers can always set attributes
+NO_SPAN = Span("", "", "", 0)
+
+
+# the spans of one run of the pipeline (e.g. one task)
+class Trace:
+    def __init__(self):
+        self.trace_id = uuid4().hex
+        self.spans: List[Span] = []
+        self.lock = threading.Lock()  # spans may end in other threads (uploads)
+
+    def add(self, span: Span):
+        with self.lock:
+            self.spans.append(span)
+
+
+# the trace and span that new spans are children of, per thread (see propagate)
+_current: ContextVar[Optional[Tuple[Trace, Span]]] = ContextVar(
+    "current_span", default=None
+)
+
+
+@contextmanager
+def _record(trace: Trace, parent_id: str, name: str, attributes: dict):
+    span = Span(
+        name,
+        uuid4().hex[:16],
+        parent_id,
+        time.time_ns(),
+        thread_id=threading.get_ident(),
+        attributes=attributes,
+    )
+    token = _current.set((trace, span))
+    try:
+        yield span
+    except BaseException as e:
+        span.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        span.end_unix_ns = time.time_ns()
+        _current.reset(token)
+        trace.add(span)
+
+
+# times the block as a child of the current span. Outside of a trace (see
+# start_trace) nothing is recorded, so spans cost next to nothing when unused
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Span]:
+    current = _current.get()
+    if current is None:
+        yield NO_SPAN
+        return
+    trace, parent = current
+    with _record(trace, parent.span_id, name, attributes) as child:
+        yield child
+
+
+# e.g. to set attributes the caller of a function can't know
+def current_span() -> Span:
+    current = _current.get()
+    return current[1] if current else NO_SPAN
+
+
+# starts a trace with a root span, or a child span if a trace is running already
+# (e.g. asr.run within a task of the API). A new trace is exported to TRACE_DIR
+@contextmanager
+def start_trace(name: str, **attributes) -> Iterator[Trace]:
+    current = _current.get()
+    if current is not None:
+        with span(name, **attributes):
+            yield current[0]
+        return
+    trace = Trace()
+    try:
+        with _record(trace, "", name, attributes):
+            yield trace
+    finally:
+        if TRACE_DIR:
+            export_trace(trace, TRACE_DIR, TRACE_FORMAT)
+
+
+# makes func run in the current trace context in another thread, e.g. a pool
+def propagate(func: Callable) -> Callable:
+    context = copy_context()
+    return lambda *args, **kwargs: context.run(func, *args, **kwargs)
+
+
+def export_trace(trace: Trace, trace_dir: str, trace_format: str):
+    try:
+        os.makedirs(trace_dir, exist_ok=True)
+        root = next((s for s in trace.spans if not s.parent_id), None)
+        name = (root.attributes.get("asset_id") if root else "") or "trace"
+        path = os.path.join(trace_dir, f"{name}-{trace.trace_id}.{trace_format}.json")
+        exported = to_otlp(trace) if trace_format == "otlp" else to_chrome_trace(trace)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(exported, f)
+        logger.info(f"Trace written to {path}")
+    except Exception:
+        logger.exception(f"Failed to export trace {trace.trace_id}")
+
+
+# the Trace Event Format that chrome://tracing and Perfetto open: one "complete"
+# event per span, microseconds since the start of the trace
+def to_chrome_trace(trace: Trace) -> dict:
+    with trace.lock:
+        spans = sorted(trace.spans, key=lambda s: s.start_unix_ns)
+    start_ns = spans[0].start_unix_ns if spans else 0
+    return {
+        "traceEvents": [
+            {
+                "name": s.name,
+                "ph": "X",
+                "ts": (s.start_unix_ns - start_ns) / 1000,
+                "dur": (s.end_unix_ns - s.start_unix_ns) / 1000,
+                "pid": os.getpid(),
+                "tid": s.thread_id,
+                "args": {**s.attributes, **({"error": s.error} if s.error else {})},
+            }
+            for s in spans
+        ],
+        "displayTimeUnit": "ms",
+        "otherData": {"trace_id": trace.trace_id, "start_unix_ns": start_ns},
+    }
+
+
+# OTLP/JSON (as POSTed to a collector's /v1/traces)
+def to_otlp(trace: Trace) -> dict:
+    with trace.lock:
+        spans = list(trace.spans)
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": _to_otlp_attributes({"service.name": SERVICE_NAME})
+                },
+                "scopeSpans": [
+                    {
+                        "scope": {"name": SERVICE_NAME},
+                        "spans": [_to_otlp_span(trace.trace_id, s) for s in spans],
+                    }
+                ],
+            }
+        ]
+    }
+
+
+def _to_otlp_span(trace_id: str, span: Span) -> dict:
+    otlp_span = {
+        "traceId": trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": 1,  # SPAN_KIND_INTERNAL
+        "startTimeUnixNano": str(span.start_unix_ns),
+        "endTimeUnixNano": str(span.end_unix_ns),
+        "attributes": _to_otlp_attributes(span.attributes),
+        # STATUS_CODE_ERROR or STATUS_CODE_UNSET
+        "status": {"code": 2, "message": span.error} if span.error else {"code": 0},
+    }
+    if span.parent_id:
+        otlp_span["parentSpanId"] = span.parent_id
+    return otlp_span
+
+
+def _to_otlp_attributes(attributes: Dict[str, Any]) -> List[dict]:
+    otlp_attributes = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            otlp_value: dict = {"boolValue": value}
+        elif isinstance(value, int):
+            otlp_value = {"intValue": str(value)}  # int64 is a string in JSON
+        elif isinstance(value, float):
+            otlp_value = {"doubleValue": value}
+        else:
+            otlp_value = {"stringValue": str(value)}
+        otlp_attributes.append({"key": key, "value": otlp_value})
+    return otlp_attributes
@@ -1,20 +1,83 @@
+import json
 import logging
 import os
 import time
-from base_util import Provenance, run_shell_command
+from dataclasses import asdict, dataclass
+from functools import cache, lru_cache
+from typing import Callable, Optional, Tuple
+from base_util import (
+    CancelToken,
+    Provenance,
+    ProgressCallback,
+    TaskCancelled,
+    run_command,
+)
+from config import FFMPEG_TIMEOUT_S
+from download import get_stream_url
+from tracing import current_span, span
 
 
 logger = logging.getLogger(__name__)
 
+# what Whisper works with internally: no resampling/downmixing needed when decoding
+ASR_SAMPLE_RATE = 16000
+ASR_CHANNELS = 1
+ASR_READY_CODECS = ["pcm_s16le", "flac", "mp3"]
+
+# ffprobe and ffmpeg -version only read headers, so they should never take long
+PROBE_TIMEOUT_S = 120
+
+
+@dataclass(frozen=True)
+class AudioStream:
+    index: int  # index among the audio streams, i.e. ffmpeg's -map 0:a:<index>
+    codec_name: str
+    sample_rate: int
+    channels: int
+
+
+@dataclass(frozen=True)
+class MediaInfo:
+    format_name: str
+    duration: float  # in seconds, -1 if unknown
+    stream_count: int
+    audio_streams: Tuple[AudioStream, ...]
+
+    # the first audio stream that actually carries sound
+    def first_usable_audio_stream(self) -> Optional[AudioStream]:
+        for stream in self.audio_streams:
+            if stream.channels > 0 and stream.sample_rate > 0:
+                return stream
+        return None
+
+    # single 16kHz mono audio stream in a codec that is cheap to decode
+    def is_asr_ready(self) -> bool:
+        stream = self.first_usable_audio_stream()
+        return (
+            self.stream_count == 1
+            and stream is not None
+            and stream.codec_name in ASR_READY_CODECS
+            and stream.sample_rate == ASR_SAMPLE_RATE
+            and stream.channels == ASR_CHANNELS
+        )
+
+
+@dataclass
+class TranscodeResult:
+    file_path: str  # the audio file to transcribe
+    provenance: Provenance
+    duration: float = -1  # probed duration of the audio in seconds
+
 
 def try_transcode(
     input_file: str,
     asset_id: str,
-    extension: str,
     output_path: str,
-) -> Provenance:
+    on_progress: Optional[ProgressCallback] = None,
+    cancel: Optional[CancelToken] = None,
+) -> TranscodeResult:
     logger.info(
-        f"Determining if transcode is required for input_path: {input_file} asset_id: ({asset_id}) extension: ({extension})"
+        f"Determining if transcode is required for input_path: {input_file} asset_id: ({asset_id})"
     )
     start_time = time.time()
 
@@ -25,56 +88,251 @@ def try_transcode(
         input_data=input_file,
     )
 
-    output_file = os.path.join(output_path, f"{asset_id}.mp3")
+    output_file = get_audio_file(asset_id, output_path)
 
     # check if the input file needs transcoding (or is already transcoded)
-    if _is_audio_file(extension) or os.path.exists(output_file):
-        logger.info("Input is already audio or has been transcoded")
-        provenance.processing_time_ms = (time.time() - start_time) * 1000
-        provenance.output_data = output_path
-        provenance.steps.append("Input is already audio or has been transcoded")
-        return provenance
-
-    # Get output of "ffmpeg -version"
-    success, ffmpeg_ver = run_shell_command(["ffmpeg", "-version"])
-    if not success:
-        raise RuntimeError("Running ffmpeg to extract audio failed")
+    if os.path.exists(output_file):
+        logger.info("Input has already been transcoded")
+        return _already_transcoded(output_file, provenance, start_time)
 
-    # Add only the ffmpeg version number info to prov
-    ffmpeg_ver = " ".join(ffmpeg_ver.split()[:3])
-    provenance.software_version = ffmpeg_ver
+    media_info = probe_media(input_file)
+    provenance.parameters = _get_probe_parameters(media_info)
+    if media_info.is_asr_ready():
+        logger.info("Input is already 16kHz mono audio, no need to transcode")
+        current_span().set("skipped", "already ASR-ready audio")
+        provenance.processing_time_ms = (time.time() - start_time) * 1000
+        provenance.output_data = input_file
+        provenance.steps.append("Input is already audio that needs no transcoding")
+        return TranscodeResult(input_file, provenance, media_info.duration)
 
-    # if the input format is not supported, fail
-    if not _is_transcodable(extension):
-        raise ValueError(
-            f"Audio extraction failure: Input with extension {extension} is not transcodable"
-        )
+    provenance.software_version = get_ffmpeg_version()
 
     # go ahead and transcode the input file
-    success = transcode_to_mp3(
-        input_file,
-        output_file,
-    )
+    success = extract_audio(input_file, output_file, media_info, on_progress, cancel)
     if not success:
         raise RuntimeError("Running ffmpeg to transcode failed")
 
-    logger.info(f"Transcode of {extension} successful, returning: {output_file}")
+    logger.info(f"Transcode of {input_file} successful, returning: {output_file}")
 
     provenance.processing_time_ms = (time.time() - start_time) * 1000
     provenance.output_data = output_file
     provenance.steps.append("Transcode successful")
-    return provenance
+    return TranscodeResult(output_file, provenance, media_info.duration)
 
 
-def transcode_to_mp3(path: str, asr_path: str) -> bool:
-    logger.debug(f"Encoding file: {path}")
-    success, _ = run_shell_command(["ffmpeg", "-y", "-i", path, asr_path])
-    return success
+# lets ffmpeg read the input over HTTP(S) (seeking with range requests), so
+# download and decode overlap and only the extracted audio is written to disk.
+# Returns None if the input needs no transcoding or cannot be streamed
+def try_stream_transcode(
+    input_uri: str,
+    asset_id: str,
+    output_path: str,
+    on_progress: Optional[ProgressCallback] = None,
+    cancel: Optional[CancelToken] = None,
+) -> Optional[TranscodeResult]:
+    logger.info(f"Trying to stream {input_uri} into ffmpeg")
+    start_time = time.time()
+
+    provenance = Provenance(
+        activity_name="Streaming transcode",
+        activity_description="Extracts the audio while streaming the input",
+        start_time_unix=start_time,
+        input_data=input_uri,
+    )
+
+    output_file = get_audio_file(asset_id, output_path)
+    if os.path.exists(output_file):
+        logger.info("Input has already been transcoded")
+        return _already_transcoded(output_file, provenance, start_time)
+
+    try:
+        input_url = get_stream_url(input_uri)
+        media_info = probe_media(input_url)
+        if media_info.is_asr_ready():
+            logger.info("Input needs no transcoding, so it will be downloaded")
+            return None
+        provenance.parameters = _get_probe_parameters(media_info)
+        provenance.software_version = get_ffmpeg_version()
+        # Create /data/<asset_id>/ folder if not exists
+        if not os.path.exists(output_path):
+            logger.info(f"{output_path} does not exist, creating it now")
+            os.makedirs(output_path)
+        if not extract_audio(input_url, output_file, media_info, on_progress, cancel):
+            raise RuntimeError("Running ffmpeg to transcode failed")
+    except TaskCancelled:
+        raise
+    except Exception:
+        logger.exception("Streaming transcode failed, falling back to download")
+        return None
 
+    logger.info(f"Streaming transcode successful, returning: {output_file}")
+    provenance.processing_time_ms = (time.time() - start_time) * 1000
+    provenance.output_data = output_file
+    provenance.steps.append("Streaming transcode successful")
+    return TranscodeResult(output_file, provenance, media_info.duration)
+
+
+def _already_transcoded(
+    output_file: str, provenance: Provenance, start_time: float
+) -> TranscodeResult:
+    current_span().set("skipped", "already transcoded")
+    media_info = probe_media(output_file)
+    provenance.parameters = _get_probe_parameters(media_info)
+    provenance.processing_time_ms = (time.time() - start_time) * 1000
+    provenance.output_data = output_file
+    provenance.steps.append("Input has already been transcoded")
+    return TranscodeResult(output_file, provenance, media_info.duration)
+
+
+def get_audio_file(asset_id: str, output_path: str) -> str:
+    return os.path.join(output_path, f"{asset_id}_16k.wav")
+
+
+# reads the stream layout of a local file or URL. Local files are only probed
+# again when they change, URLs every time: the object behind a URL may be
+# replaced without the URL changing
+def probe_media(input: str) -> MediaInfo:
+    if os.path.exists(input):
+        stat = os.stat(input)
+        return _probe_local_media(input, stat.st_size, stat.st_mtime_ns)
+    return _probe_media(input)
+
+
+@lru_cache(maxsize=256)
+def _probe_local_media(input: str, size: int, mtime_ns: int) -> MediaInfo:
+    return _probe_media(input)
+
+
+def _probe_media(input: str) -> MediaInfo:
+    logger.info(f"Probing {input}")
+    with span("probe_media", input=input):
+        success, output = run_command(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-print_format",
+                "json",
+                "-show_format",
+                "-show_streams",
+                input,
+            ],
+            timeout_s=PROBE_TIMEOUT_S,
+        )
+    if not success:
+        raise ValueError(f"Audio extraction failure: could not probe {input}")
+    probe = json.loads(output)
+    streams = probe.get("streams", [])
+    audio_streams = [s for s in streams if s.get("codec_type") == "audio"]
+    media_info = MediaInfo(
+        format_name=probe.get("format", {}).get("format_name", ""),
+        duration=float(probe.get("format", {}).get("duration", -1)),
+        stream_count=len(streams),
+        audio_streams=tuple(
+            AudioStream(
+                index=i,
+                codec_name=s.get("codec_name", ""),
+                sample_rate=int(s.get("sample_rate", 0)),
+                channels=int(s.get("channels", 0)),
+            )
+            for i, s in enumerate(audio_streams)
+        ),
+    )
+    logger.info(media_info)
+    return media_info
+
+
+def _get_probe_parameters(media_info: MediaInfo) -> dict:
+    stream = media_info.first_usable_audio_stream()
+    return {
+        "format": media_info.format_name,
+        "duration_s": media_info.duration,
+        "stream_count": media_info.stream_count,
+        "audio_stream": asdict(stream) if stream else None,
+    }
+
+
+# returns only the version number info of "ffmpeg -version", e.g. for provenance.
+# The installed ffmpeg does not change while the worker runs, so probe it once
+@cache
+def get_ffmpeg_version() -> str:
+    with span("ffmpeg_version"):
+        success, ffmpeg_ver = run_command(
+            ["ffmpeg", "-version"], timeout_s=PROBE_TIMEOUT_S
+        )
+    if not success:
+        raise RuntimeError("Running ffmpeg to extract audio failed")
+    return " ".join(ffmpeg_ver.split()[:3])
+
+
+# extracts the first usable audio stream as 16kHz mono WAV, which Whisper can
+# read without resampling. Writes to a temporary file first, so a failed run
+# never leaves a partial file behind that would be mistaken for a finished one
+def extract_audio(
+    input: str,
+    asr_path: str,
+    media_info: MediaInfo,
+    on_progress: Optional[ProgressCallback] = None,
+    cancel: Optional[CancelToken] = None,
+) -> bool:
+    stream = media_info.first_usable_audio_stream()
+    if not stream:
+        raise ValueError(
+            f"Audio extraction failure: {input} does not contain a usable audio stream"
+        )
+    logger.debug(f"Encoding audio stream {stream.index} of: {input}")
+    tmp_path = f"{asr_path}.part"
+    success = False
+    with span("extract_audio", audio_s=media_info.duration) as audio_span:
+        try:
+            success, _ = run_command(
+                [
+                    "ffmpeg",
+                    "-y",
+                    "-nostats",
+                    "-progress",
+                    "pipe:1",
+                    "-i",
+                    input,
+                    "-map",
+                    f"0:a:{stream.index}",
+                    "-ac",
+                    str(ASR_CHANNELS),
+                    "-ar",
+                    str(ASR_SAMPLE_RATE),
+                    "-c:a",
+                    "pcm_s16le",
+                    "-f",
+                    "wav",
+                    tmp_path,
+                ],
+                timeout_s=FFMPEG_TIMEOUT_S,
+                on_output_line=_progress_parser(
+                    media_info.duration, on_progress, cancel
+                ),
+            )
+        finally:  # also when the run is cancelled, which kills ffmpeg
+            if success:
+                os.replace(tmp_path, asr_path)
+            elif os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        audio_span.set("bytes", os.path.getsize(asr_path) if success else 0)
+    return success
 
-def _is_audio_file(extension):
-    return extension in [".mp3", ".wav"]
 
+# turns the key=value lines of ffmpeg -progress into the fraction of audio done
+def _progress_parser(
+    duration: float,
+    on_progress: Optional[ProgressCallback],
+    cancel: Optional[CancelToken] = None,
+) -> Callable[[str], None]:
+    def parse_line(line: str):
+        if cancel:
+            cancel.check()  # raising makes run_command kill ffmpeg
+        key, _, value = line.partition("=")
+        # both are in microseconds (out_time_ms is misnamed)
+        if key in ["out_time_us", "out_time_ms"] and value.isdigit():
+            if on_progress and duration > 0:
+                on_progress("transcode", min(int(value) / 1_000_000 / duration, 1.0))
 
-def _is_transcodable(extension):
-    return extension in [".mov", ".mp4"]
+    return parse_line
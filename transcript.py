@@ -0,0 +1,245 @@
+import logging
+from array import array
+from dataclasses import dataclass, field
+from typing import Iterable, List, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+WORD_FIELDS = ["text", "start", "end", "confidence"]
+# what a segment (dict) read from an older or trimmed transcript may lack
+SEGMENT_DEFAULTS = {
+    "id": 0,
+    "seek": 0,
+    "temperature": 0.0,
+    "avg_logprob": 0.0,
+    "compression_ratio": 1.0,
+    "no_speech_prob": 0.0,
+}
+
+
+# the words of a segment, one list per field (extending the arrays of the
+# TranscriptBuilder with a list is much faster than appending word by word)
+class WordColumns(NamedTuple):
+    texts: List[str]
+    starts: List[float]
+    ends: List[float]
+    probabilities: List[float]
+
+
+# a segment of the Whisper transcript without its words and tokens: those are
+# columns of the Transcript (see word_range and token_range)
+@dataclass(slots=True)
+class TranscriptSegment:
+    id: int
+    seek: int
+    start: float
+    end: float
+    text: str
+    temperature: float
+    avg_logprob: float
+    compression_ratio: float
+    no_speech_prob: float
+
+
+# The Whisper transcript as the pipeline keeps it in memory. Rather than a dict
+# per word (~10,000 an hour) and a list of token ints per segment, the words and
+# tokens are columns of NumPy arrays, the texts of the words slices of a single
+# string. The JSON schema (see transcript_format.py) and the DAAN format
+# are only produced when they're written
+@dataclass(slots=True)
+class Transcript:
+    carrier_id: str
+    segments: List[TranscriptSegment]
+    word_offsets: np.ndarray  # the words of segment i: word_offsets[i:i + 2]
+    word_text: str  # the texts of all words, one after the other
+    word_text_offsets: np.ndarray  # word i: word_text[offsets[i]:offsets[i + 1]]
+    word_starts: np.ndarray
+    word_ends: np.ndarray
+    word_probabilities: np.ndarray
+    token_offsets: np.ndarray  # the tokens of segment i: token_offsets[i:i + 2]
+    tokens: np.ndarray
+    # "deferred" when the words are added later (see alignment.py)
+    word_alignment: Optional[str] = None
+    # the bounds as Python ints, looked up once per segment
+    _word_bounds: List[int] = field(default_factory=list, repr=False)
+    _token_bounds: List[int] = field(default_factory=list, repr=False)
+
+    def __post_init__(self):
+        self._word_bounds = self.word_offsets.tolist()
+        self._token_bounds = self.token_offsets.tolist()
+
+    @property
+    def word_count(self) -> int:
+        return len(self.word_starts)
+
+    # the bytes of the arrays and the text (not the segment records)
+    @property
+    def nbytes(self) -> int:
+        arrays = [
+            self.word_offsets,
+            self.word_text_offsets,
+            self.word_starts,
+            self.word_ends,
+            self.word_probabilities,
+            self.token_offsets,
+            self.tokens,
+        ]
+        return sum(a.nbytes for a in arrays) + len(self.word_text.encode("utf-8"))
+
+    def word_range(self, i: int) -> Tuple[int, int]:
+        return self._word_bounds[i], self._word_bounds[i + 1]
+
+    def token_range(self, i: int) -> Tuple[int, int]:
+        return self._token_bounds[i], self._token_bounds[i + 1]
+
+    def word_texts(self, start: int, end: int) -> List[str]:
+        offsets = self.word_text_offsets[start : end + 1].tolist()
+        return [self.word_text[a:b] for a, b in zip(offsets, offsets[1:])]
+
+    # the start of every word in milliseconds (truncated, like int()), at once
+    def word_times_ms(self) -> np.ndarray:
+        return (self.word_starts * 1000).astype(np.int64)
+
+    # the words of segment i in the JSON schema: rows (a dict per word) or columns
+    def get_words(self, i: int, columnar: bool = False):
+        return self.segment_to_dict(i, columnar, tokens=False)["words"]
+
+    def segment_to_dict(
+        self, i: int, columnar_words: bool = False, tokens: bool = True
+    ) -> dict:
+        return self.segments_to_dicts(i, i + 1, columnar_words, tokens)[0]
+
+    # the dicts of segments first to last (exclusive) in the JSON schema. The
+    # arrays are converted to lists once for all of them: per segment, the
+    # conversion costs more than building the dicts
+    def segments_to_dicts(
+        self, first: int, last: int, columnar_words: bool = False, tokens: bool = True
+    ) -> List[dict]:
+        word_start, word_end = self._word_bounds[first], self._word_bounds[last]
+        texts = self.word_texts(word_start, word_end)
+        starts = self.word_starts[word_start:word_end].tolist()
+        ends = self.word_ends[word_start:word_end].tolist()
+        probabilities = self.word_probabilities[word_start:word_end].tolist()
+        token_start = self._token_bounds[first]
+        all_tokens = self.tokens[token_start : self._token_bounds[last]].tolist()
+        dicts = []
+        for i in range(first, last):
+            segment = self.segments[i]
+            data = {
+                "id": segment.id,
+                "seek": segment.seek,
+                "start": segment.start,
+                "end": segment.end,
+                "text": segment.text,
+            }
+            if tokens:
+                a, b = self.token_range(i)
+                data["tokens"] = all_tokens[a - token_start : b - token_start]
+            a, b = self.word_range(i)
+            a, b = a - word_start, b - word_start
+            columns = [texts[a:b], starts[a:b], ends[a:b], probabilities[a:b]]
+            if columnar_words:
+                words: Union[dict, List[dict]] = dict(zip(WORD_FIELDS, columns))
+            else:
+                # (a dict literal is created about twice as fast as dict(zip()))
+                words = [
+                    {"text": text, "start": start, "end": end, "confidence": p}
+                    for text, start, end, p in zip(*columns)
+                ]
+            data.update(
+                temperature=segment.temperature,
+                avg_logprob=segment.avg_logprob,
+                compression_ratio=segment.compression_ratio,
+                no_speech_prob=segment.no_speech_prob,
+                words=words,
+            )
+            dicts.append(data)
+        return dicts
+
+    # the dict of the Whisper transcript JSON schema, without the segments
+    def header(self) -> dict:
+        data: dict = {"carrierId": self.carrier_id, "segments": []}
+        if self.word_alignment:
+            data["word_alignment"] = self.word_alignment
+        return data
+
+    # the dict of the Whisper transcript JSON schema
+    def to_dict(self, columnar_words: bool = False, tokens: bool = True) -> dict:
+        segments = self.segments_to_dicts(0, len(self.segments), columnar_words, tokens)
+        return {**self.header(), "segments": segments}
+
+    # e.g. a transcript read by decode_whisper_transcript (words as rows)
+    @classmethod
+    def from_dict(cls, data: dict) -> "Transcript":
+        builder = TranscriptBuilder(data["carrierId"])
+        for segment in data["segments"]:
+            builder.add_segment(
+                TranscriptSegment(
+                    **{k: segment.get(k, v) for k, v in SEGMENT_DEFAULTS.items()},
+                    start=segment["start"],
+                    end=segment["end"],
+                    text=segment["text"],
+                ),
+                segment.get("tokens", []),
+                WordColumns(
+                    [w["text"] for w in segment["words"]],
+                    [w["start"] for w in segment["words"]],
+                    [w["end"] for w in segment["words"]],
+                    [w["confidence"] for w in segment["words"]],
+                ),
+            )
+        return builder.build(data.get("word_alignment"))
+
+
+# collects the segments while they're transcribed, in growable arrays (8 bytes a
+# number, rather than a float object and a dict slot), then builds the Transcript
+class TranscriptBuilder:
+    def __init__(self, carrier_id: str):
+        self.carrier_id = carrier_id
+        self.segments: List[TranscriptSegment] = []
+        self.word_offsets = array("q", [0])
+        self.word_texts: List[str] = []
+        self.word_starts = array("d")
+        self.word_ends = array("d")
+        self.word_probabilities = array("d")
+        self.token_offsets = array("q", [0])
+        self.tokens = array("i")
+
+    def __len__(self) -> int:
+        return len(self.segments)
+
+    def add_segment(
+        self,
+        segment: TranscriptSegment,
+        tokens: Iterable[int],
+        words: Optional[WordColumns] = None,
+    ):
+        self.segments.append(segment)
+        self.tokens.extend(tokens)
+        self.token_offsets.append(len(self.tokens))
+        if words:
+            self.word_texts.extend(words.texts)
+            self.word_starts.extend(words.starts)
+            self.word_ends.extend(words.ends)
+            self.word_probabilities.extend(words.probabilities)
+        self.word_offsets.append(len(self.word_starts))
+
+    def build(self, word_alignment: Optional[str] = None) -> Transcript:
+        text_offsets = np.zeros(len(self.word_texts) + 1, dtype=np.int64)
+        np.cumsum([len(text) for text in self.word_texts], out=text_offsets[1:])
+        return Transcript(
+            carrier_id=self.carrier_id,
+            segments=self.segments,
+            word_offsets=np.array(self.word_offsets, dtype=np.int64),
+            word_text="".join(self.word_texts),
+            word_text_offsets=text_offsets,
+            word_starts=np.array(self.word_starts, dtype=np.float64),
+            word_ends=np.array(self.word_ends, dtype=np.float64),
+            word_probabilities=np.array(self.word_probabilities, dtype=np.float64),
+            token_offsets=np.array(self.token_offsets, dtype=np.int64),
+            tokens=np.array(self.tokens, dtype=np.int32),
+            word_alignment=word_alignment,
+        )
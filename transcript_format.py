@@ -0,0 +1,160 @@
+import gzip
+import io
+import logging
+import orjson
+from typing import Iterator, List, Union
+from config import (
+    TRANSCRIPT_COLUMNAR_WORDS,
+    TRANSCRIPT_COMPRESSION,
+    TRANSCRIPT_LAYOUT,
+    TRANSCRIPT_TOKENS,
+)
+from transcript import WORD_FIELDS, Transcript
+
+
+logger = logging.getLogger(__name__)
+
+# the compressions are recognised by their magic bytes, not by the file name
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+# segments encoded at a time (see _encode_transcript), ~5 minutes of speech
+SEGMENT_BATCH = 64
+
+
+# encodes the transcript as configured: see the "Transcript params" in config.py
+def encode_whisper_transcript(
+    transcript: Union[dict, Transcript],
+    layout: str = TRANSCRIPT_LAYOUT,
+    columnar_words: bool = TRANSCRIPT_COLUMNAR_WORDS,
+    compression: str = TRANSCRIPT_COMPRESSION,
+    tokens: bool = TRANSCRIPT_TOKENS,
+) -> bytes:
+    if isinstance(transcript, Transcript):
+        data = _encode_transcript(
+            transcript, layout, columnar_words, compression == "none", tokens
+        )
+        return _compress(data, compression)
+    segments = [
+        _encode_segment(segment, columnar_words, tokens)
+        for segment in transcript["segments"]
+    ]
+    if layout == "ndjson":
+        # first line has everything but the segments, then one segment per line
+        header = {k: v for k, v in transcript.items() if k != "segments"}
+        data = b"\n".join(orjson.dumps(line) for line in [header, *segments]) + b"\n"
+    elif compression == "none":
+        data = orjson.dumps(
+            {**transcript, "segments": segments}, option=orjson.OPT_INDENT_2
+        )
+    else:
+        # nobody reads compressed files, so skip the (costly) indentation
+        data = orjson.dumps({**transcript, "segments": segments})
+    return _compress(data, compression)
+
+
+# reads every layout, word orientation and compression encode_whisper_transcript
+# can write, regardless of the current configuration
+def decode_whisper_transcript(data: bytes) -> dict:
+    data = _decompress(data)
+    try:
+        transcript = orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # more than one JSON document: NDJSON
+        header, *segments = [orjson.loads(line) for line in data.splitlines() if line]
+        transcript = {**header, "segments": segments}
+    transcript.setdefault("segments", [])  # NDJSON without segments
+    for segment in transcript["segments"]:
+        if isinstance(segment.get("words"), dict):
+            segment["words"] = _to_rows(segment["words"])
+    return transcript
+
+
+# the same bytes as encoding transcript.to_dict(), but SEGMENT_BATCH segments at a
+# time, written into a single buffer: the dicts of the JSON schema only exist for
+# one batch, rather than a dict for every word of the transcript at once
+def _encode_transcript(
+    transcript: Transcript,
+    layout: str,
+    columnar_words: bool,
+    indent: bool,
+    tokens: bool,
+) -> bytes:
+    option = orjson.OPT_INDENT_2 if indent and layout != "ndjson" else 0
+    header = transcript.header()
+    out = io.BytesIO()
+    if layout == "ndjson":
+        del header["segments"]
+        out.write(orjson.dumps(header) + b"\n")
+        for batch in _segment_batches(transcript, columnar_words, tokens):
+            for segment in batch:
+                out.write(orjson.dumps(segment) + b"\n")
+        return out.getvalue()
+
+    # the segments go between the brackets of the (empty) "segments" array
+    empty = orjson.dumps(header, option=option)
+    start = empty.index(b'"segments":') + len(b'"segments":')
+    end = empty.index(b"[]", start) + 1
+    out.write(empty[:end])
+    # a batch encoded as the "segments" of an object has the indentation of the
+    # segments of the transcript, so its items are copied as they are
+    probe = orjson.dumps({"segments": [0]}, option=option)
+    items_start = probe.index(b"[") + 1
+    items_end = len(probe) - probe.rindex(b"0") - 1
+    for i, batch in enumerate(_segment_batches(transcript, columnar_words, tokens)):
+        data = orjson.dumps({"segments": batch}, option=option)
+        if i:
+            out.write(b",")
+        out.write(memoryview(data)[items_start : len(data) - items_end])
+    if indent and transcript.segments:
+        out.write(b"\n  ")
+    out.write(empty[end:])
+    return out.getvalue()
+
+
+def _segment_batches(
+    transcript: Transcript, columnar_words: bool, tokens: bool
+) -> Iterator[List[dict]]:
+    for first in range(0, len(transcript.segments), SEGMENT_BATCH):
+        last = min(first + SEGMENT_BATCH, len(transcript.segments))
+        yield transcript.segments_to_dicts(first, last, columnar_words, tokens)
+
+
+def _encode_segment(segment: dict, columnar_words: bool, tokens: bool) -> dict:
+    if not tokens or columnar_words:
+        segment = {k: v for k, v in segment.items() if tokens or k != "tokens"}
+    if columnar_words:
+        segment["words"] = _to_columns(segment["words"])
+    return segment
+
+
+# [{"text": "a", "start": 0.0, ...}, ...] -> {"text": ["a", ...], "start": [0.0, ...], ...}
+def _to_columns(words: List[dict]) -> dict:
+    return {field: [word[field] for word in words] for field in WORD_FIELDS}
+
+
+def _to_rows(columns: dict) -> List[dict]:
+    return [
+        dict(zip(WORD_FIELDS, values))
+        for values in zip(*(columns[f] for f in WORD_FIELDS))
+    ]
+
+
+def _compress(data: bytes, compression: str) -> bytes:
+    if compression == "gzip":
+        # level 6 is ~3x faster than the default 9, for a few percent in size
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    if compression == "zstd":
+        import zstandard  # optional dependency (poetry install -E zstd)
+
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return data
+
+
+def _decompress(data: bytes) -> bytes:
+    if data.startswith(GZIP_MAGIC):
+        return gzip.decompress(data)
+    if data.startswith(ZSTD_MAGIC):
+        import zstandard
+
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
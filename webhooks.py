@@ -0,0 +1,278 @@
+import hashlib
+import hmac
+import json
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional
+from uuid import uuid4
+
+import requests
+
+from config import (
+    WEBHOOK_BACKOFF_S,
+    WEBHOOK_BATCH_SIZE,
+    WEBHOOK_BATCH_WAIT_S,
+    WEBHOOK_MAX_ATTEMPTS,
+    WEBHOOK_SECRET,
+    WEBHOOK_TIMEOUT_S,
+)
+
+
+logger = logging.getLogger(__name__)
+
+# the backoff doubles with every failed attempt, up to this
+MAX_BACKOFF_S = 3600
+# how often the dispatcher checks the outbox when nothing wakes it up
+POLL_INTERVAL_S = 60
+
+
+@dataclass
+class Delivery:
+    id: str  # sent as the event_id, so receivers can drop duplicates
+    callback_url: str
+    payload: dict
+    attempts: int = 0  # the failed ones so far
+    created_unix: float = 0
+
+
+# the notifications that still have to be delivered. It's a file (e.g. in
+# DATA_BASE_DIR), so the ones that are pending (or waiting for a retry) when the
+# worker restarts are delivered after the restart
+class Outbox:
+    PENDING = "PENDING"
+    FAILED = "FAILED"
+
+    def __init__(self, path: str, max_attempts: int = WEBHOOK_MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.local = threading.local()  # see SQLiteJobQueue
+        with self._transaction() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                "id TEXT PRIMARY KEY, "
+                "callback_url TEXT NOT NULL, "
+                "payload TEXT NOT NULL, "
+                "status TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "next_attempt_unix REAL NOT NULL, "
+                "error_msg TEXT NOT NULL DEFAULT '', "
+                "created_unix REAL NOT NULL)"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS outbox_due ON outbox "
+                "(status, next_attempt_unix)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        if not hasattr(self.local, "db"):
+            db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            self.local.db = db
+        return self.local.db
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def put(self, callback_url: str, payload: dict) -> str:
+        delivery_id = str(uuid4())
+        now = time.time()
+        with self._transaction() as db:
+            db.execute(
+                "INSERT INTO outbox (id, callback_url, payload, status, "
+                "next_attempt_unix, created_unix) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    delivery_id,
+                    callback_url,
+                    json.dumps(payload),
+                    self.PENDING,
+                    now,
+                    now,
+                ),
+            )
+        return delivery_id
+
+    # the delivery that is due the longest, with (up to max_batch) other due deliveries to the
+    # same callback_url
+    def next_due(self, max_batch: int) -> List[Delivery]:
+        db = self._connect()
+        query = (
+            "SELECT * FROM outbox WHERE status = ? AND next_attempt_unix <= ? {} "
+            "ORDER BY next_attempt_unix, created_unix LIMIT ?"
+        )
+        now = time.time()
+        first = db.execute(query.format(""), (self.PENDING, now, 1)).fetchone()
+        if first is None:
+            return []
+        rows = db.execute(
+            query.format("AND callback_url = ?"),
+            (self.PENDING, now, first["callback_url"], max_batch),
+        ).fetchall()
+        return [
+            Delivery(
+                row["id"],
+                row["callback_url"],
+                json.loads(row["payload"]),
+                row["attempts"],
+                row["created_unix"],
+            )
+            for row in rows
+        ]
+
+    # when the next pending delivery is due, None if there is none
+    def next_attempt_unix(self) -> Optional[float]:
+        row = (
+            self._connect()
+            .execute(
+                "SELECT MIN(next_attempt_unix) FROM outbox WHERE status = ?",
+                (self.PENDING,),
+            )
+            .fetchone()
+        )
+        return row[0]
+
+    def delivered(self, deliveries: List[Delivery]):
+        with self._transaction() as db:
+            db.executemany(
+                "DELETE FROM outbox WHERE id = ?", [(d.id,) for d in deliveries]
+            )
+
+    # schedules the next attempt with exponential backoff, or fails the deliveries
+    # when they have no attempts left (or retrying is pointless)
+    def failed(self, deliveries: List[Delivery], error_msg: str, retry: bool = True):
+        now = time.time()
+        with self._transaction() as db:
+            for d in deliveries:
+                attempts = d.attempts + 1
+                give_up = not retry or attempts >= self.max_attempts
+                backoff_s = min(WEBHOOK_BACKOFF_S * 2 ** (attempts - 1), MAX_BACKOFF_S)
+                db.execute(
+                    "UPDATE outbox SET status = ?, attempts = ?, "
+                    "next_attempt_unix = ?, error_msg = ? WHERE id = ?",
+                    (
+                        self.FAILED if give_up else self.PENDING,
+                        attempts,
+                        now + backoff_s,
+                        error_msg,
+                        d.id,
+                    ),
+                )
+
+    def get_counts(self) -> Dict[str, int]:
+        rows = (
+            self._connect()
+            .execute("SELECT status, COUNT(*) FROM outbox GROUP BY status")
+            .fetchall()
+        )
+        return {self.PENDING: 0, self.FAILED: 0} | {row[0]: row[1] for row in rows}
+
+
+# POSTs the notifications in the outbox in a background thread, as
+# {"events": [...]}: with a WEBHOOK_BATCH_SIZE above 1, the completions for the
+# same callback_url within WEBHOOK_BATCH_WAIT_S are sent in one request. Delivery
+# is at least once, receivers can tell duplicates by their event_id
+class WebhookDispatcher:
+    def __init__(
+        self,
+        outbox: Outbox,
+        batch_size: int = WEBHOOK_BATCH_SIZE,
+        batch_wait_s: float = WEBHOOK_BATCH_WAIT_S,
+    ):
+        self.outbox = outbox
+        self.batch_size = batch_size
+        self.batch_wait_s = batch_wait_s
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def notify(self, callback_url: str, payload: dict) -> str:
+        delivery_id = self.outbox.put(callback_url, payload)
+        self.wakeup.set()
+        return delivery_id
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # the outbox keeps what's not delivered yet for the next start
+    def stop(self, timeout_s: float = WEBHOOK_TIMEOUT_S):
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join(timeout_s)
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                if not self.deliver_next():
+                    self.wait()
+            except Exception:
+                logger.exception("Failed to deliver webhooks")
+                self.stopped.wait(POLL_INTERVAL_S)
+
+    # sleeps until a delivery is due or a new one is added
+    def wait(self):
+        next_attempt_unix = self.outbox.next_attempt_unix()
+        wait_s = POLL_INTERVAL_S
+        if next_attempt_unix is not None:
+            wait_s = min(max(next_attempt_unix - time.time(), 0), wait_s)
+        self.wakeup.wait(wait_s)
+        self.wakeup.clear()
+
+    # returns False if nothing was due
+    def deliver_next(self) -> bool:
+        deliveries = self.outbox.next_due(self.batch_size)
+        if not deliveries:
+            return False
+        # a batch that isn't full waits for more completions, up to batch_wait_s
+        wait_s = deliveries[0].created_unix + self.batch_wait_s - time.time()
+        if len(deliveries) < self.batch_size and wait_s > 0:
+            self.stopped.wait(wait_s)
+            deliveries = self.outbox.next_due(self.batch_size)
+        self.post(deliveries)
+        return True
+
+    def post(self, deliveries: List[Delivery]):
+        callback_url = deliveries[0].callback_url
+        body = json.dumps(
+            {"events": [{"event_id": d.id, **d.payload} for d in deliveries]}
+        ).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        if WEBHOOK_SECRET:
+            headers["X-Webhook-Signature"] = get_signature(body, WEBHOOK_SECRET)
+        try:
+            response = requests.post(
+                callback_url, data=body, headers=headers, timeout=WEBHOOK_TIMEOUT_S
+            )
+        except requests.RequestException as e:
+            logger.warning(f"Failed to POST {len(deliveries)} events: {e}")
+            self.outbox.failed(deliveries, str(e))
+            return
+        if response.ok:
+            logger.info(f"Delivered {len(deliveries)} events to {callback_url}")
+            self.outbox.delivered(deliveries)
+            return
+        error_msg = f"{callback_url} responded with {response.status_code}"
+        logger.warning(error_msg)
+        # other client errors (e.g. 404) won't go away by retrying
+        retry = response.status_code >= 500 or response.status_code in [408, 429]
+        self.outbox.failed(deliveries, error_msg, retry)
+
+
+# HMAC-SHA256 of the body with the WEBHOOK_SECRET, so receivers can verify that
+# the notification came from the worker
+def get_signature(body: bytes, secret: str) -> str:
+    digest = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return f"sha256={digest}"
@@ -1,101 +1,121 @@
 import logging
 import os
 import time
-
-import faster_whisper
+from typing import Optional, Tuple
 
 from config import (
     MODEL_BASE_DIR,
-    W_BEAM_SIZE,
-    W_BEST_OF,
+    W_BACKEND,
     W_DEVICE,
     W_MODEL,
-    W_BATCH_SIZE,
-    W_VAD,
+    W_DEFER_WORD_TIMESTAMPS,
+    W_WARM_UP,
     W_WORD_TIMESTAMPS,
     WHISPER_JSON_FILE,
 )
-from base_util import Provenance, write_transcript_to_json
-from gpu_measure import GpuMemoryMeasure
-from model_download import get_model_location
-
+from asr_backend import AsrBackend, get_backend
+from base_util import CancelToken, Provenance, ProgressCallback
+from output_sink import LocalSink, OutputSink
+from tracing import current_span, span
+from transcript import (
+    Transcript,
+    TranscriptBuilder,
+    TranscriptSegment,
+    WordColumns,
+)
+from transcript_format import encode_whisper_transcript
 
 logger = logging.getLogger(__name__)
 
 
-# loads the whisper model
+# loads the whisper model (or the stub, see W_BACKEND)
 def load_model(
-    model_base_dir: str, model_type: str, device: str
-) -> faster_whisper.BatchedInferencePipeline:
-    logger.info(f"Loading Whisper model {model_type} for device: {device}")
-
-    # change HuggingFace dir to where model is downloaded
-    os.environ["HF_HOME"] = model_base_dir
-
-    # determine loading locally or have Whisper download from HuggingFace
-    model_location = get_model_location(model_base_dir, W_MODEL)
-
-    if model_location == "":
-        raise ValueError("Transcribe failure: Model could not be loaded")
-    model = faster_whisper.WhisperModel(
-        model_location,  # either local path or e.g. large-v2 (means HuggingFace download)
-        device=device,
-        compute_type=(  # float16 only works on GPU, float32 or int8 are recommended for CPU
-            "float16" if device == "cuda" else "float32"
-        ),
-    )
-    batching_model = faster_whisper.BatchedInferencePipeline(model=model)
-    logger.info(f"Model loaded from location: {model_location}")
-    return batching_model
+    model_base_dir: str, model_type: str, device: str, warm_up: bool = W_WARM_UP
+) -> AsrBackend:
+    logger.info(f"Loading {W_BACKEND} model {model_type} for device: {device}")
+    configure_caches(model_base_dir)  # before CUDA is initialised
+    model = get_backend(W_BACKEND, model_base_dir, model_type, device)
+    if warm_up:
+        warm_up_model(model)
+    return model
+
+
+# the CUDA driver JIT-compiles the kernels it has no binary for (e.g. on GPUs newer
+# than the CTranslate2 build) on first use. Keeping its cache in the (mounted)
+# MODEL_BASE_DIR spares every new container that work. Settings in the
+# environment take precedence
+def configure_caches(model_base_dir: str):
+    cache_dir = os.path.join(model_base_dir, ".cache")
+    os.environ.setdefault("CUDA_CACHE_PATH", os.path.join(cache_dir, "cuda"))
+    os.environ.setdefault("CUDA_CACHE_MAXSIZE", str(4 * 1024**3))  # the maximum
+    os.environ.setdefault("PYTORCH_KERNEL_CACHE_PATH", cache_dir)
+
+
+def warm_up_model(model: AsrBackend) -> float:
+    warm_up_s = model.warm_up()
+    logger.info(f"Model warmed up in {warm_up_s:.2f}s")
+    return warm_up_s
 
 
 def run_asr(
     input_path: str,
     output_dir: str,
     asset_id: str,
-    model=None,
-) -> Provenance:
+    model: Optional[AsrBackend] = None,
+    duration: float = -1,
+    on_progress: Optional[ProgressCallback] = None,
+    sink: Optional[OutputSink] = None,
+    cancel: Optional[CancelToken] = None,
+) -> Tuple[Provenance, Transcript]:
     logger.info(f"Starting ASR on {input_path}")
     start_time = time.time()
 
     if not model:
         logger.info("Model not passed as param, need to obtain it first")
-        model = load_model(MODEL_BASE_DIR, W_MODEL, W_DEVICE)
+        # a warm-up only pays off when the model transcribes more than one input
+        model = load_model(MODEL_BASE_DIR, W_MODEL, W_DEVICE, warm_up=False)
     if W_DEVICE == "cpu":
         logger.warning(f"Device selected is {W_DEVICE}: using a batch size of 1")
 
-    os.environ["PYTORCH_KERNEL_CACHE_PATH"] = MODEL_BASE_DIR
     logger.info("Processing segments")
 
-    if W_DEVICE == "cuda":
+    gpu_mem_measure = None
+    if model.device == "cuda":
+        from gpu_measure import GpuMemoryMeasure  # py3nvml is only needed on GPU
+
         gpu_mem_measure = GpuMemoryMeasure()
         gpu_mem_measure.start_measure_gpu_mem()
 
-    segments, _ = model.transcribe(
-        input_path,
-        vad_filter=W_VAD,
-        beam_size=W_BEAM_SIZE,
-        best_of=W_BEST_OF,
-        batch_size=W_BATCH_SIZE if W_DEVICE == "cuda" else 1,
-        language="nl",  # TODO: experiment without language parameter specified (for programs with foreign speech)
-        word_timestamps=W_WORD_TIMESTAMPS,
-    )
-
-    # Also added "carrierId" because the DAAN format requires it
-    transcript = {"carrierId": asset_id, "segments": process_segments(segments)}
-    end_time = (time.time() - start_time) * 1000
-
-    if W_DEVICE == "cuda":
-        max_mem_usage, gpu_limit = gpu_mem_measure.stop_measure_gpu_mem()
-        logger.info(
-            "Maximum GPU memory usage: %dMiB / %dMiB (%.2f%%)"
-            % (
-                max_mem_usage,
-                gpu_limit,
-                (max_mem_usage / gpu_limit) * 100,
+    # the measuring thread is stopped also when the run is cancelled (or fails),
+    # otherwise it would keep the worker from exiting
+    try:
+        # VAD and the decoding of the first batch happen before the first segment
+        with span(
+            "transcribe", backend=model.name, audio_s=duration
+        ) as transcribe_span:
+            segments = model.transcribe(input_path)
+            # the asset_id is the "carrierId", the DAAN format requires it
+            transcript = process_segments(
+                segments, asset_id, duration, on_progress, cancel
             )
-        )
-        del gpu_mem_measure
+            transcribe_span.set("segments", len(transcript.segments))
+            transcribe_span.set("words", transcript.word_count)
+        if W_DEFER_WORD_TIMESTAMPS:
+            # the words are added by alignment.py, the tokens are kept for it
+            transcript.word_alignment = "deferred"
+        end_time = (time.time() - start_time) * 1000
+    finally:
+        if gpu_mem_measure:
+            max_mem_usage, gpu_limit = gpu_mem_measure.stop_measure_gpu_mem()
+            logger.info(
+                "Maximum GPU memory usage: %dMiB / %dMiB (%.2f%%)"
+                % (
+                    max_mem_usage,
+                    gpu_limit,
+                    (max_mem_usage / gpu_limit) * 100,
+                )
+            )
+            del gpu_mem_measure
 
     provenance = Provenance(
         activity_name="Running",
@@ -103,42 +123,61 @@ def run_asr(
         processing_time_ms=end_time,
         start_time_unix=start_time,
         input_data=input_path,
-        output_data=os.path.join(output_dir, WHISPER_JSON_FILE),
     )
 
-    write_transcript_to_json(transcript, output_dir, WHISPER_JSON_FILE)
-    return provenance
+    # by default the transcript is saved in output_dir
+    sink = sink or LocalSink(output_dir)
+    with span("encode_whisper_transcript") as encode_span:
+        data = encode_whisper_transcript(transcript)
+        encode_span.set("bytes", len(data))
+    sink.put(WHISPER_JSON_FILE, data)
+    provenance.output_data = sink.location(WHISPER_JSON_FILE)
+    return provenance, transcript
 
 
-def process_segments(segments) -> list:
-    segments_to_add = []
-
-    for segment in segments:
-        words_to_add = []
-        if W_WORD_TIMESTAMPS:
-            for word in segment.words:
-                words_to_add.append(
-                    {
-                        "text": word.word.strip(),
-                        "start": word.start,
-                        "end": word.end,
-                        "confidence": word.probability,
-                    }
-                )
-        segments_to_add.append(
-            {
-                "id": segment.id,
-                "seek": segment.seek,
-                "start": segment.start,
-                "end": segment.end,
-                "text": segment.text.strip(),
-                "tokens": segment.tokens,
-                "temperature": segment.temperature,
-                "avg_logprob": segment.avg_logprob,
-                "compression_ratio": segment.compression_ratio,
-                "no_speech_prob": segment.no_speech_prob,
-                "words": words_to_add,
-            }
+# segments are transcribed lazily while iterating, so this also reports progress
+# (and stops transcribing when the run is cancelled)
+def process_segments(
+    segments,
+    asset_id: str,
+    duration: float = -1,
+    on_progress: Optional[ProgressCallback] = None,
+    cancel: Optional[CancelToken] = None,
+) -> Transcript:
+    builder = TranscriptBuilder(asset_id)
+    start_time = time.time()
+    add_words = W_WORD_TIMESTAMPS and not W_DEFER_WORD_TIMESTAMPS
+
+    for segment in segments:  # faster_whisper or asr_backend Segments
+        if cancel:
+            cancel.check()
+        if not builder:
+            current_span().set("first_segment_s", time.time() - start_time)
+        if on_progress and duration > 0:
+            on_progress("asr", min(segment.end / duration, 1.0))
+        builder.add_segment(
+            TranscriptSegment(
+                id=segment.id,
+                seek=segment.seek,
+                start=segment.start,
+                end=segment.end,
+                text=segment.text.strip(),
+                temperature=segment.temperature,
+                avg_logprob=segment.avg_logprob,
+                compression_ratio=segment.compression_ratio,
+                no_speech_prob=segment.no_speech_prob,
+            ),
+            segment.tokens,
+            get_word_columns(segment.words) if add_words else None,
         )
 
-    return segments_to_add
+    return builder.build()
+
+
+def get_word_columns(words: list) -> WordColumns:
+    return WordColumns(
+        [word.word.strip() for word in words],
+        [word.start for word in words],
+        [word.end for word in words],
+        [word.probability for word in words],
+    )
@@ -0,0 +1,134 @@
+import logging
+import mmap
+import struct
+import unicodedata
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+# An inverted index of the words of one asset, so search can find where a word is
+# said without loading (and re-tokenising) the transcript. Everything is
+# little-endian uint32, in columns, so it can be memory-mapped and searched as is:
+#
+#   header         magic, version, term count (T), posting count (P)
+#   term_offsets   T + 1 byte offsets of the terms in the term blob
+#   posting_starts T + 1 indexes of the first posting of each term
+#   segments       P index of the segment (in the DAAN transcript) of each posting
+#   word_offsets   P position of the word in the segment's "words" (DAAN)
+#   start_ms       P start of the word, like the DAAN wordTimes
+#   term blob      the sorted (by UTF-8 bytes) terms, UTF-8 encoded
+MAGIC = b"WIDX"
+VERSION = 1
+HEADER = struct.Struct("<4sIII")
+
+
+@dataclass
+class Posting:
+    segment: int
+    word_offset: int
+    start_ms: int
+
+
+# lowercase, without diacritics and punctuation: "Één," -> "een"
+def normalise(word: str) -> str:
+    decomposed = unicodedata.normalize("NFKD", word.casefold())
+    return "".join(c for c in decomposed if c.isalnum())
+
+
+# collects the postings while the DAAN transcript is generated
+class WordIndexBuilder:
+    def __init__(self):
+        self.postings: Dict[str, List[Tuple[int, int, int]]] = defaultdict(list)
+
+    def add(self, segment: int, word_offset: int, word: str, start_ms: int):
+        term = normalise(word)
+        if term:
+            self.postings[term].append((segment, word_offset, start_ms))
+
+    def to_bytes(self) -> bytes:
+        encoded = sorted((term.encode("utf-8"), term) for term in self.postings)
+        term_offsets = [0]
+        posting_starts = [0]
+        columns: Tuple[List[int], List[int], List[int]] = ([], [], [])
+        for encoded_term, term in encoded:
+            term_offsets.append(term_offsets[-1] + len(encoded_term))
+            for posting in self.postings[term]:
+                for column, value in zip(columns, posting):
+                    column.append(value)
+            posting_starts.append(len(columns[0]))
+
+        def pack(values: List[int]) -> bytes:
+            return struct.pack(f"<{len(values)}I", *values)
+
+        return b"".join(
+            [
+                HEADER.pack(MAGIC, VERSION, len(encoded), len(columns[0])),
+                pack(term_offsets),
+                pack(posting_starts),
+                *(pack(column) for column in columns),
+                *(encoded_term for encoded_term, _ in encoded),
+            ]
+        )
+
+
+# looks terms up in a memory-mapped index file: a binary search over the sorted
+# terms, only the pages it touches are read
+class WordIndex:
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.term_count, self.posting_count = HEADER.unpack_from(
+            self.data
+        )
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a (version {VERSION}) word index")
+        self.term_offsets = HEADER.size
+        self.posting_starts = self.term_offsets + 4 * (self.term_count + 1)
+        self.segments = self.posting_starts + 4 * (self.term_count + 1)
+        self.word_offsets = self.segments + 4 * self.posting_count
+        self.start_ms = self.word_offsets + 4 * self.posting_count
+        self.terms = self.start_ms + 4 * self.posting_count
+
+    def __enter__(self) -> "WordIndex":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.data.close()
+
+    def _uint(self, offset: int, i: int) -> int:
+        return struct.unpack_from("<I", self.data, offset + 4 * i)[0]
+
+    def _term(self, i: int) -> bytes:
+        start = self.terms + self._uint(self.term_offsets, i)
+        end = self.terms + self._uint(self.term_offsets, i + 1)
+        return self.data[start:end]
+
+    # where the (normalised) word is said, in order of appearance
+    def lookup(self, word: str) -> List[Posting]:
+        term = normalise(word).encode("utf-8")
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._term(middle) < term:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.term_count or self._term(low) != term:
+            return []
+        return [
+            Posting(
+                self._uint(self.segments, i),
+                self._uint(self.word_offsets, i),
+                self._uint(self.start_ms, i),
+            )
+            for i in range(
+                self._uint(self.posting_starts, low),
+                self._uint(self.posting_starts, low + 1),
+            )
+        ]